@@ -1,23 +1,48 @@
 # app.py — Outpainted Mockups (multi-only, alignment-safe, simple ingest resize)
 # Endpoints:
 #   GET  /healthz
+#   GET  /readyz
+#   GET  /metrics
 #   POST /outpaint/mockup     ← the only generator endpoint
 
+from __future__ import annotations
+
 import io
 import os
+import sys
 import base64
 import zipfile
+import importlib
+import threading
 from math import ceil
+from pathlib import Path
 from typing import Dict, Tuple, List
 
-import requests
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Request
 from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
-from PIL import Image, ImageOps, ImageFile
-from PIL.Image import Resampling
+from starlette.concurrency import run_in_threadpool
+
+sys.path.insert(0, str(Path(__file__).parent / "server" / "scripts"))
+from perf_metrics import instrument_app, register_metrics, stage  # noqa: E402
+from perf_profile import request_profile  # noqa: E402
+from single_flight import SingleFlight, request_key  # noqa: E402
+from upstream_limiter import UpstreamLimiter, UpstreamBusy  # noqa: E402
+import deadlines  # noqa: E402
+from deadlines import Deadline, Cancelled, ClientDisconnected, DEADLINE_HEADER  # noqa: E402
+from warmup import lazy_import, load  # noqa: E402
+from upload_ingest import UploadError, UploadLimit, read_upload  # noqa: E402
+
+
+def _pil_setup(module):
+    importlib.import_module("PIL.ImageFile").LOAD_TRUNCATED_IMAGES = True
 
-ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+# Imported on first use or by the warmup thread, so the port binds without them
+Image = lazy_import("PIL.Image", setup=_pil_setup)
+ImageOps = lazy_import("PIL.ImageOps")
+requests = lazy_import("requests")
+jwt = lazy_import("jwt")
 
 # =========================
 # Config / Presets
@@ -26,6 +51,10 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 DEFAULT_TARGET_PX = int(os.getenv("TARGET_PX", "2048"))                # upscale only if art is smaller
 DEFAULT_INGEST_LONG_EDGE = int(os.getenv("INGEST_LONG_EDGE", "2048"))  # simple proportional downscale
 OPENAI_MODEL = os.getenv("OPENAI_IMAGES_MODEL", "gpt-image-1")
+# Point at a stand-in (benchmarks/images_api_stub.py) for local load tests
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+# Times a call rate limited upstream is requeued (see server/scripts/upstream_limiter.py for the limits)
+UPSTREAM_429_RETRIES = int(os.getenv("UPSTREAM_429_RETRIES", "2"))
 
 STYLE_PROMPTS: Dict[str, str] = {
     "living_room": (
@@ -72,11 +101,19 @@ PRINT_SIZES: Dict[str, Tuple[int, int]] = {
 
 app = FastAPI(title="Outpainted Mockups (multi-only)", version="5.0")
 
+# Oversized bodies get 413 before the multipart form is parsed (MAX_UPLOAD_MB);
+# added before CORS so the 413 carries CORS headers
+app.add_middleware(UploadLimit)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_credentials=True,
     allow_methods=["*"], allow_headers=["*"],
 )
+# Per-stage timings: Server-Timing header on every response, histograms on /metrics
+instrument_app(app, "outpaint")
+# Process-wide admission control for Images API calls (UPSTREAM_* env, see upstream_limiter.py)
+_upstream = UpstreamLimiter.from_env("openai_images")
+register_metrics(_upstream.render_prometheus)
 
 @app.get("/healthz")
 def healthz():
@@ -89,24 +126,56 @@ def healthz():
         "note": "Only /outpaint/mockup is exposed. Ingest proportional resize is ON by default.",
     }
 
+_warm_state = {"ready": False, "imports": {}}
+_warm_lock = threading.Lock()
+
+def warm_caches() -> dict:
+    """
+    Import the heavy modules and load every PIL codec plugin up front (normally
+    imported lazily on first open). start_fastapi.py calls this before forking so
+    workers share the loaded modules, answering /healthz from the parent meanwhile;
+    single-process servers warm up on startup instead.
+    """
+    with _warm_lock:
+        if not _warm_state["ready"]:
+            _warm_state["imports"] = load(Image, ImageOps, requests, jwt)
+            Image.init()
+            _warm_state["ready"] = True
+    return {"ready": True, "pil_plugins": len(Image.OPEN), "imports": _warm_state["imports"]}
+
+@app.on_event("startup")
+def _warm_on_startup():
+    if not _warm_state["ready"]:
+        threading.Thread(target=warm_caches, name="outpaint-warmup", daemon=True).start()
+
+@app.get("/readyz")
+def readyz():
+    body = {
+        "ready": _warm_state["ready"],
+        "openai_key_configured": bool(os.getenv("OPENAI_API_KEY")),
+        "pid": os.getpid(),
+    }
+    return JSONResponse(body, status_code=200 if _warm_state["ready"] else 503)
+
 # =========================
 # Helpers
 # =========================
 
 def _img_to_png_bytes(img: Image.Image) -> bytes:
-    buf = io.BytesIO()
-    img.save(buf, "PNG")
-    return buf.getvalue()
+    with stage("encode"):
+        buf = io.BytesIO()
+        img.save(buf, "PNG")
+        return buf.getvalue()
 
 def _resize_fit(img: Image.Image, target: Tuple[int, int]) -> Image.Image:
-    return ImageOps.contain(img, target, Resampling.LANCZOS)
+    return ImageOps.contain(img, target, Image.Resampling.LANCZOS)
 
-def _ingest_simple_resize(file_bytes: bytes, enable: bool, max_long_edge: int) -> Image.Image:
+def _ingest_simple_resize(fp, enable: bool, max_long_edge: int) -> Image.Image:
     """
     Proportional resize ONLY if long edge exceeds max_long_edge.
     No padding/cropping; preserves aspect ratio exactly.
     """
-    img = Image.open(io.BytesIO(file_bytes))
+    img = Image.open(fp)
     img = ImageOps.exif_transpose(img)
     if not enable:
         return img.convert("RGBA")
@@ -114,7 +183,7 @@ def _ingest_simple_resize(file_bytes: bytes, enable: bool, max_long_edge: int) -
     long_edge = max(w, h)
     if long_edge > max_long_edge:
         s = max_long_edge / float(long_edge)
-        img = img.resize((int(w * s), int(h * s)), Resampling.LANCZOS)
+        img = img.resize((int(w * s), int(h * s)), Image.Resampling.LANCZOS)
     return img.convert("RGBA")
 
 def _pad_to_ratio(img: Image.Image, ratio_w: int, ratio_h: int, bg=(0, 0, 0, 0)):
@@ -150,7 +219,7 @@ def _pad_canvas_keep_center(img: Image.Image, pad_ratio: float, target_side: int
     longest = max(img.size)
     if longest < target_side:
         scale = target_side / float(longest)
-        img = img.resize((int(img.width * scale), int(img.height * scale)), Resampling.LANCZOS)
+        img = img.resize((int(img.width * scale), int(img.height * scale)), Image.Resampling.LANCZOS)
 
     w, h = img.size
     border = int(pad_ratio * max(w, h))
@@ -190,7 +259,7 @@ def _overlay_original_art(result_rgba: Image.Image, art_rgba: Image.Image,
             x0, y0, x1, y1 = bbox
     w, h = x1 - x0, y1 - y0
     if art_rgba.size != (w, h):
-        art_rgba = art_rgba.resize((w, h), Resampling.LANCZOS)
+        art_rgba = art_rgba.resize((w, h), Image.Resampling.LANCZOS)
     out = result_rgba.copy()
     out.paste(art_rgba, (x0, y0), art_rgba)
     return out
@@ -209,11 +278,12 @@ def _api_edit_size_for(canvas_size: Tuple[int, int]) -> Tuple[int, int, str]:
         return 1024, 1536, "1024x1536"
     return 1536, 1024, "1536x1024"
 
-def _openai_images_edit_multi(image_png: bytes, mask_png: bytes, prompt: str, n: int, size_str: str) -> List[str]:
+def _openai_images_edit_multi(image_png: bytes, mask_png: bytes, prompt: str, n: int, size_str: str,
+                              priority: str = "interactive") -> List[str]:
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise HTTPException(status_code=500, detail="OPENAI_API_KEY not set on server")
-    url = "https://api.openai.com/v1/images/edits"
+    url = f"{OPENAI_BASE_URL}/images/edits"
     headers = {"Authorization": f"Bearer {api_key}"}
     org_id = os.getenv("OPENAI_ORG_ID")
     if org_id:
@@ -224,10 +294,27 @@ def _openai_images_edit_multi(image_png: bytes, mask_png: bytes, prompt: str, n:
         "image": ("canvas.png", image_png, "image/png"),
         "mask":  ("mask.png",   mask_png,  "image/png"),
     }
-    try:
-        resp = requests.post(url, headers=headers, data=data, files=files, timeout=300)
-    except requests.RequestException as e:
-        raise HTTPException(status_code=502, detail=f"Images API request failed: {e}")
+    # Admission control: queue behind the account's rate limits rather than tripping them
+    for _ in range(UPSTREAM_429_RETRIES + 1):
+        try:
+            with _upstream.admit(images=int(data["n"]), priority=priority, deadline=deadlines.current()):
+                with stage("upstream"):
+                    # The read timeout is what ends a call still in flight at the deadline
+                    resp = requests.post(url, headers=headers, data=data, files=files, timeout=deadlines.timeout(300))
+        except UpstreamBusy as e:
+            raise HTTPException(status_code=429, detail=f"Image generation is busy, retry shortly ({e})",
+                                headers={"Retry-After": str(e.retry_after)})
+        except requests.RequestException as e:
+            deadlines.check("Images API response")  # timed out on our deadline, not an upstream failure
+            raise HTTPException(status_code=502, detail=f"Images API request failed: {e}")
+        if resp.status_code != 429:
+            break
+        # Rate limited anyway (other clients of the key, limits set too high): pause every
+        # caller, then requeue this one
+        _upstream.backoff(_retry_after_seconds(resp))
+    if resp.status_code == 429:
+        raise HTTPException(status_code=429, detail=f"Image API rate limited: {resp.text}",
+                            headers={"Retry-After": str(max(1, round(_retry_after_seconds(resp))))})
     if resp.status_code != 200:
         raise HTTPException(status_code=502, detail=f"Image API error [{resp.status_code}]: {resp.text}")
 
@@ -237,11 +324,20 @@ def _openai_images_edit_multi(image_png: bytes, mask_png: bytes, prompt: str, n:
         raise HTTPException(status_code=502, detail=f"Image API returned no data: {js}")
     return [it.get("b64_json") for it in items if it.get("b64_json")]
 
+def _retry_after_seconds(resp) -> float:
+    try:
+        return float(resp.headers.get("Retry-After", "1"))
+    except ValueError:
+        return 1.0
+
 # =========================================================
 # Multi-style / multi-variant endpoint (ONLY)
 # =========================================================
+_inflight = SingleFlight()
+
 @app.post("/outpaint/mockup")
 async def outpaint_mockup(
+    request: Request,
     file: UploadFile = File(...),
     styles: str = Form(",".join(DEFAULT_STYLE_LIST)),
     target_px: int = Form(DEFAULT_TARGET_PX),
@@ -257,7 +353,11 @@ async def outpaint_mockup(
     ingest_max_long_edge: int = Form(DEFAULT_INGEST_LONG_EDGE),
     return_format: str = Form("json"),        # json | png | zip
     filename: str = Form("mockup_bundle"),
+    profile: int = Form(0),                   # 1 = profile this request (needs PERF_PROFILE_FORM=1)
+    deadline_ms: int = Form(0),               # time budget; also the X-Deadline-Ms header (smaller wins)
 ):
+    if profile:
+        request_profile("outpaint POST /outpaint/mockup")
     style_list = [s.strip() for s in styles.split(",") if s.strip()]
     invalid = [s for s in style_list if s not in STYLE_PROMPTS]
     if invalid:
@@ -266,10 +366,45 @@ async def outpaint_mockup(
         raise HTTPException(400, "No valid styles provided.")
 
     try:
-        raw = await file.read()
-        art = _ingest_simple_resize(raw, bool(ingest_resize), int(ingest_max_long_edge))
+        upload = await read_upload(file)
+    except UploadError as e:
+        raise HTTPException(e.status_code, str(e))
+    params = dict(style_list=style_list, target_px=target_px, pad_ratio=pad_ratio, normalize_ratio=normalize_ratio,
+                  mat_pct=mat_pct, variants=variants, overlay_original=overlay_original,
+                  overlay_inset_px=overlay_inset_px, make_print_previews=make_print_previews,
+                  ingest_resize=ingest_resize, ingest_max_long_edge=ingest_max_long_edge,
+                  return_format=return_format.lower(), filename=filename)
+    # Remaining styles are skipped once the deadline passes or every waiting client has gone
+    deadline = Deadline.from_ms(request.headers.get(DEADLINE_HEADER), deadline_ms)
+    started = []
+
+    def job():
+        started.append(True)  # the job owns the upload from here and closes it once decoded
+        return run_in_threadpool(deadline.run, _outpaint_mockup, upload, **params)
+
+    # Identical concurrent requests (double clicks, retries) share one job and one upstream bill
+    try:
+        return await _inflight.run(request_key(upload.sha256, **params), job, deadline=deadline, request=request)
+    except ClientDisconnected:
+        return Response(status_code=499)  # nobody to answer
+    except Cancelled as e:
+        raise HTTPException(504, f"Mockup not finished in time: {e}")
+    finally:
+        if not started:
+            upload.close()  # joined another request's job; this upload is never read
+
+
+def _outpaint_mockup(upload, style_list: List[str], target_px: int, pad_ratio: float, normalize_ratio: str,
+                     mat_pct: float, variants: int, overlay_original: int, overlay_inset_px: int,
+                     make_print_previews: int, ingest_resize: int, ingest_max_long_edge: int,
+                     return_format: str, filename: str):
+    try:
+        with stage("decode"):
+            art = _ingest_simple_resize(upload.rewind(), bool(ingest_resize), int(ingest_max_long_edge))
     except Exception as e:
         raise HTTPException(400, f"Could not read image: {e}")
+    finally:
+        upload.close()  # decoded; drop the spooled bytes
 
     if normalize_ratio:
         try:
@@ -286,58 +421,76 @@ async def outpaint_mockup(
         art = mat_canvas
 
     # Build canvas + mask (one geometry)
-    canvas, keep_bbox = _pad_canvas_keep_center(art, pad_ratio=pad_ratio, target_side=target_px)
-    mask = _build_outpaint_mask(canvas.size, keep_bbox)
+    with stage("canvas"):
+        canvas, keep_bbox = _pad_canvas_keep_center(art, pad_ratio=pad_ratio, target_side=target_px)
+        mask = _build_outpaint_mask(canvas.size, keep_bbox)
 
-    # API-safe size
-    api_w, api_h, api_size_str = _api_edit_size_for(canvas.size)
-    canvas_api = canvas.resize((api_w, api_h), Resampling.LANCZOS)
-    mask_api   = mask.resize((api_w, api_h), Resampling.NEAREST)
+        # API-safe size
+        api_w, api_h, api_size_str = _api_edit_size_for(canvas.size)
+        canvas_api = canvas.resize((api_w, api_h), Image.Resampling.LANCZOS)
+        mask_api   = mask.resize((api_w, api_h), Image.Resampling.NEAREST)
 
     one_style = len(style_list) == 1
     n_per_style = max(1, min(int(variants), 10)) if one_style else 1
+    # Single-style requests are someone waiting on a preview; style packs queue behind them
+    priority = "interactive" if one_style else "bulk"
 
     # Fast PNG path → first variant, first style
     if return_format.lower() == "png":
         style = style_list[0]
         prompt = f"{PRESERVE_DIRECTIVE} {STYLE_PROMPTS[style]}"
+        deadlines.check(f"style {style}")
         b64_list = _openai_images_edit_multi(
             _img_to_png_bytes(canvas_api), _img_to_png_bytes(mask_api),
-            prompt=prompt, n=n_per_style, size_str=api_size_str
+            prompt=prompt, n=n_per_style, size_str=api_size_str, priority=priority
         )
-        out = Image.open(io.BytesIO(base64.b64decode(b64_list[0]))).convert("RGBA")
-        if out.size != canvas.size:
-            out = out.resize(canvas.size, Resampling.LANCZOS)
-        if overlay_original:
-            x0, y0, x1, y1 = keep_bbox
-            placed_art = canvas.crop((x0, y0, x1, y1))
-            out = _overlay_original_art(out, placed_art, keep_bbox, inset_px=max(0, int(overlay_inset_px)))
-        buf = io.BytesIO(); out.save(buf, "PNG")
+        with stage("postprocess"):
+            out = Image.open(io.BytesIO(base64.b64decode(b64_list[0]))).convert("RGBA")
+            if out.size != canvas.size:
+                out = out.resize(canvas.size, Image.Resampling.LANCZOS)
+            if overlay_original:
+                x0, y0, x1, y1 = keep_bbox
+                placed_art = canvas.crop((x0, y0, x1, y1))
+                out = _overlay_original_art(out, placed_art, keep_bbox, inset_px=max(0, int(overlay_inset_px)))
+        with stage("encode"):
+            buf = io.BytesIO(); out.save(buf, "PNG")
         suffix = "_v01" if n_per_style > 1 else ""
         headers = {"Content-Disposition": f'inline; filename="{filename}_{style}{suffix}.png"'}
         return Response(content=buf.getvalue(), media_type="image/png", headers=headers)
 
     results: List[Dict[str, object]] = []
     previews_map: Dict[str, Dict[str, Dict[str, str]]] = {}
+    skipped: List[str] = []
 
-    for style in style_list:
+    for idx, style in enumerate(style_list):
         prompt = f"{PRESERVE_DIRECTIVE} {STYLE_PROMPTS[style]}"
-        b64_list = _openai_images_edit_multi(
-            _img_to_png_bytes(canvas_api), _img_to_png_bytes(mask_api),
-            prompt=prompt, n=n_per_style, size_str=api_size_str
-        )
+        try:
+            deadlines.check(f"style {style}")
+            b64_list = _openai_images_edit_multi(
+                _img_to_png_bytes(canvas_api), _img_to_png_bytes(mask_api),
+                prompt=prompt, n=n_per_style, size_str=api_size_str, priority=priority
+            )
+        except Cancelled:
+            if not results:
+                raise
+            # Out of time: return the styles that are done
+            skipped = style_list[idx:]
+            break
 
         fixed_b64_list: List[str] = []
         for b64 in b64_list:
-            img = Image.open(io.BytesIO(base64.b64decode(b64))).convert("RGBA")
-            if img.size != canvas.size:
-                img = img.resize(canvas.size, Resampling.LANCZOS)
-            if overlay_original:
-                x0, y0, x1, y1 = keep_bbox
-                placed_art = canvas.crop((x0, y0, x1, y1))
-                img = _overlay_original_art(img, placed_art, keep_bbox, inset_px=max(0, int(overlay_inset_px)))
-            buf = io.BytesIO(); img.save(buf, "PNG")
-            fixed_b64_list.append(base64.b64encode(buf.getvalue()).decode("utf-8"))
+            with stage("postprocess"):
+                img = Image.open(io.BytesIO(base64.b64decode(b64))).convert("RGBA")
+                if img.size != canvas.size:
+                    img = img.resize(canvas.size, Image.Resampling.LANCZOS)
+                if overlay_original:
+                    x0, y0, x1, y1 = keep_bbox
+                    placed_art = canvas.crop((x0, y0, x1, y1))
+                    img = _overlay_original_art(img, placed_art, keep_bbox, inset_px=max(0, int(overlay_inset_px)))
+            with stage("encode"):
+                buf = io.BytesIO(); img.save(buf, "PNG")
+            with stage("base64"):
+                fixed_b64_list.append(base64.b64encode(buf.getvalue()).decode("utf-8"))
 
         results.append({
             "style": style,
@@ -349,16 +502,17 @@ async def outpaint_mockup(
         })
 
         if make_print_previews:
-            pv_style: Dict[str, Dict[str, str]] = {}
-            for i, vb64 in enumerate(fixed_b64_list, start=1):
-                img = Image.open(io.BytesIO(base64.b64decode(vb64))).convert("RGBA")
-                pv_variant: Dict[str, str] = {}
-                for name, wh in PRINT_SIZES.items():
-                    thumb = _resize_fit(img, wh)
-                    tbuf = io.BytesIO(); thumb.save(tbuf, "PNG")
-                    pv_variant[name] = base64.b64encode(tbuf.getvalue()).decode("utf-8")
-                pv_style[f"v{i:02d}"] = pv_variant
-            previews_map[style] = pv_style
+            with stage("previews"):
+                pv_style: Dict[str, Dict[str, str]] = {}
+                for i, vb64 in enumerate(fixed_b64_list, start=1):
+                    img = Image.open(io.BytesIO(base64.b64decode(vb64))).convert("RGBA")
+                    pv_variant: Dict[str, str] = {}
+                    for name, wh in PRINT_SIZES.items():
+                        thumb = _resize_fit(img, wh)
+                        tbuf = io.BytesIO(); thumb.save(tbuf, "PNG")
+                        pv_variant[name] = base64.b64encode(tbuf.getvalue()).decode("utf-8")
+                    pv_style[f"v{i:02d}"] = pv_variant
+                previews_map[style] = pv_style
 
     if return_format.lower() == "zip":
         mem = io.BytesIO()
@@ -375,6 +529,8 @@ async def outpaint_mockup(
         zip_bytes = mem.getvalue()
         headers = {"Content-Disposition": f'attachment; filename="{filename}.zip"',
                    "Content-Length": str(len(zip_bytes))}
+        if skipped:
+            headers["X-Skipped-Styles"] = ",".join(skipped)
         return Response(content=zip_bytes, media_type="application/zip", headers=headers)
 
     return JSONResponse({
@@ -386,6 +542,7 @@ async def outpaint_mockup(
         },
         "print_previews": previews_map,
         "total_variants": sum(len(item["variants"]) for item in results),
+        "skipped_styles": skipped,
         "note": "Generated with OpenAI Images API (gpt-image-1) via outpainting.",
     })
 
@@ -394,7 +551,6 @@ async def outpaint_mockup(
 # JWT auth for frontend integration
 # =========================
 
-import jwt
 from fastapi import Depends, HTTPException
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
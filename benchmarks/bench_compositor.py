@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Compositor benchmark - every template under templates/ against synthetic artworks
+
+Runs process_single_template (the batch path) and, with --api, POST /mockup/apply
+in-process, for each template x artwork size (1, 12, 50 MP) x shape (portrait,
+landscape, square). Per case it reports:
+
+    p50/p95 wall time per stage (from perf_metrics stage timings) and in total
+    peak RSS and peak traced allocation per stage (one extra run under perf_profile;
+    for --api, one extra request profiled by the service itself via X-Profile)
+    output PNG bytes
+
+Results can be stored as a baseline and later runs compared against it; any
+stage or total p50 (or peak RSS) above baseline * (1 + threshold) is flagged
+and the exit status is 1. Baselines are machine-specific: record one on the
+box the comparison runs on.
+
+Usage:
+    python benchmarks/bench_compositor.py [--runs 5] [--sizes 1,12,50] [--shapes portrait,landscape,square]
+        [--templates bedroom/bedroom_01,...] [--api] [--save-baseline FILE] [--baseline FILE]
+        [--threshold 0.15] [--output FILE]
+
+Prints a table to stderr and the results JSON to stdout (or --output).
+"""
+import os
+import sys
+import json
+import math
+import time
+import base64
+import argparse
+import platform
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import cv2
+from PIL import Image
+
+REPO = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO / "server" / "scripts"))
+sys.path.insert(0, str(REPO))  # template_mockup_api for --api
+# Measure compositing, not result-cache hits
+os.environ["MOCKUP_CACHE_DIR"] = ""
+
+from template_store import list_templates, templates_root  # noqa: E402
+from batch_mockup import process_single_template, read_artwork  # noqa: E402
+from perf_metrics import start_request  # noqa: E402
+import perf_profile  # noqa: E402
+from perf_profile import profiling  # noqa: E402
+
+SIZES_MP = (1, 12, 50)
+SHAPES = {"portrait": 2 / 3, "landscape": 3 / 2, "square": 1.0}  # width / height
+DEFAULT_THRESHOLD = 0.15
+# Differences below these are noise whatever the ratio
+MIN_DELTA_MS = 2.0
+MIN_DELTA_BYTES = 8 * 1024 * 1024
+API_PROFILE_TOKEN = "bench_compositor"
+
+
+def synthetic_artwork(megapixels, shape, seed=0):
+    """JPEG bytes of a deterministic gradient + noise image of about megapixels MP"""
+    ratio = SHAPES[shape]
+    h = int(round(math.sqrt(megapixels * 1e6 / ratio)))
+    w = int(round(h * ratio))
+    rng = np.random.default_rng(seed)
+    xs = np.linspace(0, 255, w, dtype=np.float32)
+    ys = np.linspace(0, 255, h, dtype=np.float32)[:, None]
+    img = np.empty((h, w, 3), np.uint8)
+    img[..., 0] = xs
+    img[..., 1] = ys
+    img[..., 2] = (xs + ys) * 0.5
+    # Noise keeps the JPEG (and the decode) about as heavy as a photo
+    img ^= rng.integers(0, 32, size=(h, w, 1), dtype=np.uint8)
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+    if not ok:
+        raise RuntimeError("JPEG encode failed")
+    return buf.tobytes(), (w, h)
+
+
+def _percentiles(values):
+    return {"p50": round(float(np.percentile(values, 50)), 2),
+            "p95": round(float(np.percentile(values, 95)), 2)}
+
+
+def _summarise(samples, walls):
+    """{stage: [ms per run]} and wall times -> p50/p95 per stage and total"""
+    stages = {name: _percentiles(ms) for name, ms in samples.items()}
+    return {"stages": stages, "total": _percentiles(walls)}
+
+
+def _collect(samples, timings):
+    for name, ms in timings.items():
+        samples.setdefault(name, []).append(ms)
+
+
+def _memory_run(fn, label):
+    """Run fn once under perf_profile; returns (per-stage peak RSS, per-stage peak traced bytes)"""
+    with tempfile.TemporaryDirectory() as tmp:
+        with profiling(label, tmp) as holder:
+            fn()
+    summary = holder.get("summary") or {}
+    return summary.get("stage_rss_peak_bytes", {}), summary.get("stage_peak_bytes", {})
+
+
+def bench_artwork(path, runs):
+    """read_artwork alone: the per-artwork read/decode stages"""
+    samples, walls = {}, []
+    read_artwork(str(path))  # warm the page cache
+    for _ in range(runs):
+        timings = start_request()
+        t0 = time.perf_counter()
+        read_artwork(str(path))
+        walls.append((time.perf_counter() - t0) * 1000.0)
+        _collect(samples, timings)
+    result = _summarise(samples, walls)
+    result["rss_bytes"], result["alloc_bytes"] = _memory_run(lambda: read_artwork(str(path)), "artwork")
+    return result
+
+
+def bench_template(art, room, template_id, runs):
+    """process_single_template for one template: stage timings, memory and output size"""
+    template = {"room": room, "id": template_id}
+    first = process_single_template(art, template)  # warm-up: compiles/maps the template
+    if not first["success"]:
+        return {"error": first["error"]}
+    samples, walls = {}, []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        out = process_single_template(art, template)
+        walls.append((time.perf_counter() - t0) * 1000.0)
+        _collect(samples, out["timings"])
+    result = _summarise(samples, walls)
+    result["output_bytes"] = len(base64.b64decode(first["image_data"]))
+    result["rss_bytes"], result["alloc_bytes"] = _memory_run(
+        lambda: process_single_template(art, template), f"{room}/{template_id}")
+    return result
+
+
+def _server_timing(header):
+    timings = {}
+    for part in filter(None, (p.strip() for p in (header or "").split(","))):
+        name, _, dur = part.partition(";dur=")
+        if dur:
+            timings[name] = float(dur)
+    return timings
+
+
+def _api_memory_run(post):
+    """One request profiled by the service (X-Profile); same fields as _memory_run
+
+    The TestClient app runs in this process, so its VmHWM is the server's.
+    """
+    saved = perf_profile.PROFILE_TOKEN, perf_profile.PROFILE_DIR
+    with tempfile.TemporaryDirectory() as tmp:
+        perf_profile.PROFILE_TOKEN, perf_profile.PROFILE_DIR = API_PROFILE_TOKEN, tmp
+        try:
+            profile_id = post({perf_profile.PROFILE_HEADER: API_PROFILE_TOKEN}).headers.get("x-profile-id")
+            summary = json.loads((Path(tmp) / f"{profile_id}.json").read_text()) if profile_id else {}
+        finally:
+            perf_profile.PROFILE_TOKEN, perf_profile.PROFILE_DIR = saved
+    return summary.get("stage_rss_peak_bytes", {}), summary.get("stage_peak_bytes", {})
+
+
+def bench_api(client, raw, room, template_id, runs):
+    """POST /mockup/apply in-process; stages from the Server-Timing header, memory from X-Profile"""
+    def post(headers=None):
+        return client.post("/mockup/apply", data={"room": room, "template_id": template_id},
+                           files={"file": ("art.jpg", raw, "image/jpeg")}, headers=headers)
+
+    first = post()
+    if first.status_code != 200:
+        return {"error": f"HTTP {first.status_code}: {first.text[:200]}"}
+    samples, walls = {}, []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        resp = post()
+        walls.append((time.perf_counter() - t0) * 1000.0)
+        _collect(samples, _server_timing(resp.headers.get("server-timing")))
+    result = _summarise(samples, walls)
+    result["output_bytes"] = len(first.content)
+    result["rss_bytes"], result["alloc_bytes"] = _api_memory_run(post)
+    return result
+
+
+def _regressions(results, baseline, threshold):
+    """[(case, metric, old, new)] for every metric worse than baseline * (1 + threshold)"""
+    found = []
+    for key, case in results["cases"].items():
+        old = baseline.get("cases", {}).get(key)
+        if not old or "error" in case or "error" in old:
+            continue
+        pairs = [("total.p50", old["total"]["p50"], case["total"]["p50"], MIN_DELTA_MS),
+                 ("total.p95", old["total"]["p95"], case["total"]["p95"], MIN_DELTA_MS)]
+        for stage, stat in case["stages"].items():
+            if stage in old["stages"]:
+                pairs.append((f"{stage}.p50", old["stages"][stage]["p50"], stat["p50"], MIN_DELTA_MS))
+        old_rss = max(old.get("rss_bytes", {}).values(), default=0)
+        new_rss = max(case.get("rss_bytes", {}).values(), default=0)
+        if old_rss and new_rss:
+            pairs.append(("peak_rss", old_rss, new_rss, MIN_DELTA_BYTES))
+        for metric, before, after, min_delta in pairs:
+            if after > before * (1 + threshold) and after - before > min_delta:
+                found.append((key, metric, before, after))
+    return found
+
+
+def _print_case(key, case):
+    if "error" in case:
+        print(f"{key:48s} ERROR {case['error']}", file=sys.stderr)
+        return
+    rss = max(case.get("rss_bytes", {}).values(), default=0) / 1048576
+    rss = f"{rss:7.1f}MB" if rss else "      -  "
+    stages = "  ".join(f"{n} {s['p50']:.0f}" for n, s in case["stages"].items() if s["p50"] >= 1)
+    print(f"{key:48s} p50 {case['total']['p50']:8.1f}ms  p95 {case['total']['p95']:8.1f}ms  "
+          f"rss {rss}  {stages}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the compositor over the template corpus")
+    parser.add_argument("--runs", type=int, default=5, help="Timed runs per case (after one warm-up)")
+    parser.add_argument("--sizes", default=",".join(map(str, SIZES_MP)), help="Artwork sizes in MP")
+    parser.add_argument("--shapes", default=",".join(SHAPES), help="Artwork shapes")
+    parser.add_argument("--templates", default="", help="room/id list (default: every template)")
+    parser.add_argument("--api", action="store_true", help="Also benchmark POST /mockup/apply in-process")
+    parser.add_argument("--baseline", help="Compare against this results file")
+    parser.add_argument("--save-baseline", metavar="FILE", help="Write the results here as the new baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Flag metrics slower than baseline by more than this fraction")
+    parser.add_argument("--output", help="Write results JSON here instead of stdout")
+    args = parser.parse_args()
+
+    root = templates_root()
+    if args.templates:
+        templates = [tuple(t.split("/", 1)) for t in args.templates.split(",") if t.strip()]
+    else:
+        templates = list_templates(root)
+    if not templates:
+        print(json.dumps({"error": f"No templates found under {root}"}))
+        sys.exit(1)
+    sizes = [float(s) for s in args.sizes.split(",") if s.strip()]
+    shapes = [s.strip() for s in args.shapes.split(",") if s.strip()]
+
+    client = None
+    if args.api:
+        os.environ.setdefault("TEMPLATE_ROOT_DIR", str(root.resolve()))
+        from fastapi.testclient import TestClient
+        import template_mockup_api
+        client = TestClient(template_mockup_api.app)
+
+    results = {
+        "meta": {"python": platform.python_version(), "numpy": np.__version__, "opencv": cv2.__version__,
+                 "pillow": Image.__version__, "machine": platform.machine(), "cpus": os.cpu_count(),
+                 "runs": args.runs, "templates": len(templates)},
+        "cases": {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for mp in sizes:
+            for shape in shapes:
+                label = f"{mp:g}mp-{shape}"
+                raw, (w, h) = synthetic_artwork(mp, shape)
+                path = Path(tmp) / f"{label}.jpg"
+                path.write_bytes(raw)
+                print(f"Artwork {label}: {w}x{h}, {len(raw) / 1048576:.1f}MB JPEG", file=sys.stderr)
+
+                key = f"artwork@{label}"
+                results["cases"][key] = bench_artwork(path, args.runs)
+                _print_case(key, results["cases"][key])
+                art = read_artwork(str(path))
+                for room, template_id in templates:
+                    key = f"batch:{room}/{template_id}@{label}"
+                    results["cases"][key] = bench_template(art, room, template_id, args.runs)
+                    _print_case(key, results["cases"][key])
+                    if client is not None:
+                        key = f"api:{room}/{template_id}@{label}"
+                        results["cases"][key] = bench_api(client, raw, room, template_id, args.runs)
+                        _print_case(key, results["cases"][key])
+                del art, raw
+
+    status = 0
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        regressions = _regressions(results, baseline, args.threshold)
+        results["regressions"] = [{"case": c, "metric": m, "baseline": b, "current": a}
+                                  for c, m, b, a in regressions]
+        for case, metric, before, after in regressions:
+            print(f"REGRESSION {case} {metric}: {before:g} -> {after:g} (x{after / before:.2f})", file=sys.stderr)
+        print(f"{len(regressions)} regression(s) above {args.threshold:.0%} vs {args.baseline}", file=sys.stderr)
+        status = 1 if regressions else 0
+
+    text = json.dumps(results, indent=2)
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(text)
+        print(f"Baseline saved to {args.save_baseline}", file=sys.stderr)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+    sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Images API stand-in - a local /v1/images/edits for load-testing the outpaint services
+
+Accepts the same multipart request as the real endpoint (image, mask, prompt,
+model, size, n) and answers {"created", "data": [{"b64_json"}, ...]} after a
+configurable latency. The returned images are the submitted canvas re-encoded
+at the requested size, so the caller's decode/resize/encode work is realistic.
+A fraction of requests can be answered with 429 (with Retry-After) or 500.
+
+Usage:
+    python benchmarks/images_api_stub.py [--port 9100] [--latency-ms 8000] [--jitter-ms 2000]
+        [--rate-limit 0.05] [--error-rate 0.01]
+
+Then run the service under test with
+    OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=stub
+
+GET /stats returns request/response counters.
+"""
+import io
+import os
+import time
+import base64
+import random
+import asyncio
+import argparse
+
+import uvicorn
+from fastapi import FastAPI, File, Form, UploadFile
+from fastapi.responses import JSONResponse
+from PIL import Image
+
+CONFIG = {
+    "latency_ms": float(os.environ.get("STUB_LATENCY_MS", "8000")),
+    "jitter_ms": float(os.environ.get("STUB_JITTER_MS", "2000")),
+    "rate_limit": float(os.environ.get("STUB_RATE_LIMIT", "0")),
+    "error_rate": float(os.environ.get("STUB_ERROR_RATE", "0")),
+}
+_stats = {"requests": 0, "ok": 0, "rate_limited": 0, "errors": 0, "in_flight": 0, "max_in_flight": 0}
+
+app = FastAPI(title="Images API stub")
+
+
+def _render(raw, size_str):
+    """Submitted canvas as a PNG of the requested size (base64)"""
+    w, h = (int(v) for v in size_str.split("x"))
+    img = Image.open(io.BytesIO(raw)).convert("RGBA")
+    if img.size != (w, h):
+        img = img.resize((w, h), Image.Resampling.BILINEAR)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", compress_level=1)
+    return base64.b64encode(buf.getvalue()).decode("ascii")
+
+
+@app.post("/v1/images/edits")
+async def images_edits(
+    image: UploadFile = File(...),
+    mask: UploadFile = File(None),
+    prompt: str = Form(...),
+    model: str = Form("gpt-image-1"),
+    size: str = Form("1024x1024"),
+    n: int = Form(1),
+):
+    _stats["requests"] += 1
+    _stats["in_flight"] += 1
+    _stats["max_in_flight"] = max(_stats["max_in_flight"], _stats["in_flight"])
+    try:
+        raw = await image.read()
+        if mask is not None:
+            await mask.read()
+        roll = random.random()
+        if roll < CONFIG["rate_limit"]:
+            _stats["rate_limited"] += 1
+            return JSONResponse(status_code=429, headers={"Retry-After": "1"},
+                                content={"error": {"message": "Rate limit reached (stub)", "type": "requests"}})
+        delay = max(0.0, random.gauss(CONFIG["latency_ms"], CONFIG["jitter_ms"] / 2)) / 1000.0
+        await asyncio.sleep(delay)
+        if roll < CONFIG["rate_limit"] + CONFIG["error_rate"]:
+            _stats["errors"] += 1
+            return JSONResponse(status_code=500, content={"error": {"message": "Internal error (stub)"}})
+        b64 = await asyncio.get_running_loop().run_in_executor(None, _render, raw, size)
+        _stats["ok"] += 1
+        return {"created": int(time.time()), "data": [{"b64_json": b64} for _ in range(max(1, min(n, 10)))]}
+    finally:
+        _stats["in_flight"] -= 1
+
+
+@app.get("/stats")
+def stats():
+    return dict(_stats, **CONFIG)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Images API edits endpoint")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency-ms", type=float, default=CONFIG["latency_ms"], help="Mean response latency")
+    parser.add_argument("--jitter-ms", type=float, default=CONFIG["jitter_ms"], help="Latency spread (~2 sigma)")
+    parser.add_argument("--rate-limit", type=float, default=CONFIG["rate_limit"], help="Fraction answered 429")
+    parser.add_argument("--error-rate", type=float, default=CONFIG["error_rate"], help="Fraction answered 500")
+    args = parser.parse_args()
+    CONFIG.update(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                  rate_limit=args.rate_limit, error_rate=args.error_rate)
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Outpaint load driver - concurrent /outpaint/mockup requests against one instance
+
+For each concurrency level, N workers keep a request in flight until the level's
+request budget is spent. While they run, the service's /metrics is polled for
+event-loop lag and resident memory. Reports throughput, latency p50/p95/p99,
+status counts, response bytes, the largest loop lag and peak RSS per level.
+
+Run against the Images API stand-in so the numbers measure this service, not
+the upstream:
+
+    python benchmarks/images_api_stub.py --latency-ms 8000 &
+    OPENAI_BASE_URL=http://127.0.0.1:9100/v1 OPENAI_API_KEY=stub uvicorn app:app --port 8000 &
+    python benchmarks/load_outpaint.py --url http://127.0.0.1:8000 --artwork test_artwork.jpg \\
+        --concurrency 1,4,16,32 --requests 64 --formats json,png,zip
+
+Prints a table to stderr and the results JSON to stdout.
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+from pathlib import Path
+
+import numpy as np
+import aiohttp
+
+FORMATS = ("json", "png", "zip")
+
+
+def _gauge(text, name):
+    """First sample of a gauge in Prometheus text, or None"""
+    for line in text.splitlines():
+        if line.startswith(name) and not line.startswith(name + "_"):
+            try:
+                return float(line.rsplit(" ", 1)[1])
+            except ValueError:
+                return None
+    return None
+
+
+async def _poll_metrics(session, url, interval, out, stop):
+    """Track the largest event-loop lag and RSS reported while the level runs"""
+    while not stop.is_set():
+        try:
+            async with session.get(f"{url}/metrics") as resp:
+                text = await resp.text()
+            lag = _gauge(text, "event_loop_lag_seconds")
+            rss = _gauge(text, "process_resident_memory_bytes")
+            if lag is not None:
+                out["loop_lag_ms"].append(lag * 1000.0)
+            if rss is not None:
+                out["rss_bytes"].append(rss)
+        except aiohttp.ClientError:
+            out["metrics_errors"] += 1
+        try:
+            await asyncio.wait_for(stop.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def _one(session, url, artwork, fields):
+    form = aiohttp.FormData()
+    for key, value in fields.items():
+        form.add_field(key, str(value))
+    form.add_field("file", artwork, filename="artwork.jpg", content_type="image/jpeg")
+    t0 = time.perf_counter()
+    try:
+        async with session.post(f"{url}/outpaint/mockup", data=form) as resp:
+            body = await resp.read()
+            return resp.status, (time.perf_counter() - t0) * 1000.0, len(body)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+        return type(exc).__name__, (time.perf_counter() - t0) * 1000.0, 0
+
+
+async def run_level(url, artwork, fields, concurrency, total, poll_interval, timeout):
+    """total requests with concurrency in flight; returns the level's summary"""
+    results = []
+    remaining = [total]
+    metrics = {"loop_lag_ms": [], "rss_bytes": [], "metrics_errors": 0}
+    limits = aiohttp.TCPConnector(limit=concurrency + 2)
+    async with aiohttp.ClientSession(connector=limits, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        stop = asyncio.Event()
+        poller = asyncio.create_task(_poll_metrics(session, url, poll_interval, metrics, stop))
+
+        async def worker():
+            while remaining[0] > 0:
+                remaining[0] -= 1
+                results.append(await _one(session, url, artwork, fields))
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - t0
+        stop.set()
+        await poller
+
+    ok = [ms for status, ms, _ in results if status == 200]
+    statuses = {}
+    for status, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    summary = {
+        "concurrency": concurrency,
+        "requests": len(results),
+        "elapsed_s": round(elapsed, 2),
+        "throughput_rps": round(len(ok) / elapsed, 3) if elapsed else 0.0,
+        "statuses": statuses,
+        "response_bytes_mean": int(np.mean([b for s, _, b in results if s == 200])) if ok else 0,
+        "loop_lag_ms_max": round(max(metrics["loop_lag_ms"], default=0.0), 1),
+        "loop_lag_ms_p95": round(float(np.percentile(metrics["loop_lag_ms"], 95)), 1) if metrics["loop_lag_ms"] else None,
+        "rss_bytes_peak": int(max(metrics["rss_bytes"], default=0)) or None,
+    }
+    if ok:
+        summary.update({f"latency_ms_p{q}": round(float(np.percentile(ok, q)), 1) for q in (50, 95, 99)})
+    return summary
+
+
+async def main_async(args):
+    artwork = Path(args.artwork).read_bytes()
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+    formats = [f.strip() for f in args.formats.split(",") if f.strip()]
+    bad = [f for f in formats if f not in FORMATS]
+    if bad:
+        raise ValueError(f"Unknown formats {bad}; choose from {list(FORMATS)}")
+
+    report = {"url": args.url, "styles": args.styles, "variants": args.variants, "levels": []}
+    for fmt in formats:
+        fields = {"styles": args.styles, "variants": args.variants, "return_format": fmt}
+        for concurrency in levels:
+            total = args.requests or concurrency * 4
+            level = await run_level(args.url, artwork, fields, concurrency, total, args.poll_interval, args.timeout)
+            level["format"] = fmt
+            report["levels"].append(level)
+            rss = level["rss_bytes_peak"]
+            print(f"{fmt:4s} c={concurrency:<4d} {level['throughput_rps']:7.2f} req/s  "
+                  f"p50 {level.get('latency_ms_p50', 0):8.0f}ms  p95 {level.get('latency_ms_p95', 0):8.0f}ms  "
+                  f"p99 {level.get('latency_ms_p99', 0):8.0f}ms  loop lag max {level['loop_lag_ms_max']:7.1f}ms  "
+                  f"rss {rss / 1048576 if rss else 0:7.1f}MB  {level['statuses']}", file=sys.stderr)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent load against /outpaint/mockup")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Service base URL")
+    parser.add_argument("--artwork", required=True, help="Artwork image to upload")
+    parser.add_argument("--concurrency", default="1,4,16", help="Concurrency levels")
+    parser.add_argument("--requests", type=int, default=0, help="Requests per level (default 4 x concurrency)")
+    parser.add_argument("--formats", default="json", help="return_format values: json,png,zip")
+    parser.add_argument("--styles", default="living_room", help="styles form field")
+    parser.add_argument("--variants", type=int, default=1, help="variants form field")
+    parser.add_argument("--poll-interval", type=float, default=0.25, help="Seconds between /metrics polls")
+    parser.add_argument("--timeout", type=float, default=600, help="Per-request timeout in seconds")
+    args = parser.parse_args()
+    try:
+        report = asyncio.run(main_async(args))
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -5,6 +5,7 @@ Integrated OpenAI-based mockup generation for Etsy Art & Image Upscaler Pro
 
 import io
 import os
+import sys
 import base64
 import zipfile
 from math import ceil
@@ -14,6 +15,9 @@ import requests
 from fastapi import HTTPException
 from PIL import Image, ImageOps, ImageFile
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server", "scripts"))
+from upstream_limiter import UpstreamLimiter, UpstreamBusy  # noqa: E402
+
 # Allow loading of truncated images
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -21,6 +25,11 @@ ImageFile.LOAD_TRUNCATED_IMAGES = True
 DEFAULT_TARGET_PX = int(os.getenv("TARGET_PX", "2048"))
 DEFAULT_INGEST_LONG_EDGE = int(os.getenv("INGEST_LONG_EDGE", "2048"))
 OPENAI_MODEL = os.getenv("OPENAI_IMAGES_MODEL", "gpt-image-1")
+# Point at a stand-in (benchmarks/images_api_stub.py) for local load tests
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1").rstrip("/")
+# Times a call rate limited upstream is requeued (see server/scripts/upstream_limiter.py for the limits)
+UPSTREAM_429_RETRIES = int(os.getenv("UPSTREAM_429_RETRIES", "2"))
+_upstream = UpstreamLimiter.from_env("openai_images")
 
 STYLE_PROMPTS: Dict[str, str] = {
     "living_room": (
@@ -124,11 +133,12 @@ def _api_edit_size_for(canvas_size: Tuple[int, int]) -> Tuple[int, int, str]:
         return 1024, 1536, "1024x1536"
     return 1536, 1024, "1536x1024"
 
-def _openai_images_edit_multi(image_png: bytes, mask_png: bytes, prompt: str, n: int, size_str: str) -> List[str]:
+def _openai_images_edit_multi(image_png: bytes, mask_png: bytes, prompt: str, n: int, size_str: str,
+                              priority: str = "interactive") -> List[str]:
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise HTTPException(status_code=500, detail="OPENAI_API_KEY not set on server")
-    url = "https://api.openai.com/v1/images/edits"
+    url = f"{OPENAI_BASE_URL}/images/edits"
     headers = {"Authorization": f"Bearer {api_key}"}
     org_id = os.getenv("OPENAI_ORG_ID")
     if org_id:
@@ -139,10 +149,24 @@ def _openai_images_edit_multi(image_png: bytes, mask_png: bytes, prompt: str, n:
         "image": ("canvas.png", image_png, "image/png"),
         "mask":  ("mask.png",   mask_png,  "image/png"),
     }
-    try:
-        resp = requests.post(url, headers=headers, data=data, files=files, timeout=180)
-    except requests.RequestException as e:
-        raise HTTPException(status_code=502, detail=f"Images API request failed: {e}")
+    # Admission control: queue behind the account's rate limits rather than tripping them
+    for _ in range(UPSTREAM_429_RETRIES + 1):
+        try:
+            with _upstream.admit(images=int(data["n"]), priority=priority):
+                resp = requests.post(url, headers=headers, data=data, files=files, timeout=180)
+        except UpstreamBusy as e:
+            raise HTTPException(status_code=429, detail=f"Image generation is busy, retry shortly ({e})",
+                                headers={"Retry-After": str(e.retry_after)})
+        except requests.RequestException as e:
+            raise HTTPException(status_code=502, detail=f"Images API request failed: {e}")
+        if resp.status_code != 429:
+            break
+        # Rate limited anyway (other clients of the key, limits set too high): pause every
+        # caller, then requeue this one
+        _upstream.backoff(_retry_after_seconds(resp))
+    if resp.status_code == 429:
+        raise HTTPException(status_code=429, detail=f"Image API rate limited: {resp.text}",
+                            headers={"Retry-After": str(max(1, round(_retry_after_seconds(resp))))})
     if resp.status_code != 200:
         raise HTTPException(status_code=502, detail=f"Image API error [{resp.status_code}]: {resp.text}")
 
@@ -152,6 +176,12 @@ def _openai_images_edit_multi(image_png: bytes, mask_png: bytes, prompt: str, n:
         raise HTTPException(status_code=502, detail=f"Image API returned no data: {js}")
     return [it.get("b64_json") for it in items if it.get("b64_json")]
 
+def _retry_after_seconds(resp) -> float:
+    try:
+        return float(resp.headers.get("Retry-After", "1"))
+    except ValueError:
+        return 1.0
+
 def generate_single_mockup(img_bytes: bytes, style: str) -> Dict[str, Any]:
     """Generate a single mockup for one style using integrated OpenAI API"""
     try:
@@ -179,7 +209,8 @@ def generate_single_mockup(img_bytes: bytes, style: str) -> Dict[str, Any]:
             _img_to_png_bytes(mask_api),
             prompt=prompt, 
             n=1, 
-            size_str=api_size_str
+            size_str=api_size_str,
+            priority="interactive"
         )
         
         # Process result - resize back to original canvas size
@@ -259,7 +290,8 @@ def generate_local_mockups(img_bytes: bytes, mode: str, template: str) -> Dict[s
                 _img_to_png_bytes(mask_api),
                 prompt=prompt, 
                 n=n_per_style, 
-                size_str=api_size_str
+                size_str=api_size_str,
+                priority="interactive" if mode == "single_template" else "bulk"
             )
             
             # Process results - resize back to original canvas size
@@ -297,5 +329,7 @@ def generate_local_mockups(img_bytes: bytes, mode: str, template: str) -> Dict[s
             "openai_model": OPENAI_MODEL
         }
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(500, f"Mockup generation failed: {str(e)}")
\ No newline at end of file
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Quality vs latency of the int8 quantized segmentation model against fp32
+
+Runs every image through both variants with the sidecar's own inference path
+and reports per-image latency, IoU of the binarised masks (alpha > 127) and mean
+absolute alpha difference.
+
+Usage:
+    REMBG_MODEL=u2net python benchmark_quantized.py <image dir|images...> [--runs 3] [--max-side 1024]
+
+Prints a table to stderr and a JSON summary to stdout.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+import server
+
+
+def _images(sources):
+    paths = []
+    for src in map(Path, sources):
+        if src.is_dir():
+            paths.extend(sorted(p for p in src.iterdir() if p.suffix.lower() in server.IMAGE_EXTS))
+        else:
+            paths.append(src)
+    return paths
+
+
+def _timed_mask(img, size, max_side, model, runs):
+    times = []
+    mask = None
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        mask = server.predict_mask(img, size, max_side, model)
+        times.append((time.perf_counter() - t0) * 1000)
+    return np.asarray(mask), statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare int8 and fp32 background-removal masks")
+    parser.add_argument("images", nargs="+", help="Image files or directories")
+    parser.add_argument("--runs", type=int, default=3, help="Timed runs per image and variant (median reported)")
+    parser.add_argument("--max-side", type=int, default=server.MAX_INFER_SIDE)
+    args = parser.parse_args()
+
+    paths = _images(args.images)
+    if not paths:
+        print(json.dumps({"error": "No images found"}))
+        sys.exit(1)
+
+    fp32, int8 = server.model_for(False), server.model_for(True)
+    t0 = time.perf_counter()
+    server.get_session(fp32)
+    server.get_session(int8)
+    print(f"Sessions ready in {time.perf_counter() - t0:.1f}s ({fp32}, {int8})", file=sys.stderr)
+
+    rows = []
+    for path in paths:
+        img, size = server._open_image(path.read_bytes())
+        server.predict_mask(img, size, args.max_side, fp32)  # warm-up
+        server.predict_mask(img, size, args.max_side, int8)
+        ref, fp32_ms = _timed_mask(img, size, args.max_side, fp32, args.runs)
+        out, int8_ms = _timed_mask(img, size, args.max_side, int8, args.runs)
+        a, b = ref > 127, out > 127
+        union = np.logical_or(a, b).sum()
+        iou = float(np.logical_and(a, b).sum() / union) if union else 1.0
+        mad = float(np.abs(ref.astype(np.int16) - out.astype(np.int16)).mean())
+        rows.append({"image": path.name, "fp32_ms": round(fp32_ms, 1), "int8_ms": round(int8_ms, 1),
+                     "speedup": round(fp32_ms / int8_ms, 2), "iou": round(iou, 4), "mean_abs_diff": round(mad, 2)})
+        print(f"{path.name:32s} fp32 {fp32_ms:8.1f}ms  int8 {int8_ms:8.1f}ms  "
+              f"x{fp32_ms / int8_ms:4.2f}  IoU {iou:.4f}  MAD {mad:.2f}", file=sys.stderr)
+
+    print(json.dumps({
+        "model": server.MODEL_NAME,
+        "max_side": args.max_side,
+        "images": len(rows),
+        "fp32_ms_median": round(statistics.median(r["fp32_ms"] for r in rows), 1),
+        "int8_ms_median": round(statistics.median(r["int8_ms"] for r in rows), 1),
+        "iou_mean": round(statistics.mean(r["iou"] for r in rows), 4),
+        "iou_min": min(r["iou"] for r in rows),
+        "results": rows,
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,685 @@
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import Response, JSONResponse
-from rembg import remove
-from PIL import Image
+import asyncio
+import base64
+import contextvars
+import functools
+import hashlib
 import io
+import json
+import os
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+import onnxruntime as ort
+from fastapi import FastAPI, File, Form, UploadFile
+from fastapi.responses import Response, JSONResponse, PlainTextResponse, StreamingResponse
+from rembg import new_session
+from PIL import Image, ImageChops, ImageOps
+
+# Model and threading are configured per deployment; sessions are created once
+# at startup and shared by every request.
+MODEL_NAME = os.environ.get("REMBG_MODEL", "u2net")
+# Serve the int8 dynamically quantized variant by default (requests can override with quantized=)
+QUANTIZED = os.environ.get("REMBG_QUANTIZED", "").lower() in ("1", "true", "yes")
+# Quantized model file; built from the fp32 model on first use when missing
+INT8_MODEL_PATH = os.environ.get("REMBG_INT8_MODEL_PATH", "")
+INT8_SUFFIX = "-int8"
+# Concurrent inferences (executor threads); requests beyond WORKERS + MAX_QUEUE get 503
+WORKERS = int(os.environ.get("REMBG_WORKERS", "1"))
+MAX_QUEUE = int(os.environ.get("REMBG_MAX_QUEUE", "16"))
+# onnxruntime threads per inference; 0 keeps the onnxruntime/OMP_NUM_THREADS default
+INTRA_OP_THREADS = int(os.environ.get("REMBG_INTRA_OP_THREADS", "0"))
+# Longest side fed to the model; larger inputs are downscaled and the mask upsampled.
+# The segmentation models run at 320-1024px internally, so this costs no mask detail.
+MAX_INFER_SIDE = int(os.environ.get("REMBG_MAX_INFER_SIDE", "1024"))
+# /mask/batch: images per ONNX run and images per request
+BATCH_SIZE = int(os.environ.get("REMBG_BATCH_SIZE", "4"))
+BATCH_MAX_IMAGES = int(os.environ.get("REMBG_BATCH_MAX_IMAGES", "100"))
+# Models sharing U2-Net preprocessing (320x320, ImageNet mean/std) can be run as one batched tensor
+BATCHABLE_MODELS = {"u2net", "u2netp", "u2net_human_seg", "u2net_custom", "silueta"}
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff")
+# Result cache keyed on image hash + model + output mode; empty REMBG_CACHE_DIR keeps it in memory only
+CACHE_MEM_BYTES = int(os.environ.get("REMBG_CACHE_MEM_MB", "128")) * 1024 * 1024
+CACHE_DIR = os.environ.get("REMBG_CACHE_DIR", "/tmp/rembg-cache")
+CACHE_DISK_BYTES = int(os.environ.get("REMBG_CACHE_DISK_MB", "2048")) * 1024 * 1024
+# Uploads are streamed in chunks into a spooled buffer, hashed on the way and refused past these caps (0 = none)
+MAX_UPLOAD_BYTES = int(float(os.environ.get("REMBG_MAX_UPLOAD_MB", "50")) * 1024 * 1024)
+MAX_UPLOAD_PIXELS = int(float(os.environ.get("REMBG_MAX_UPLOAD_MEGAPIXELS", "150")) * 1_000_000)
+# Whole request bodies (a /mask/batch carries many images); refused from Content-Length before parsing
+MAX_REQUEST_BYTES = int(float(os.environ.get("REMBG_MAX_REQUEST_MB", "500")) * 1024 * 1024)
+UPLOAD_CHUNK_BYTES = 1024 * 1024
+UPLOAD_SPOOL_BYTES = 8 * 1024 * 1024
+# Image signatures accepted before the rest of an upload is read
+IMAGE_SIGNATURES = (b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff", b"GIF87a", b"GIF89a", b"BM", b"II*\x00", b"MM\x00*")
+# Stage histogram buckets in seconds; same metric and buckets as server/scripts/perf_metrics.py
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC = "mockup_stage_duration_seconds"
 
 app = FastAPI()
 
+_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix="rembg")
+_sessions = {}
+_sessions_lock = threading.RLock()  # int8 sessions load their fp32 base first
+_state = {"ready": False, "error": None}
+_slots = None
+_mem_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_state = {"mem_bytes": 0, "disk_bytes": None, "hits": 0, "misses": 0}
+_histograms = {}  # stage -> [[bucket counts..., +Inf count], sum]
+_metrics_lock = threading.Lock()
+_timings = contextvars.ContextVar("rembg_timings", default=None)
+
+
+def _observe(stage, seconds):
+    """Record a stage duration in its histogram and the current request's timings"""
+    with _metrics_lock:
+        hist = _histograms.setdefault(stage, [[0] * (len(METRIC_BUCKETS) + 1), 0.0])
+        hist[0][next((i for i, b in enumerate(METRIC_BUCKETS) if seconds <= b), -1)] += 1
+        hist[1] += seconds
+    timings = _timings.get()
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0.0) + seconds * 1000.0, 2)
+
+
+@contextmanager
+def _stage(stage):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        _observe(stage, time.perf_counter() - t0)
+
+
+@app.middleware("http")
+async def _stage_timings(request, call_next):
+    length = request.headers.get("content-length", "")
+    if MAX_REQUEST_BYTES and length.isdigit() and int(length) > MAX_REQUEST_BYTES:
+        # Refused before the form is parsed; per-file caps are checked while streaming
+        return JSONResponse(status_code=413, content={"error": "Request body too large"})
+    timings = {}
+    _timings.set(timings)
+    t0 = time.perf_counter()
+    response = await call_next(request)
+    _observe("request", time.perf_counter() - t0)
+    response.headers["Server-Timing"] = ", ".join(f"{k};dur={v:.1f}" for k, v in timings.items())
+    return response
+
+
+def _session_options():
+    opts = ort.SessionOptions()
+    if INTRA_OP_THREADS > 0:
+        opts.intra_op_num_threads = INTRA_OP_THREADS
+        opts.inter_op_num_threads = 1
+    return opts
+
+
+def model_for(quantized=None):
+    """Model key for a request: MODEL_NAME, or MODEL_NAME + '-int8' for the quantized variant"""
+    if quantized is None:
+        quantized = QUANTIZED
+    return MODEL_NAME + INT8_SUFFIX if quantized else MODEL_NAME
+
+
+def quantize_model(fp32_path, int8_path):
+    """Write an int8 dynamically quantized copy of an ONNX model (weights only, activations stay float)"""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    tmp = f"{int8_path}.part"
+    quantize_dynamic(str(fp32_path), tmp, weight_type=QuantType.QUInt8)
+    os.replace(tmp, int8_path)
+    return int8_path
+
+
+def _quantized_session(base_name):
+    """u2net_custom session over the int8 variant of a U2-Net family model"""
+    if base_name not in BATCHABLE_MODELS:
+        raise ValueError(f"No int8 variant for model '{base_name}'")
+    fp32_path = type(get_session(base_name)).download_models()
+    int8_path = INT8_MODEL_PATH or str(Path(fp32_path).with_suffix(".int8.onnx"))
+    if not os.path.exists(int8_path):
+        quantize_model(fp32_path, int8_path)
+    return new_session("u2net_custom", sess_opts=_session_options(), model_path=int8_path)
+
+
+def get_session(model=MODEL_NAME):
+    """Shared rembg session for a model key, created on first use"""
+    session = _sessions.get(model)
+    if session is not None:
+        return session
+    with _sessions_lock:
+        session = _sessions.get(model)
+        if session is None:
+            if model.endswith(INT8_SUFFIX):
+                session = _quantized_session(model[:-len(INT8_SUFFIX)])
+            else:
+                session = new_session(model, sess_opts=_session_options())
+            _sessions[model] = session
+    return session
+
+
+def _preload():
+    try:
+        get_session(model_for())
+        _state["ready"] = True
+    except Exception as exc:
+        _state["error"] = str(exc)
+
+
+@app.on_event("startup")
+def startup():
+    global _slots
+    _slots = asyncio.Semaphore(WORKERS + MAX_QUEUE)
+    # Load the model in the background so /health answers immediately and /ready flips once it is warm
+    threading.Thread(target=_preload, name="rembg-preload", daemon=True).start()
+
+
+async def run_inference(fn, *args):
+    """Run blocking inference on the bounded executor; None when the queue is full"""
+    if _slots.locked():
+        return None
+    return await _run_in_slot(fn, *args)
+
+
+async def _run_in_slot(fn, *args):
+    async with _slots:
+        # Copy the request context so stage timings recorded on the worker reach the response
+        call = functools.partial(contextvars.copy_context().run, fn, *args)
+        return await asyncio.get_running_loop().run_in_executor(_executor, call)
+
+
+def cache_key(digest, model, mode, max_side):
+    """Cache key for one result: content sha256 plus everything the output depends on"""
+    return f"{digest}-{model}-{mode}-{max_side}"
+
+
+class UploadRejected(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def _is_image(head):
+    return head.startswith(IMAGE_SIGNATURES) or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")
+
+
+class _Spool:
+    """One upload (or archive member) copied chunk by chunk into a spooled buffer
+
+    write() refuses an unknown image signature in the first chunk (415) and stops
+    past MAX_UPLOAD_BYTES (413); finish() refuses image headers over
+    MAX_UPLOAD_PIXELS (413) before any decode and returns (buffer, sha256 hex).
+    """
+
+    def __init__(self, name, image=True):
+        self.name = name
+        self.image = image
+        self.file = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_BYTES)
+        self.digest = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk):
+        if self.image and self.size == 0 and not _is_image(chunk):
+            raise UploadRejected(f"{self.name} is not a supported image", 415)
+        self.size += len(chunk)
+        if MAX_UPLOAD_BYTES and self.size > MAX_UPLOAD_BYTES:
+            raise UploadRejected(f"{self.name} is larger than {MAX_UPLOAD_BYTES / 1024 / 1024:g} MB", 413)
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def finish(self):
+        if self.size == 0:
+            raise UploadRejected(f"{self.name} is empty")
+        if self.image:
+            self.file.seek(0)
+            try:
+                width, height = Image.open(self.file).size  # header only
+            except Exception as exc:
+                raise UploadRejected(f"Could not read image {self.name}: {exc}")
+            if MAX_UPLOAD_PIXELS and width * height > MAX_UPLOAD_PIXELS:
+                raise UploadRejected(f"{self.name} is {width}x{height}; at most "
+                                     f"{MAX_UPLOAD_PIXELS / 1e6:g} megapixels are accepted", 413)
+        self.file.seek(0)
+        return self.file, self.digest.hexdigest()
+
+
+async def read_upload(upload, image=True):
+    """Stream an upload into a spooled buffer; returns (buffer, sha256 hex) or raises UploadRejected"""
+    spool = _Spool(upload.filename or "upload", image)
+    try:
+        while chunk := await upload.read(UPLOAD_CHUNK_BYTES):
+            spool.write(chunk)
+        return spool.finish()
+    except BaseException:
+        spool.file.close()
+        raise
+
+
+def _cache_path(key):
+    return Path(CACHE_DIR) / key[:2] / f"{key}.png"
+
+
+def _disk_usage():
+    if _cache_state["disk_bytes"] is None:
+        _cache_state["disk_bytes"] = sum(p.stat().st_size for p in Path(CACHE_DIR).glob("*/*.png"))
+    return _cache_state["disk_bytes"]
+
+
+def _evict_disk():
+    """Drop least recently used files until the disk cache is 10% under its cap"""
+    files = sorted(Path(CACHE_DIR).glob("*/*.png"), key=lambda p: p.stat().st_mtime)
+    target = CACHE_DISK_BYTES * 0.9
+    for path in files:
+        if _cache_state["disk_bytes"] <= target:
+            break
+        try:
+            size = path.stat().st_size
+            path.unlink()
+            _cache_state["disk_bytes"] -= size
+        except FileNotFoundError:
+            pass
+
+
+def _remember(key, data):
+    """Insert into the in-memory LRU (caller holds the lock)"""
+    if len(data) > CACHE_MEM_BYTES:
+        return
+    old = _mem_cache.pop(key, None)
+    if old is not None:
+        _cache_state["mem_bytes"] -= len(old)
+    _mem_cache[key] = data
+    _cache_state["mem_bytes"] += len(data)
+    while _cache_state["mem_bytes"] > CACHE_MEM_BYTES:
+        _, evicted = _mem_cache.popitem(last=False)
+        _cache_state["mem_bytes"] -= len(evicted)
+
+
+def cache_get(key):
+    """(data, 'HIT-MEMORY' | 'HIT-DISK') or (None, 'MISS')"""
+    with _cache_lock:
+        data = _mem_cache.get(key)
+        if data is not None:
+            _mem_cache.move_to_end(key)
+            _cache_state["hits"] += 1
+            return data, "HIT-MEMORY"
+    if CACHE_DIR:
+        path = _cache_path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)  # mtime is the disk LRU clock
+        except OSError:
+            data = None
+        if data is not None:
+            with _cache_lock:
+                _remember(key, data)
+                _cache_state["hits"] += 1
+            return data, "HIT-DISK"
+    with _cache_lock:
+        _cache_state["misses"] += 1
+    return None, "MISS"
+
+
+def cache_put(key, data):
+    with _cache_lock:
+        _remember(key, data)
+    if not CACHE_DIR:
+        return
+    path = _cache_path(key)
+    try:
+        with _cache_lock:
+            _disk_usage()
+        old = path.stat().st_size if path.exists() else 0
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{threading.get_ident()}.part")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        with _cache_lock:
+            _cache_state["disk_bytes"] += len(data) - old
+            if _cache_state["disk_bytes"] > CACHE_DISK_BYTES:
+                _evict_disk()
+    except OSError:
+        pass  # a full or read-only cache dir must not fail the request
+
+
+async def cached_inference(fn, raw, digest, mode, max_side, model):
+    """(png, cache status) from the cache or a fresh inference; (None, None) when the queue is full"""
+    key = cache_key(digest, model, mode, max_side)
+    with _stage("cache"):
+        data, status = cache_get(key)
+    if data is not None:
+        return data, status
+    data = await run_inference(fn, raw, max_side, model)
+    if data is None:
+        return None, None
+    await asyncio.get_running_loop().run_in_executor(None, cache_put, key, data)
+    return data, status
+
+
+def _busy():
+    return JSONResponse(status_code=503, content={"error": "Background removal queue is full"},
+                        headers={"Retry-After": "1"})
+
 
 @app.get("/health")
 def health():
     return {"ok": True}
 
 
+@app.get("/cache")
+def cache_stats():
+    with _cache_lock:
+        return {"entries": len(_mem_cache), "memory_bytes": _cache_state["mem_bytes"],
+                "disk_bytes": _cache_state["disk_bytes"], "hits": _cache_state["hits"],
+                "misses": _cache_state["misses"]}
+
+
+@app.get("/ready")
+def ready():
+    if _state["ready"]:
+        return {"ready": True, "model": model_for()}
+    return JSONResponse(status_code=503, content={"ready": False, "model": model_for(), "error": _state["error"]})
+
+
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """Stage histograms in the Prometheus text format (service="rembg")"""
+    lines = [f"# HELP {METRIC} Time spent per processing stage", f"# TYPE {METRIC} histogram"]
+    with _metrics_lock:
+        items = sorted((k, list(v[0]), v[1]) for k, v in _histograms.items())
+    for stage, counts, total in items:
+        labels = f'service="rembg",stage="{stage}"'
+        cumulative = 0
+        for bound, count in zip(METRIC_BUCKETS, counts):
+            cumulative += count
+            lines.append(f'{METRIC}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{METRIC}_bucket{{{labels},le="+Inf"}} {cumulative}')
+        lines.append(f"{METRIC}_sum{{{labels}}} {total:.6f}")
+        lines.append(f"{METRIC}_count{{{labels}}} {cumulative}")
+    return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
+def _max_side(value):
+    return MAX_INFER_SIDE if value is None or value < 0 else value
+
+
+def _open_image(raw, draft_side=0):
+    """Decode bytes or a file upright; with draft_side, JPEGs decode at reduced scale. Returns (img, full_size)"""
+    with _stage("decode"):
+        if hasattr(raw, "read"):
+            raw.seek(0)
+        img = Image.open(raw if hasattr(raw, "read") else io.BytesIO(raw))
+        size = img.size
+        if img.getexif().get(0x0112, 1) in (5, 6, 7, 8):
+            size = size[::-1]
+        if draft_side:
+            img.draft("RGB", (draft_side, draft_side))
+        return ImageOps.exif_transpose(img), size
+
+
+def _inference_image(img, max_side):
+    infer = img.convert("RGB")
+    if max_side and max(infer.size) > max_side:
+        infer.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+    return infer
+
+
+def _merge_masks(masks, size):
+    mask = masks[0]
+    for extra in masks[1:]:
+        mask = ImageChops.lighter(mask, extra)
+    if mask.size != size:
+        mask = mask.resize(size, Image.Resampling.BILINEAR)
+    return mask
+
+
+def predict_mask(img, size, max_side, model=MODEL_NAME):
+    """Model mask ('L') for img, inferred at most max_side px and resized to size"""
+    with _stage("inference"):
+        return _merge_masks(get_session(model).predict(_inference_image(img, max_side)), size)
+
+
+def _predict_u2net_batch(session, infers):
+    """U2-Net family masks for several images in one inner_session.run (same output as predict)"""
+    tensors = [session.normalize(im, (0.485, 0.456, 0.406), (0.229, 0.224, 0.225), (320, 320)) for im in infers]
+    name = next(iter(tensors[0]))
+    batch = np.concatenate([t[name] for t in tensors], axis=0)
+    preds = session.inner_session.run(None, {name: batch})[0][:, 0, :, :]
+    masks = []
+    for pred, im in zip(preds, infers):
+        ma, mi = np.max(pred), np.min(pred)
+        pred = (pred - mi) / (ma - mi)
+        mask = Image.fromarray((pred.clip(0, 1) * 255).astype("uint8"), mode="L")
+        masks.append([mask.resize(im.size, Image.Resampling.LANCZOS)])
+    return masks
+
+
+def _batch_input_fixed(session):
+    dim = session.inner_session.get_inputs()[0].shape[0]
+    return isinstance(dim, int) and dim == 1
+
+
+def predict_masks(items, max_side, model=MODEL_NAME):
+    """Masks for [(img, size)]; one batched run for U2-Net models, per image otherwise"""
+    with _stage("inference"):
+        return _predict_masks(items, max_side, model)
+
+
+def _predict_masks(items, max_side, model):
+    session = get_session(model)
+    infers = [_inference_image(img, max_side) for img, _ in items]
+    results = None
+    if len(infers) > 1 and session.model_name in BATCHABLE_MODELS and not _batch_input_fixed(session):
+        try:
+            results = _predict_u2net_batch(session, infers)
+        except Exception:
+            results = None  # model rejected the batched tensor; fall back to per-image runs
+    if results is None:
+        results = [session.predict(im) for im in infers]
+    return [_merge_masks(masks, size) for masks, (_, size) in zip(results, items)]
+
+
+def _png(img):
+    with _stage("encode"):
+        buf = io.BytesIO()
+        img.save(buf, format="PNG")
+        return buf.getvalue()
+
+
+def _cutout(raw, max_side, model):
+    img, size = _open_image(raw)
+    mask = predict_mask(img, size, max_side, model)
+    # Same result as rembg's naive cutout, encoded once
+    cutout = Image.composite(img.convert("RGBA"), Image.new("RGBA", size, 0), mask)
+    return _png(cutout)
+
+
+def _alpha(raw, max_side, model):
+    img, size = _open_image(raw, max_side)
+    return _png(predict_mask(img, size, max_side, model))
+
+
+def _mask_line(index, name, png, cache):
+    width, height = struct.unpack(">II", png[16:24])  # PNG IHDR
+    return json.dumps({"index": index, "name": name, "width": width, "height": height, "cache": cache,
+                       "mask": base64.b64encode(png).decode("ascii")}) + "\n"
+
+
+def _mask_batch(entries, max_side, model):
+    """Decode one batch, run it through the model and cache the masks
+
+    Returns the batch's NDJSON lines in input order.
+    """
+    decoded, results = [], {}
+    for index, name, key, raw in entries:
+        try:
+            decoded.append((index, name, key) + _open_image(raw, max_side))
+        except Exception as exc:
+            results[index] = {"index": index, "name": name, "error": f"Could not read image: {exc}"}
+    if decoded:
+        try:
+            masks = predict_masks([(img, size) for _, _, _, img, size in decoded], max_side, model)
+            for (index, name, key, _, _), m in zip(decoded, masks):
+                png = _png(m)
+                cache_put(key, png)
+                results[index] = _mask_line(index, name, png, "MISS")
+        except Exception as exc:
+            for index, name, _, _, _ in decoded:
+                results[index] = {"index": index, "name": name, "error": str(exc)}
+    return [r if isinstance(r, str) else json.dumps(r) + "\n" for _, r in sorted(results.items())]
+
+
+def _close_spools(files):
+    for _, spool, _ in files:
+        spool.close()
+
+
+def _zip_entries(fp):
+    """(name, spooled buffer, sha256) of the images in a ZIP file
+
+    Members go through the same checks as uploaded images. Declared sizes are
+    checked before anything is inflated: a member over MAX_UPLOAD_BYTES or an
+    archive expanding past MAX_REQUEST_BYTES in total gets 413.
+    """
+    with zipfile.ZipFile(fp) as zf:
+        infos = sorted((i for i in zf.infolist()
+                        if not i.is_dir() and i.filename.lower().endswith(IMAGE_EXTS) and "__MACOSX" not in i.filename),
+                       key=lambda i: i.filename)
+        if len(infos) > BATCH_MAX_IMAGES:
+            raise UploadRejected(f"At most {BATCH_MAX_IMAGES} images per batch", 413)
+        total = 0
+        for info in infos:
+            if MAX_UPLOAD_BYTES and info.file_size > MAX_UPLOAD_BYTES:
+                raise UploadRejected(f"{info.filename} is larger than {MAX_UPLOAD_BYTES / 1024 / 1024:g} MB", 413)
+            total += info.file_size
+            if MAX_REQUEST_BYTES and total > MAX_REQUEST_BYTES:
+                raise UploadRejected(f"Archive expands to more than {MAX_REQUEST_BYTES / 1024 / 1024:g} MB", 413)
+        entries = []
+        try:
+            for info in infos:
+                spool = _Spool(info.filename)
+                try:
+                    with zf.open(info) as member:
+                        while chunk := member.read(UPLOAD_CHUNK_BYTES):
+                            spool.write(chunk)
+                    entries.append((info.filename,) + spool.finish())
+                except BaseException:
+                    spool.file.close()
+                    raise
+        except BaseException:
+            for _, member_spool, _ in entries:
+                member_spool.close()
+            raise
+        return entries
+
+
+@app.post("/mask/batch")
+async def mask_batch(
+    images: Optional[List[UploadFile]] = File(None),
+    archive: Optional[UploadFile] = File(None),
+    batch_size: int = Form(0),
+    max_side: int = Form(-1),
+    quantized: Optional[bool] = Form(None),
+):
+    """Alpha masks for several images (multipart 'images' or a ZIP 'archive')
+
+    Streams NDJSON, one line per image as its batch completes:
+    {"index", "name", "width", "height", "mask": base64 PNG} or {"index", "name", "error"}
+    """
+    files = []
+    try:
+        for upload in images or []:
+            files.append((upload.filename or f"image_{len(files)}",) + await read_upload(upload))
+        if archive is not None:
+            spool, _ = await read_upload(archive, image=False)
+            with spool:
+                files.extend(_zip_entries(spool))
+    except zipfile.BadZipFile:
+        _close_spools(files)
+        return JSONResponse(status_code=400, content={"error": "archive is not a valid ZIP file"})
+    except UploadRejected as exc:
+        _close_spools(files)
+        return JSONResponse(status_code=exc.status_code, content={"error": str(exc)})
+    except BaseException:
+        _close_spools(files)
+        raise
+    if not files:
+        return JSONResponse(status_code=400, content={"error": "No images provided"})
+    if len(files) > BATCH_MAX_IMAGES:
+        _close_spools(files)
+        return JSONResponse(status_code=413, content={"error": f"At most {BATCH_MAX_IMAGES} images per batch"})
+    if _slots.locked():
+        _close_spools(files)
+        return _busy()
+
+    size = max(1, batch_size or BATCH_SIZE)
+    ms = _max_side(max_side)
+    model = model_for(quantized)
+    # Same key as /alpha: batched masks are identical to single-image ones
+    hits, entries = [], []
+    for i, (name, raw, digest) in enumerate(files):
+        key = cache_key(digest, model, "alpha", ms)
+        data, status = cache_get(key)
+        if data is not None:
+            hits.append(_mask_line(i, name, data, status))
+            raw.close()
+        else:
+            entries.append((i, name, key, raw))
+    del files
+
+    async def stream():
+        try:
+            for line in hits:
+                yield line
+            for start in range(0, len(entries), size):
+                for line in await _run_in_slot(_mask_batch, entries[start:start + size], ms, model):
+                    yield line
+        finally:
+            for *_, raw in entries:
+                raw.close()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
 @app.post("/mask")
-async def mask(image: UploadFile = File(...)):
+async def mask(image: UploadFile = File(...), max_side: int = Form(-1), quantized: Optional[bool] = Form(None)):
+    """RGBA cutout; max_side caps the inference resolution (-1 = REMBG_MAX_INFER_SIDE, 0 = full),
+    quantized picks the int8 model (unset = REMBG_QUANTIZED)"""
     try:
-        raw = await image.read()
-        out = remove(raw)
-        return Response(content=out, media_type="image/png")
+        spool, digest = await read_upload(image)
+    except UploadRejected as exc:
+        return JSONResponse(status_code=exc.status_code, content={"error": str(exc)})
+    try:
+        with spool:
+            out, cache = await cached_inference(_cutout, spool, digest, "cutout", _max_side(max_side),
+                                                model_for(quantized))
+        if out is None:
+            return _busy()
+        return Response(content=out, media_type="image/png", headers={"X-Cache": cache})
     except Exception as exc:
         return JSONResponse(status_code=500, content={"error": str(exc)})
 
 
 @app.post("/alpha")
-async def alpha(image: UploadFile = File(...)):
+async def alpha(image: UploadFile = File(...), max_side: int = Form(-1), quantized: Optional[bool] = Form(None)):
+    """Alpha mask only ('L' PNG at the input size), no cutout encode/decode round trip"""
     try:
-        raw = await image.read()
-        out = remove(raw)
-        img = Image.open(io.BytesIO(out)).convert("RGBA")
-        alpha = img.split()[-1]
-        buf = io.BytesIO()
-        alpha.save(buf, format="PNG")
-        return Response(content=buf.getvalue(), media_type="image/png")
+        spool, digest = await read_upload(image)
+    except UploadRejected as exc:
+        return JSONResponse(status_code=exc.status_code, content={"error": str(exc)})
+    try:
+        with spool:
+            out, cache = await cached_inference(_alpha, spool, digest, "alpha", _max_side(max_side),
+                                                model_for(quantized))
+        if out is None:
+            return _busy()
+        return Response(content=out, media_type="image/png", headers={"X-Cache": cache})
     except Exception as exc:
         return JSONResponse(status_code=500, content={"error": str(exc)})
@@ -220,13 +220,20 @@ async function startFastApiServer() {
     env.PORT = '8001';
     env.MOCK_MODE = 'false'; // Enable real RunPod with fixed workflow
     
-    fastApiProcess = spawn('uvicorn', [
-      'app:app',
-      '--host', '0.0.0.0', 
-      '--port', '8001',
-      '--workers', '1',
-      '--no-access-log'
-    ], {
+    // FASTAPI_WORKERS > 1 uses the prefork runner: caches are warmed once and shared copy-on-write
+    const fastApiWorkers = parseInt(process.env.FASTAPI_WORKERS || '1', 10);
+    env.FASTAPI_PORT = '8001';
+    const [fastApiCommand, fastApiArgs]: [string, string[]] = fastApiWorkers > 1
+      ? ['python3', ['start_fastapi.py', '--app', 'app:app', '--workers', String(fastApiWorkers)]]
+      : ['uvicorn', [
+          'app:app',
+          '--host', '0.0.0.0', 
+          '--port', '8001',
+          '--workers', '1',
+          '--no-access-log'
+        ]];
+
+    fastApiProcess = spawn(fastApiCommand, fastApiArgs, {
       env,
       stdio: ['ignore', 'pipe', 'pipe'],
       detached: false
@@ -302,11 +309,6 @@ process.on('exit', cleanup);
     console.error('Database initialization failed:', err);
   });
 
-  // Start FastAPI server in the background (non-blocking)
-  startFastApiServer().catch(err => {
-    console.error('FastAPI server startup failed:', err);
-  });
-
   // Add www redirect middleware (canonical headers managed in HTML only)
   app.use((req, res, next) => {
     const host = req.get('host');
@@ -394,5 +396,11 @@ process.on('exit', cleanup);
     log(`serving on port ${port}`);
     console.log(`🚀 Application ready on port ${port}`);
     console.log(`📋 Health check available at http://localhost:${port}/health`);
+
+    // Start FastAPI only once our own port is bound, so its Python imports don't
+    // compete with Node's boot for CPU on small hosts (non-blocking)
+    startFastApiServer().catch(err => {
+      console.error('FastAPI server startup failed:', err);
+    });
   });
 })();
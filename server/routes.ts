@@ -29,6 +29,7 @@ import { createPinterestService } from "./services/pinterest-service";
 import { createPinterestImageGenerator } from "./services/pinterest-image-generator";
 import psdMockupRoutes from "./routes/psd-mockup.routes";
 import { spawn, spawnSync } from "child_process";
+import { createHash } from "crypto";
 import { db } from "./db";
 import { eq, desc, sql } from "drizzle-orm";
 import sgMail from "@sendgrid/mail";
@@ -236,6 +237,66 @@ function collectProjectStoragePaths(project: Project): string[] {
   return Array.from(paths);
 }
 
+// Identical jobs in flight (same artwork bytes and options) share one Python run:
+// double clicks and client/proxy retries attach to the first request's result.
+// Each caller may pass its own abort signal (client went away); the job's signal
+// fires once every caller has aborted, so abandoned work is stopped.
+// The job runs under its first caller's deadline (deadlineAt, epoch ms): a caller
+// that may wait more than DEADLINE_JOIN_SLACK_MS longer starts a fresh job instead
+// of inheriting the shorter one, and later callers join that fresh job.
+const DEADLINE_JOIN_SLACK_MS = 1000;
+const inflightJobs = new Map<string, {
+  promise: Promise<any>;
+  callers: number;
+  controller: AbortController;
+  deadlineAt: number;
+}>();
+
+function singleFlight<T>(
+  key: string,
+  job: (signal: AbortSignal) => Promise<T>,
+  callerSignal?: AbortSignal,
+  deadlineAt: number = Infinity
+): Promise<T> {
+  let entry = inflightJobs.get(key);
+  if (entry && entry.deadlineAt + DEADLINE_JOIN_SLACK_MS < deadlineAt) {
+    console.log(`⏱️ Not joining in-flight job ${key.slice(0, 12)}: its deadline ends before this caller's`);
+    entry = undefined;
+  }
+  if (entry) {
+    console.log(`🔁 Joining in-flight job ${key.slice(0, 12)}`);
+  } else {
+    const controller = new AbortController();
+    const created = { promise: undefined as unknown as Promise<any>, callers: 0, controller, deadlineAt };
+    created.promise = job(controller.signal).finally(() => {
+      // A longer-deadline job may have taken the key meanwhile
+      if (inflightJobs.get(key) === created) inflightJobs.delete(key);
+    });
+    inflightJobs.set(key, created);
+    entry = created;
+  }
+  const current = entry;
+  current.callers++;
+  if (!callerSignal) {
+    return current.promise;
+  }
+  return new Promise<T>((resolve, reject) => {
+    const onAbort = () => {
+      current.callers--;
+      if (current.callers === 0) {
+        current.controller.abort();
+      }
+      reject(new Error('Client disconnected'));
+    };
+    if (callerSignal.aborted) {
+      onAbort();
+      return;
+    }
+    callerSignal.addEventListener('abort', onAbort, { once: true });
+    current.promise.then(resolve, reject).finally(() => callerSignal.removeEventListener('abort', onAbort));
+  });
+}
+
 function resolvePythonExecutable(): { command: string; args: string[] } {
   // In production (Render), always use system Python
   if (process.env.NODE_ENV === 'production') {
@@ -3174,104 +3235,41 @@ export async function registerRoutes(app: Express): Promise<Server> {
       const bgPath = path.join(templatePath, bgFilename);
       fs.writeFileSync(bgPath, bgFile.buffer);
       
-      // Load and process mask to detect corners using Python script
+      // Uploaded mask is stored as mask.png by the ingest step
       const maskPath = path.join(templatePath, 'temp_mask.png');
       fs.writeFileSync(maskPath, maskFile.buffer);
       
-      // Use Python to detect corners from the mask
-      const pythonScript = `
-import sys
-import json
-import cv2
-import numpy as np
-from PIL import Image
-
-def detect_corners_from_mask(mask_path, bg_width, bg_height):
-    """Detect the 4 corners of the white region in the mask"""
-    try:
-        # Load mask
-        mask = cv2.imread(mask_path, cv2.IMREAD_GRAYSCALE)
-        if mask is None:
-            return None, "Failed to load mask image"
-        
-        # Resize mask to match background dimensions
-        mask = cv2.resize(mask, (bg_width, bg_height), interpolation=cv2.INTER_NEAREST)
-        
-        # Threshold to get binary mask
-        _, binary = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
-        
-        # Find contours
-        contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        if not contours:
-            return None, "No contours found in mask"
-        
-        # Get the largest contour
-        largest_contour = max(contours, key=cv2.contourArea)
-        
-        # Approximate the contour to a polygon
-        epsilon = 0.02 * cv2.arcLength(largest_contour, True)
-        approx = cv2.approxPolyDP(largest_contour, epsilon, True)
-        
-        # If we don't have exactly 4 points, use bounding rectangle
-        if len(approx) != 4:
-            x, y, w, h = cv2.boundingRect(largest_contour)
-            corners = [
-                [x, y],           # Top-left
-                [x + w, y],       # Top-right
-                [x + w, y + h],   # Bottom-right
-                [x, y + h]        # Bottom-left
-            ]
-        else:
-            # Sort corners: TL, TR, BR, BL
-            pts = approx.reshape(4, 2)
-            # Sort by y-coordinate
-            sorted_by_y = pts[np.argsort(pts[:, 1])]
-            # Top two points
-            top_pts = sorted_by_y[:2]
-            # Sort top points by x
-            top_sorted = top_pts[np.argsort(top_pts[:, 0])]
-            tl, tr = top_sorted
-            # Bottom two points
-            bottom_pts = sorted_by_y[2:]
-            # Sort bottom points by x
-            bottom_sorted = bottom_pts[np.argsort(bottom_pts[:, 0])]
-            bl, br = bottom_sorted
-            corners = [tl.tolist(), tr.tolist(), br.tolist(), bl.tolist()]
-        
-        return corners, None
-    except Exception as e:
-        return None, str(e)
-
-if __name__ == "__main__":
-    mask_path = sys.argv[1]
-    bg_width = int(sys.argv[2])
-    bg_height = int(sys.argv[3])
-    
-    corners, error = detect_corners_from_mask(mask_path, bg_width, bg_height)
-    
-    if error:
-        print(json.dumps({"error": error}))
-        sys.exit(1)
-    else:
-        print(json.dumps({"corners": corners}))
-        sys.exit(0)
-`;
-      
-      // Write Python script to temp file
-      const scriptPath = path.join(templatePath, 'detect_corners.py');
-      fs.writeFileSync(scriptPath, pythonScript);
-      
       // Get background dimensions
       const sharp = (await import('sharp')).default;
       const bgMetadata = await sharp(bgFile.buffer).metadata();
       const bgWidth = bgMetadata.width || 1024;
       const bgHeight = bgMetadata.height || 1024;
       
-      // Run Python script to detect corners
+      const manifestFields = {
+        name: name?.trim() || `${room.replace(/_/g, ' ')} ${finalTemplateId}`,
+        description: description?.trim() || '',
+        tags: tags?.trim().split(',').map((t: string) => t.trim()).filter(Boolean) || [],
+        background: bgFilename,
+        blend: {
+          mode: blendMode || 'normal',
+          opacity: parseFloat(blendOpacity || '1.0')
+        },
+        feather_px: parseFloat(featherPx || '1'),
+        pad_inset_px: parseInt(padInsetPx || '0', 10)
+      };
+      
+      // Detect corners and precompile the template (raw background, preview tier, ROI geometry)
+      // so the first mockup request is served hot
+      const ingestScript = process.env.NODE_ENV === 'production'
+        ? path.join(process.cwd(), 'dist', 'server', 'scripts', 'template_ingest.py')
+        : path.join(process.cwd(), 'server', 'scripts', 'template_ingest.py');
       const pythonExec = resolvePythonExecutable();
-      const cornerDetection = await new Promise<{ corners?: number[][], error?: string }>((resolve) => {
-        const python = spawn(pythonExec.command, [...pythonExec.args, scriptPath, maskPath, bgWidth.toString(), bgHeight.toString()]);
+      const ingest = await new Promise<{ manifest?: any, corners_detected?: boolean, warning?: string, error?: string }>((resolve) => {
+        const python = spawn(pythonExec.command, [
+          ...pythonExec.args, ingestScript, templatePath,
+          '--mask', maskPath,
+          '--manifest', JSON.stringify(manifestFields)
+        ]);
         
         let output = '';
         let errorOutput = '';
@@ -3284,61 +3282,52 @@ if __name__ == "__main__":
           errorOutput += data.toString();
         });
         
+        python.on('error', (err) => {
+          resolve({ error: err.message });
+        });
+        
         python.on('close', (code) => {
-          if (code !== 0) {
-            console.error('Python corner detection failed:', errorOutput);
-            resolve({ error: errorOutput || 'Corner detection failed' });
-          } else {
-            try {
-              const result = JSON.parse(output.trim());
-              resolve(result);
-            } catch (e) {
-              resolve({ error: 'Failed to parse corner detection output' });
+          try {
+            const result = JSON.parse(output.trim());
+            if (code !== 0 && !result.error) {
+              result.error = errorOutput || 'Template ingest failed';
             }
+            resolve(result);
+          } catch (e) {
+            console.error('Template ingest failed:', errorOutput);
+            resolve({ error: errorOutput || 'Failed to parse template ingest output' });
           }
         });
       });
       
-      // Clean up temp files
+      // Clean up temp mask
       try {
         fs.unlinkSync(maskPath);
-        fs.unlinkSync(scriptPath);
       } catch (e) {
         // Ignore cleanup errors
       }
       
-      if (cornerDetection.error || !cornerDetection.corners) {
-        // Fallback to default corners if detection fails
-        console.warn('Corner detection failed, using default corners:', cornerDetection.error);
-        cornerDetection.corners = [
-          [Math.round(bgWidth * 0.2), Math.round(bgHeight * 0.2)],
-          [Math.round(bgWidth * 0.8), Math.round(bgHeight * 0.2)],
-          [Math.round(bgWidth * 0.8), Math.round(bgHeight * 0.8)],
-          [Math.round(bgWidth * 0.2), Math.round(bgHeight * 0.8)]
-        ];
+      let manifest = ingest.manifest;
+      if (ingest.error || !manifest) {
+        // Fallback to default corners if ingest fails; the template compiles lazily on first use
+        console.warn('Template ingest failed, using default corners:', ingest.error);
+        manifest = {
+          ...manifestFields,
+          width: bgWidth,
+          height: bgHeight,
+          corners: [
+            [Math.round(bgWidth * 0.2), Math.round(bgHeight * 0.2)],
+            [Math.round(bgWidth * 0.8), Math.round(bgHeight * 0.2)],
+            [Math.round(bgWidth * 0.8), Math.round(bgHeight * 0.8)],
+            [Math.round(bgWidth * 0.2), Math.round(bgHeight * 0.8)]
+          ]
+        };
+        const manifestPath = path.join(templatePath, 'manifest.json');
+        fs.writeFileSync(manifestPath, JSON.stringify(manifest, null, 2));
+      } else if (!ingest.corners_detected) {
+        console.warn('Corner detection failed, using default corners:', ingest.warning);
       }
       
-      // Create manifest
-      const manifest = {
-        name: name?.trim() || `${room.replace(/_/g, ' ')} ${finalTemplateId}`,
-        description: description?.trim() || '',
-        tags: tags?.trim().split(',').map((t: string) => t.trim()).filter(Boolean) || [],
-        width: bgWidth,
-        height: bgHeight,
-        background: bgFilename,
-        corners: cornerDetection.corners,
-        blend: {
-          mode: blendMode || 'normal',
-          opacity: parseFloat(blendOpacity || '1.0')
-        },
-        feather_px: parseFloat(featherPx || '1'),
-        pad_inset_px: parseInt(padInsetPx || '0', 10)
-      };
-      
-      // Save manifest
-      const manifestPath = path.join(templatePath, 'manifest.json');
-      fs.writeFileSync(manifestPath, JSON.stringify(manifest, null, 2));
-      
       console.log(`✅ Created new template: ${room}/${finalTemplateId}`);
       
       res.json({
@@ -3483,6 +3472,14 @@ if __name__ == "__main__":
 
   // Apply artwork to selected templates
   app.post("/api/apply-templates", authenticateToken, upload.single("file"), async (req: AuthenticatedRequest, res) => {
+    // Tab closed or request aborted: stop rendering mockups nobody will receive
+    const clientGone = new AbortController();
+    res.on('close', () => {
+      if (!res.writableEnded) clientGone.abort();
+    });
+    // Optional time budget (ms) from the client; remaining templates are skipped once it passes
+    const deadlineMs = Number(req.headers['x-deadline-ms']) || 0;
+    const deadlineAt = deadlineMs > 0 ? Date.now() + deadlineMs : Infinity;
     try {
       const userId = req.userId!;
       
@@ -3569,7 +3566,13 @@ if __name__ == "__main__":
       // Template limit is now checked above based on user plan
 
       const templateApiPort = process.env.TEMPLATE_API_PORT || 8003;
-      const mockups: Array<{ template: { room: string; id: string; name: string }; image_data: string }> = [];
+      const mockups: Array<{
+        template: { room: string; id: string; name: string };
+        image_data: string;
+        exports?: Array<{ name: string; format: string; width: number; height: number; image_data: string }>;
+      }> = [];
+      // Listing/preview/thumbnail sizes cut from each composed frame: a preset name ("etsy") or a JSON list
+      const exportsSpec = typeof req.body.exports === 'string' && req.body.exports.trim() ? req.body.exports.trim() : null;
 
       // Process PSD templates first (if any)
       if (psdTemplates.length > 0) {
@@ -3578,6 +3581,10 @@ if __name__ == "__main__":
         const { agPsdMockupService } = await import('./services/agpsd-mockup-service.js');
         
         for (let i = 0; i < psdTemplates.length; i++) {
+          if (clientGone.signal.aborted) {
+            console.log(`🛑 Client disconnected, skipping ${psdTemplates.length - i} PSD templates`);
+            break;
+          }
           const template = psdTemplates[i];
           console.log(`\n📄 Processing PSD template ${i + 1}/${psdTemplates.length}: ${template.id}`);
           
@@ -3666,14 +3673,18 @@ if __name__ == "__main__":
       }
 
       // Only process perspective templates if there are any
-      if (perspectiveTemplates.length > 0) {
-        // Create temporary file for artwork (only once!)
-        const tempArtworkPath = path.join(process.cwd(), `temp_artwork_${Date.now()}.jpg`);
-        fs.writeFileSync(tempArtworkPath, req.file.buffer);
+      if (perspectiveTemplates.length > 0 && !clientGone.signal.aborted) {
+        // Artwork is streamed to Python over stdin: no temp file, no name collisions
+        const artworkBuffer = req.file.buffer;
 
         try {
+          const removeBackground = req.body.remove_background === 'true';
+          const batchKey = createHash('sha256')
+            .update(artworkBuffer)
+            .update(JSON.stringify({ templates: perspectiveTemplates, removeBackground, exportsSpec }))
+            .digest('hex');
           // Use batch Python script to process all templates at once (memory optimized!)
-          const batchResult = await new Promise<any>((resolve, reject) => {
+          const batchResult = await singleFlight(batchKey, (signal) => new Promise<any>((resolve, reject) => {
             const pythonExec = resolvePythonExecutable();
             // In production, script is in dist/server/scripts, in dev it's in server/scripts
             const scriptPath = process.env.NODE_ENV === 'production'
@@ -3689,14 +3700,28 @@ if __name__ == "__main__":
             const python = spawn(pythonExec.command, [
               ...pythonExec.args,
               scriptPath,
-              tempArtworkPath,
-              JSON.stringify(perspectiveTemplates)
+              '-',
+              JSON.stringify(perspectiveTemplates),
+              // Segment the artwork once in the compositor instead of a sidecar round trip
+              ...(removeBackground ? ['--remove-background'] : []),
+              ...(deadlineMs > 0 ? ['--deadline', String(deadlineMs / 1000)] : []),
+              ...(exportsSpec ? ['--exports', exportsSpec] : [])
             ], { env });
 
+          // Every waiting client is gone: SIGTERM makes the script skip the templates left
+          signal.addEventListener('abort', () => {
+            console.log(`🛑 Stopping batch ${batchKey.slice(0, 12)}: no client waiting`);
+            python.kill('SIGTERM');
+          }, { once: true });
+
           python.on('error', (spawnError) => {
             reject(new Error(`Failed to start Python process: ${spawnError instanceof Error ? spawnError.message : String(spawnError)}`));
           });
 
+          // EPIPE here means Python exited early; the close handler reports why
+          python.stdin.on('error', () => {});
+          python.stdin.end(artworkBuffer);
+
           let output = '';
           let error = '';
 
@@ -3724,7 +3749,7 @@ if __name__ == "__main__":
               reject(new Error(`Failed to parse batch output: ${output}`));
             }
           });
-        });
+        }), clientGone.signal, deadlineAt);
 
         // Process successful results
         if (batchResult?.mockups && Array.isArray(batchResult.mockups)) {
@@ -3732,7 +3757,16 @@ if __name__ == "__main__":
             if (result.success && result.image_data) {
               mockups.push({
                 template: result.template,
-                image_data: `data:image/png;base64,${result.image_data}`
+                image_data: `data:image/png;base64,${result.image_data}`,
+                ...(Array.isArray(result.exports) ? {
+                  exports: result.exports.map((e: any) => ({
+                    name: e.name,
+                    format: e.format,
+                    width: e.width,
+                    height: e.height,
+                    image_data: `data:${e.mime};base64,${e.image_data}`
+                  }))
+                } : {})
               });
               console.log(`✅ Generated mockup for ${result.template.room}/${result.template.id}`);
             } else {
@@ -3745,6 +3779,10 @@ if __name__ == "__main__":
         console.log(`⚡ Batch processing completed in ${elapsed}ms (${mockups.length}/${perspectiveTemplates.length} successful)`);
 
         } catch (batchError: any) {
+          if (clientGone.signal.aborted) {
+            console.log('🛑 Client disconnected during batch processing');
+            return;
+          }
           console.error('❌ Batch processing error:', batchError.message);
           
           // Fallback to old sequential method if batch fails
@@ -3758,10 +3796,6 @@ if __name__ == "__main__":
             
             console.log(`Processing mockup for ${template.room}/${template.id} with parameters: margin_px=0, feather_px=-1, opacity=-1, fit=cover`);
 
-            // Create temporary file for artwork
-            const tempArtworkPath = path.join(process.cwd(), `temp_artwork_${Date.now()}.jpg`);
-            fs.writeFileSync(tempArtworkPath, req.file.buffer);
-
             // Call Python script with your exact logic
             const pythonResult = await new Promise<any>((resolve, reject) => {
               const pythonExec = resolvePythonExecutable();
@@ -3870,7 +3904,8 @@ def process_mockup(artwork_path, room, template_id):
         corners = manifest["corners"]
         TL, TR, BR, BL = [tuple(map(float, p)) for p in corners]
         
-        with Image.open(artwork_path) as art_img:
+        art_source = io.BytesIO(sys.stdin.buffer.read()) if artwork_path == "-" else artwork_path
+        with Image.open(art_source) as art_img:
             art = art_img.convert("RGBA")
             art = ImageOps.exif_transpose(art)
         
@@ -3923,13 +3958,16 @@ def process_mockup(artwork_path, room, template_id):
 if len(sys.argv) >= 4:
     process_mockup(sys.argv[1], sys.argv[2], sys.argv[3])
 else:
-    process_mockup(${JSON.stringify(tempArtworkPath)}, ${JSON.stringify(template.room)}, ${JSON.stringify(template.id)})
+    process_mockup("-", ${JSON.stringify(template.room)}, ${JSON.stringify(template.id)})
 `]);
 
               python.on('error', (spawnError) => {
                 reject(new Error(`Failed to start Python process (${pythonExec.command}): ${spawnError instanceof Error ? spawnError.message : String(spawnError)}`));
               });
 
+              python.stdin.on('error', () => {});
+              python.stdin.end(artworkBuffer);
+
               let output = '';
               let error = '';
 
@@ -3942,13 +3980,6 @@ else:
               });
 
               python.on('close', (code: any) => {
-                // Clean up temp file
-                try {
-                  fs.unlinkSync(tempArtworkPath);
-                } catch (e) {
-                  // Ignore cleanup errors
-                }
-
                 if (code !== 0) {
                   reject(new Error(`Python process failed: ${error}`));
                   return;
@@ -3989,16 +4020,15 @@ else:
           console.error(`Error generating template ${template.room}/${template.id}:`, templateError);
         }
       }
-        } finally {
-          // Clean up temp file
-          try {
-            fs.unlinkSync(tempArtworkPath);
-          } catch (e) {
-            // Ignore cleanup errors
-          }
         }
       } // Close if (perspectiveTemplates.length > 0)
 
+      if (clientGone.signal.aborted) {
+        // Nothing was delivered, so nothing is charged or saved
+        console.log(`🛑 Client disconnected, discarding ${mockups.length} mockups`);
+        return;
+      }
+
       if (mockups.length === 0) {
         return res.status(500).json({ error: "Failed to generate any mockups" });
       }
@@ -4082,7 +4112,8 @@ else:
           status: 'completed',
           upscaleOption: '2x',
           mockupTemplate: selectedTemplates.length === 1 ? `${selectedTemplates[0].room}/${selectedTemplates[0].id}` : 'multiple',
-          thumbnailUrl: mockups[0]?.image_data || `data:image/jpeg;base64,${req.file.buffer.toString('base64')}`,
+          thumbnailUrl: mockups[0]?.exports?.find(e => e.name === 'thumbnail')?.image_data
+            || mockups[0]?.image_data || `data:image/jpeg;base64,${req.file.buffer.toString('base64')}`,
           aiPrompt: null,
           metadata: {
             mockupSet: 'true',
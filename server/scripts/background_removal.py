@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+Background Removal - in-process segmentation for the compositor
+Runs the rembg session inside the compositing process and hands the artwork to
+the warp/blend as an RGBA image carrying the predicted alpha, instead of a round
+trip through the rembg sidecar and two PNG codecs. Sessions are created once per process and reused.
+
+rembg is optional: it is imported on first use, so compositing without
+background removal never pays for it.
+
+Environment (same names as the rembg sidecar):
+    REMBG_MODEL            segmentation model (default u2net)
+    REMBG_MAX_INFER_SIDE   longest side fed to the model (default 1024, 0 = full size)
+"""
+import os
+import threading
+import numpy as np
+from PIL import Image
+
+MODEL_NAME = os.environ.get('REMBG_MODEL', 'u2net')
+MAX_INFER_SIDE = int(os.environ.get('REMBG_MAX_INFER_SIDE', '1024'))
+
+_SESSIONS = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def import_rembg():
+    """Import rembg once and return new_session; safe from any thread
+
+    rembg pulls in pymatting, which starts numba's threading layer on import.
+    The TBB layer started from a thread other than the main one keeps the
+    interpreter from exiting, so unless NUMBA_THREADING_LAYER says otherwise
+    the workqueue layer is used (pymatting's parallel kernels only serve alpha
+    matting, which this module does not use).
+    """
+    os.environ.setdefault('NUMBA_THREADING_LAYER', 'workqueue')
+    try:
+        from rembg import new_session
+    except ImportError:
+        raise Exception("Background removal requires the 'rembg' package")
+    return new_session
+
+
+def get_session(model_name=None):
+    """Shared rembg session for a model, created on first use"""
+    model_name = model_name or MODEL_NAME
+    session = _SESSIONS.get(model_name)
+    if session is not None:
+        return session
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(model_name)
+        if session is None:
+            session = import_rembg()(model_name)
+            _SESSIONS[model_name] = session
+    return session
+
+
+def predict_alpha(art, max_side=None, model_name=None):
+    """Foreground alpha for an artwork as a uint8 ndarray of the artwork's size
+
+    Inference runs on a copy downscaled to max_side; the mask is upsampled back.
+    """
+    if max_side is None:
+        max_side = MAX_INFER_SIDE
+    infer = art.convert("RGB")
+    if max_side and max(infer.size) > max_side:
+        infer.thumbnail((max_side, max_side), Image.BILINEAR)
+    masks = get_session(model_name).predict(infer)
+    alpha = np.asarray(masks[0].convert("L"))
+    for extra in masks[1:]:
+        alpha = np.maximum(alpha, np.asarray(extra.convert("L")))
+    if alpha.shape[:2] != (art.size[1], art.size[0]):
+        alpha = np.asarray(Image.fromarray(alpha).resize(art.size, Image.BILINEAR))
+    return alpha
+
+
+def remove_background(art, max_side=None, model_name=None):
+    """RGBA artwork with the predicted alpha multiplied into its own alpha channel"""
+    alpha = predict_alpha(art, max_side, model_name)
+    rgba = np.array(art.convert("RGBA"))
+    rgba[..., 3] = (rgba[..., 3].astype(np.uint16) * alpha // 255).astype(np.uint8)
+    return Image.fromarray(rgba, "RGBA")
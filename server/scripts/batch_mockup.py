@@ -2,6 +2,41 @@
 """
 Batch Mockup Generator - Process multiple templates in a single Python call
 This is 5-10x faster than spawning separate processes for each template
+
+Usage:
+    batch_mockup.py <artwork> <templates_json> [--raw WxHxC] [--cleanup] [--preview-long-edge N]
+                    [--remove-background] [--profile-dir DIR] [--deadline SECONDS] [--tiled]
+                    [--exports SPEC]
+
+<artwork> is a file path, '-' (encoded bytes on stdin), 'shm:<name>' (a
+/dev/shm segment, unlinked once read) or 'fd:<n>' (an inherited file
+descriptor such as a memfd). With --raw the bytes are decoded pixels
+(C = 3 for RGB, 4 for RGBA) instead of an encoded image.
+
+--preview-long-edge composites against the template's preview tier (background,
+corners and feather scaled to that long edge) for cheap gallery previews; the
+picked templates are then rendered again without it at full resolution.
+
+--remove-background segments the artwork once, in-process, and composites it
+with the predicted alpha (see background_removal.py).
+
+--profile-dir writes a sampling profile and tracemalloc peak snapshot of the run
+(see perf_profile.py), for artworks that are slow or run out of memory.
+
+--tiled composites and PNG-encodes in horizontal strips (png_stream.py), so
+memory stays bounded by the strip size rather than the background's; it is
+automatic for backgrounds of MOCKUP_TILED_MIN_MP megapixels (default 20) or more.
+Compile backgrounds (template_store.py build) so they are memory-mapped too.
+
+--exports adds listing/preview/thumbnail sizes to each mockup, resized and
+encoded from the composed frame in the same pass (see mockup_exports.py). SPEC
+is a preset ('etsy') or a JSON list such as
+'[{"name": "listing", "long_edge": 2000, "format": "jpeg"}]'. Each result then
+has 'exports': [{name, format, mime, width, height, image_data}].
+
+--deadline is the run's time budget. Once it passes, or on SIGTERM (the caller
+went away), the remaining templates are skipped: they are reported with
+'skipped': True and the output gets a 'cancelled' reason.
 """
 import sys
 import json
@@ -9,46 +44,24 @@ import base64
 import io
 import math
 import os
+import signal
+import argparse
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import cv2
 from PIL import Image, ImageOps
+from template_store import (load_template, compile_geometry, preview_template, template_fingerprint,
+                            background_rows)
+from perf_metrics import stage, start_request
+from deadlines import Deadline, Cancelled
+import result_cache
+from png_stream import write_png
+from mockup_exports import parse_exports, reduce_factor, reduce_frame, render_exports, export_frame, StripReducer, submit
 
-
-def _load_manifest(room, template_id):
-    """Load template manifest and validate paths"""
-    # Use TEMPLATES_PATH environment variable if set (for production with dist/templates)
-    templates_path = os.environ.get('TEMPLATES_PATH', './templates')
-    template_root = Path(templates_path)
-    room_dir = template_root / room
-    if not room_dir.exists():
-        raise Exception(f"Room folder not found: {room_dir}")
-    tdir = room_dir / template_id
-    if not tdir.exists():
-        raise Exception(f"Template '{template_id}' not found under {room_dir}")
-    
-    mpath = tdir / "manifest.json"
-    if not mpath.exists():
-        raise Exception(f"manifest.json missing in {tdir}")
-    
-    try:
-        manifest = json.loads(mpath.read_text())
-    except Exception as e:
-        raise Exception(f"manifest.json not valid JSON: {e}")
-    
-    bg_name = manifest.get("background")
-    if not bg_name:
-        raise Exception("manifest.json missing 'background'")
-    bg_path = tdir / bg_name
-    if not bg_path.exists():
-        raise Exception(f"Background not found: {bg_path}")
-    
-    corners = manifest.get("corners")
-    if not (isinstance(corners, list) and len(corners) == 4):
-        raise Exception("manifest.json 'corners' must be 4 points [TL,TR,BR,BL]")
-    
-    return manifest, bg_path
+# Backgrounds of at least this many pixels are composited in strips of TILE_ROWS
+# rows and streamed into the PNG encoder (bounded memory for 8K templates)
+TILED_MIN_PIXELS = int(float(os.environ.get('MOCKUP_TILED_MIN_MP', '20')) * 1_000_000)
+TILE_ROWS = int(os.environ.get('MOCKUP_TILE_ROWS', '256'))
 
 
 def _fit_size(src_w, src_h, dst_w, dst_h, mode):
@@ -87,17 +100,6 @@ def _np_to_pil(arr):
     return Image.fromarray(rgba)
 
 
-def _polygon_mask(shape_hw, polygon, feather_px):
-    """Create polygon mask with optional feathering"""
-    h, w = shape_hw
-    mask = np.zeros((h, w), dtype=np.uint8)
-    cv2.fillConvexPoly(mask, polygon.astype(np.int32), 255)
-    if feather_px and feather_px > 0:
-        k = max(1, int(round(feather_px)) | 1)
-        mask = cv2.GaussianBlur(mask, (k, k), 0)
-    return mask
-
-
 def _blend(bg_bgra, fg_bgra, mask, mode, opacity):
     """Blend foreground onto background with mask and opacity"""
     opacity = max(0.0, min(1.0, float(opacity)))
@@ -119,129 +121,503 @@ def _blend(bg_bgra, fg_bgra, mask, mode, opacity):
     return out
 
 
-def process_single_template(art, template):
-    """Process one template and return result
-    
+def load_artwork(artwork_path):
+    """Load artwork as an upright RGBA PIL image"""
+    with stage("decode"), Image.open(artwork_path) as art_img:
+        art = art_img.convert("RGBA")
+        art = ImageOps.exif_transpose(art)
+    return art
+
+
+def _read_artwork_bytes(spec, cleanup=False):
+    """Read artwork bytes from a path, stdin ('-'), /dev/shm ('shm:<name>') or fd ('fd:<n>')
+
+    shm segments are always unlinked once read; plain paths only with cleanup=True.
+    """
+    if spec == '-':
+        return sys.stdin.buffer.read()
+    if spec.startswith('fd:'):
+        with os.fdopen(int(spec[3:]), 'rb') as f:
+            try:
+                f.seek(0)
+            except OSError:
+                pass  # pipes aren't seekable; memfds are
+            return f.read()
+    if spec.startswith('shm:'):
+        name = spec[4:]
+        if not name or '/' in name or name.startswith('.'):
+            raise ValueError(f"Invalid shared-memory segment name: {name!r}")
+        path = Path('/dev/shm') / name
+        cleanup = True
+    else:
+        path = Path(spec)
+    try:
+        return path.read_bytes()
+    finally:
+        if cleanup:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+
+def read_artwork(spec, raw_shape=None, cleanup=False, max_side=0):
+    """Load artwork from any supported source as an upright RGBA PIL image
+
     Args:
-        art: Pre-loaded PIL Image (RGBA) to avoid loading from disk multiple times
-        template: Template configuration dict
+        spec: Path, '-', 'shm:<name>' or 'fd:<n>' (see _read_artwork_bytes)
+        raw_shape: (w, h, channels) when the bytes are decoded pixels
+        cleanup: Delete a plain-path artwork once it has been read
+        max_side: If set, let JPEG decode at a reduced scale (never below max_side)
     """
+    with stage("read"):
+        data = _read_artwork_bytes(spec, cleanup)
+    return decode_artwork(data, raw_shape, max_side)
+
+
+def decode_artwork(data, raw_shape=None, max_side=0):
+    """Decode artwork bytes (encoded image, or raw pixels with raw_shape) as an upright RGBA PIL image"""
+    if raw_shape is not None:
+        w, h, c = raw_shape
+        if c not in (3, 4):
+            raise ValueError("Raw artwork must have 3 (RGB) or 4 (RGBA) channels")
+        if len(data) != w * h * c:
+            raise ValueError(f"Raw artwork is {len(data)} bytes, expected {w}x{h}x{c} = {w * h * c}")
+        with stage("decode"):
+            return Image.frombuffer("RGBA" if c == 4 else "RGB", (w, h), data, "raw").convert("RGBA")
+    with stage("decode"), Image.open(io.BytesIO(data)) as art_img:
+        if max_side:
+            art_img.draft(None, (max_side, max_side))
+        art = art_img.convert("RGBA")
+        art = ImageOps.exif_transpose(art)
+    return art
+
+
+def _parse_raw_shape(value):
     try:
-        room = template['room']
-        template_id = template['id']
-        name = template.get('name', f"{room}_{template_id}")
-        
-        # Load manifest and background
-        manifest, bg_path = _load_manifest(room, template_id)
-        
-        with Image.open(bg_path) as P:
-            bg = P.convert("RGBA")
-        
-        bg_w, bg_h = bg.size
-        corners = manifest["corners"]
-        TL, TR, BR, BL = [tuple(map(float, p)) for p in corners]
-        
-        # Artwork is already loaded and passed in (memory optimization)
-        
-        dst_w = math.dist(TL, TR)
-        dst_h = math.dist(TL, BL)
-        
-        mx = 0  # margin_px = 0
-        dst_quad = np.array([TL, TR, BR, BL], dtype=np.float32)
-        
+        w, h, c = (int(v) for v in value.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected WxHxC, e.g. 2000x3000x4")
+    return w, h, c
+
+
+def _parse_exports_arg(value):
+    try:
+        return parse_exports(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def _prepare_composite(art, tpl, fit, margin_px, feather_px, opacity, art_alpha=False):
+    """Fit the artwork to the template quad; returns what warping and blending need"""
+    manifest = tpl['manifest']
+    bg_h, bg_w = tpl['bg'].shape[:2]
+    dst_quad = tpl['quad']
+    TL, TR, BR, BL = [tuple(map(float, p)) for p in dst_quad]
+
+    dst_w = math.dist(TL, TR)
+    dst_h = math.dist(TL, BL)
+
+    mx = max(0, int(margin_px))
+
+    with stage("fit"):
         # Fit artwork to destination
         aw, ah = art.size
-        sw, sh = _fit_size(aw, ah, int(round(dst_w))-2*mx, int(round(dst_h))-2*mx, "cover")
-        
+        sw, sh = _fit_size(aw, ah, int(round(dst_w))-2*mx, int(round(dst_h))-2*mx, fit.lower())
+
         art_resized = art.resize((max(1,sw), max(1,sh)), Image.LANCZOS)
-        
+
         # Create canvas and center artwork
         canvas_w = int(round(dst_w))
         canvas_h = int(round(dst_h))
+        if canvas_w < 2 or canvas_h < 2:
+            raise ValueError("Destination frame too small from corners")
         art_canvas = Image.new("RGBA", (canvas_w, canvas_h), (0,0,0,0))
         ox = (canvas_w - sw)//2
         oy = (canvas_h - sh)//2
         ox = max(0, ox + (mx if sw <= canvas_w-2*mx else 0))
         oy = max(0, oy + (mx if sh <= canvas_h-2*mx else 0))
-        art_canvas.paste(art_resized, (ox, oy), art_resized)
-        
-        # Apply perspective transform
+        if art_alpha:
+            # Straight copy: _warp_rows applies the alpha, once
+            art_canvas.paste(art_resized, (ox, oy))
+        else:
+            art_canvas.paste(art_resized, (ox, oy), art_resized)
+        del art_resized
+
+    # Apply perspective transform
+    with stage("homography"):
         src_quad = np.array([[0,0],[canvas_w,0],[canvas_w,canvas_h],[0,canvas_h]], dtype=np.float32)
         H, ok = cv2.findHomography(src_quad, dst_quad, method=0)
-        
-        bg_bgra = _pil_to_np(bg)
+    if H is None:
+        raise ValueError("Failed to compute homography from points")
+
+    # Apply mask and blend
+    with stage("mask"):
+        if feather_px is None:
+            roi, quad_mask = tpl['roi'], tpl['mask']
+        else:
+            roi, quad_mask = compile_geometry(dst_quad, feather_px, (bg_h, bg_w), tpl.get('occlusion'))
+    if opacity is None:
+        opacity = manifest.get("blend", {}).get("opacity", 1.0)
+    blend_mode = manifest.get("blend", {}).get("mode", "normal").lower()
+
+    with stage("warp"):
         art_bgra = _pil_to_np(art_canvas)
-        warped = cv2.warpPerspective(art_bgra, H, (bg_w, bg_h), flags=cv2.INTER_LANCZOS4, borderMode=cv2.BORDER_TRANSPARENT)
-        
-        # Apply mask and blend
-        feather_px = manifest.get("feather_px", 0)
-        quad_mask = _polygon_mask((bg_h, bg_w), dst_quad, feather_px)
-        opacity_val = manifest.get("blend", {}).get("opacity", 1.0)
-        blend_mode = manifest.get("blend", {}).get("mode", "normal").lower()
-        
-        composed = _blend(bg_bgra, warped, quad_mask, blend_mode, opacity_val)
+    return {'art': art_bgra, 'H': H, 'roi': roi, 'mask': quad_mask, 'mode': blend_mode, 'opacity': opacity}
+
+
+def _warp_rows(prep, y0, y1, art_alpha):
+    """Warped artwork and blend mask for background rows y0:y1 of the ROI's columns"""
+    x0, _, x1, _ = prep['roi']
+    # Translated homography: warp straight into the rows wanted; pixels outside the quad stay transparent
+    with stage("warp"):
+        T = np.array([[1, 0, -x0], [0, 1, -y0], [0, 0, 1]], dtype=np.float64)
+        warped = np.zeros((y1 - y0, x1 - x0, 4), dtype=np.uint8)
+        cv2.warpPerspective(prep['art'], T @ prep['H'], (x1 - x0, y1 - y0), dst=warped,
+                            flags=cv2.INTER_LANCZOS4, borderMode=cv2.BORDER_TRANSPARENT)
+    roi_y0 = prep['roi'][1]
+    mask = prep['mask'][y0 - roi_y0:y1 - roi_y0]
+    if art_alpha:
+        mask = (mask.astype(np.uint16) * warped[..., 3] // 255).astype(np.uint8)
+    return warped, mask
+
+
+def compose_mockup(art, tpl, fit="cover", margin_px=0, feather_px=None, opacity=None, art_alpha=False):
+    """Warp artwork into the template quad and blend it onto the background
+
+    Args:
+        art: RGBA PIL Image
+        tpl: Loaded template dict from template_store (manifest, bg, quad)
+        fit: 'cover' or 'contain'
+        margin_px: Inset artwork within the frame
+        feather_px: None uses manifest feather
+        opacity: None uses manifest opacity (blend.opacity)
+        art_alpha: Honour the artwork's alpha channel (background-removed art)
+
+    Returns:
+        Composed BGRA numpy array the size of the background
+    """
+    bg_bgra = tpl['bg']
+    prep = _prepare_composite(art, tpl, fit, margin_px, feather_px, opacity, art_alpha)
+    x0, y0, x1, y1 = prep['roi']
+    warped, quad_mask = _warp_rows(prep, y0, y1, art_alpha)
+
+    with stage("blend"):
+        composed = bg_bgra.copy()
+        composed[y0:y1, x0:x1] = _blend(bg_bgra[y0:y1, x0:x1], warped, quad_mask, prep['mode'], prep['opacity'])
+    return composed
+
+
+def compose_strips(art, tpl, fit="cover", margin_px=0, feather_px=None, opacity=None, art_alpha=False,
+                   rows=TILE_ROWS):
+    """compose_mockup, yielded as BGRA strips of `rows` rows from the top
+
+    Only one strip of the background is read (from the compiled background)
+    and blended at a time, and the artwork is warped strip by strip, so
+    memory does not grow with the background's size.
+    """
+    bg_bgra = tpl['bg']
+    bg_h = bg_bgra.shape[0]
+    prep = _prepare_composite(art, tpl, fit, margin_px, feather_px, opacity, art_alpha)
+    x0, y0, x1, y1 = prep['roi']
+    for r0 in range(0, bg_h, rows):
+        r1 = min(bg_h, r0 + rows)
+        strip = background_rows(bg_bgra, r0, r1)
+        a, b = max(r0, y0), min(r1, y1)
+        if a < b:
+            warped, mask = _warp_rows(prep, a, b, art_alpha)
+            with stage("blend"):
+                strip[a - r0:b - r0, x0:x1] = _blend(strip[a - r0:b - r0, x0:x1], warped, mask,
+                                                     prep['mode'], prep['opacity'])
+        yield strip
+
+
+def encode_png(composed):
+    """Encode a BGRA array as PNG bytes"""
+    with stage("encode"):
         out_img = _np_to_pil(composed)
-        
-        # Convert to base64
         buf = io.BytesIO()
         out_img.save(buf, "PNG")
-        b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
+        return buf.getvalue()
+
+
+def use_tiled(tpl):
+    """Whether a template's background is large enough to composite in strips"""
+    bg_h, bg_w = tpl['bg'].shape[:2]
+    return bg_h * bg_w >= TILED_MIN_PIXELS
+
+
+def write_mockup_png(art, tpl, out, tiled=None, **kwargs):
+    """Composite and write the PNG to a binary file object
+
+    tiled (None = by background size) streams strips into the encoder, so
+    neither the frame nor the whole PNG is held in memory. kwargs are
+    compose_mockup's. The tiled PNG is pixel-identical to the whole-frame one
+    but not byte-identical (different row filtering).
+    """
+    if tiled is None:
+        tiled = use_tiled(tpl)
+    if not tiled:
+        out.write(encode_png(compose_mockup(art, tpl, **kwargs)))
+        return
+    bg_h, bg_w = tpl['bg'].shape[:2]
+    write_png(compose_strips(art, tpl, **kwargs), bg_w, bg_h, out)
+
+
+def compose_png(art, tpl, tiled=None, **kwargs):
+    """write_mockup_png into PNG bytes"""
+    buf = io.BytesIO()
+    write_mockup_png(art, tpl, buf, tiled=tiled, **kwargs)
+    return buf.getvalue()
+
+
+def compose_with_exports(art, tpl, exports, tiled=None, **kwargs):
+    """compose_png plus the export sizes, from the same composite; returns (png, exports)
+
+    Whole frames are PNG-encoded on the export pool while the sizes are cut;
+    strip-composited frames are reduced strip by strip as they are encoded.
+    """
+    bg_h, bg_w = tpl['bg'].shape[:2]
+    factor = reduce_factor(bg_w, bg_h, exports)
+    if tiled is None:
+        tiled = use_tiled(tpl)
+    if tiled:
+        reducer = StripReducer(bg_w, bg_h, factor)
+        buf = io.BytesIO()
+        write_png(reducer.feed(compose_strips(art, tpl, **kwargs)), bg_w, bg_h, buf)
+        return buf.getvalue(), render_exports(reducer.result(), (bg_w, bg_h), exports)
+    composed = compose_mockup(art, tpl, **kwargs)
+    png = submit(encode_png, composed)
+    level = reduce_frame(composed, factor)
+    del composed
+    rendered = render_exports(level, (bg_w, bg_h), exports)
+    return png.result(), rendered
+
+
+def _exports_output(rendered):
+    with stage("base64"):
+        return [{'name': e['name'], 'format': e['format'], 'mime': e['mime'], 'width': e['width'],
+                 'height': e['height'], 'image_data': base64.b64encode(e['data']).decode("utf-8")} for e in rendered]
+
+
+def process_single_template(art, template, tpl=None, preview_long_edge=0, art_alpha=False, cache_key=None,
+                            tiled=None, exports=None):
+    """Process one template and return result
+    
+    Args:
+        art: Pre-loaded PIL Image (RGBA) to avoid loading from disk multiple times
+        template: Template configuration dict
+        tpl: Optional already-loaded template (long-lived workers pass cached ones)
+        preview_long_edge: Composite against the preview tier with this long edge (0 = full size)
+        art_alpha: Composite through the artwork's alpha (set after remove_background)
+        cache_key: Store the PNG in the result cache under this key
+        tiled: Composite in strips (None = for backgrounds of TILED_MIN_PIXELS or more)
+        exports: Parsed export spec (mockup_exports.parse_exports); adds 'exports' to the result
+    """
+    timings = start_request()
+    try:
+        room = template['room']
+        template_id = template['id']
+        name = template.get('name', f"{room}_{template_id}")
+        
+        # Load manifest and background
+        with stage("template"):
+            if tpl is None:
+                tpl = load_template(room, template_id)
+            if preview_long_edge:
+                tpl = preview_template(tpl, preview_long_edge)
         
-        # Explicitly close/delete large objects to free memory immediately
-        del bg_bgra, art_bgra, warped, composed, out_img, bg, art_resized, art_canvas
-        buf.close()
+        out_h, out_w = tpl['bg'].shape[:2]
+        rendered = None
+        if exports:
+            png, rendered = compose_with_exports(art, tpl, exports, tiled=tiled, art_alpha=art_alpha)
+        else:
+            png = compose_png(art, tpl, tiled=tiled, art_alpha=art_alpha)
+        if cache_key:
+            with stage("cache"):
+                result_cache.put(cache_key, png)
+        with stage("base64"):
+            b64 = base64.b64encode(png).decode("utf-8")
         
-        return {
+        # Explicitly delete large objects to free memory immediately
+        del tpl
+        
+        result = {
             'success': True,
             'template': {'room': room, 'id': template_id, 'name': name},
-            'image_data': b64
+            'image_data': b64,
+            'timings': timings,
         }
+        if preview_long_edge:
+            result['preview'] = {'long_edge': preview_long_edge, 'w': out_w, 'h': out_h}
+        if rendered is not None:
+            result['exports'] = _exports_output(rendered)
+        return result
         
     except Exception as e:
         return {
             'success': False,
             'template': template,
-            'error': str(e)
+            'error': str(e),
+            'timings': timings,
         }
 
 
+def _cache_key(art_hash, template, args):
+    """Result cache key for a template, or None when the cache is off or the template is unreadable"""
+    if art_hash is None:
+        return None
+    try:
+        fingerprint = template_fingerprint(template['room'], template['id'])
+    except (OSError, ValueError, KeyError):
+        return None  # process_single_template reports the broken template
+    # Batch composites with compose_mockup's defaults
+    return result_cache.result_key(art_hash, fingerprint, preview_long_edge=args.preview_long_edge,
+                                   remove_background=args.remove_background)
+
+
+def _cached_result(template, png, preview_long_edge, timings, exports=None):
+    """process_single_template's result for a cache hit
+
+    Exports are cut from the cached PNG, decoded once (the cache holds only the full size).
+    """
+    room, template_id = template['room'], template['id']
+    result = {
+        'success': True,
+        'template': {'room': room, 'id': template_id, 'name': template.get('name', f"{room}_{template_id}")},
+        'image_data': base64.b64encode(png).decode("utf-8"),
+        'timings': timings,
+        'cache': 'HIT',
+    }
+    if preview_long_edge:
+        out_w, out_h = result_cache.png_size(png)
+        result['preview'] = {'long_edge': preview_long_edge, 'w': out_w, 'h': out_h}
+    if exports:
+        with stage("decode"):
+            frame = cv2.imdecode(np.frombuffer(png, np.uint8), cv2.IMREAD_UNCHANGED)
+        result['exports'] = _exports_output(export_frame(frame, exports))
+    return result
+
+
+def _run_batch(args, templates, run_timings, deadline=None):
+    """Read the artwork once and composite it onto every template in turn
+
+    Mockups already in the result cache are served from it; the artwork is only
+    decoded (and segmented) if at least one template misses. Templates left when
+    the deadline passes or is cancelled are skipped.
+    """
+    with stage("read"):
+        data = _read_artwork_bytes(args.artwork, args.cleanup)
+    art_hash = None
+    if result_cache.enabled():
+        art_hash = result_cache.artwork_hash(data)
+        if args.raw is not None:
+            art_hash = result_cache.artwork_hash(f"{art_hash}:{args.raw}".encode())
+    art = None
+
+    # Process templates SEQUENTIALLY (one at a time) to minimize memory usage
+    # This is critical for supporting 10 mockups without running out of RAM
+    results = []
+    for i, template in enumerate(templates, 1):
+        try:
+            if deadline is not None:
+                deadline.check(f"mockup {i}/{len(templates)}")
+        except Cancelled as e:
+            print(f"Skipping {len(templates) - i + 1} remaining mockups: {e}", file=sys.stderr)
+            results.extend({'success': False, 'template': t, 'error': f"skipped: {e.reason}", 'skipped': True}
+                           for t in templates[i - 1:])
+            break
+        print(f"Processing mockup {i}/{len(templates)}: {template.get('name', template['id'])}", file=sys.stderr)
+        key = _cache_key(art_hash, template, args)
+        if key is not None:
+            timings = start_request()
+            with stage("cache"):
+                png = result_cache.get(key)
+            if png is not None:
+                results.append(_cached_result(template, png, args.preview_long_edge, timings, args.exports))
+                continue
+        if art is None:
+            # Load artwork ONCE to avoid loading it multiple times
+            start_request(run_timings)
+            art = decode_artwork(data, args.raw, max_side=args.preview_long_edge)
+            del data
+            if args.remove_background:
+                # Once per artwork, shared by every template
+                from background_removal import remove_background
+                with stage("remove_background"):
+                    art = remove_background(art)
+        result = process_single_template(art, template, preview_long_edge=args.preview_long_edge,
+                                         art_alpha=args.remove_background, cache_key=key,
+                                         tiled=True if args.tiled else None, exports=args.exports)
+        results.append(result)
+        
+        # Force garbage collection after each mockup to free memory immediately
+        import gc
+        gc.collect()
+        
+        # Log memory usage for monitoring
+        try:
+            import psutil
+            process = psutil.Process()
+            mem_mb = process.memory_info().rss / 1024 / 1024
+            print(f"Memory usage after mockup {i}: {mem_mb:.1f}MB", file=sys.stderr)
+        except ImportError:
+            pass  # psutil not available, skip memory logging
+    return results
+
+
 def main():
     """Main entry point - process all templates SEQUENTIALLY to minimize memory usage"""
-    if len(sys.argv) < 3:
-        print(json.dumps({'error': 'Usage: batch_mockup.py <artwork_path> <templates_json>'}), file=sys.stderr)
-        sys.exit(1)
-    
-    artwork_path = sys.argv[1]
-    templates = json.loads(sys.argv[2])
-    
-    # Load artwork ONCE to avoid loading it multiple times
-    with Image.open(artwork_path) as art_img:
-        art = art_img.convert("RGBA")
-        art = ImageOps.exif_transpose(art)
-        
-        # Process templates SEQUENTIALLY (one at a time) to minimize memory usage
-        # This is critical for supporting 10 mockups without running out of RAM
-        results = []
-        for i, template in enumerate(templates, 1):
-            print(f"Processing mockup {i}/{len(templates)}: {template.get('name', template['id'])}", file=sys.stderr)
-            result = process_single_template(art, template)
-            results.append(result)
-            
-            # Force garbage collection after each mockup to free memory immediately
-            import gc
-            gc.collect()
-            
-            # Log memory usage for monitoring
-            try:
-                import psutil
-                process = psutil.Process()
-                mem_mb = process.memory_info().rss / 1024 / 1024
-                print(f"Memory usage after mockup {i}: {mem_mb:.1f}MB", file=sys.stderr)
-            except ImportError:
-                pass  # psutil not available, skip memory logging
+    parser = argparse.ArgumentParser(description="Composite one artwork onto several templates")
+    parser.add_argument("artwork", help="Path, '-' (stdin), 'shm:<name>' or 'fd:<n>'")
+    parser.add_argument("templates", help="Templates JSON list")
+    parser.add_argument("--raw", type=_parse_raw_shape, metavar="WxHxC",
+                        help="Artwork bytes are raw RGB/RGBA pixels of this shape")
+    parser.add_argument("--cleanup", action="store_true", help="Delete the artwork file once read")
+    parser.add_argument("--preview-long-edge", type=int, default=0,
+                        help="Composite at preview resolution (long edge in px)")
+    parser.add_argument("--remove-background", action="store_true",
+                        help="Segment the artwork in-process and composite only its foreground")
+    parser.add_argument("--profile-dir", metavar="DIR",
+                        help="Profile the run (sampled stacks + tracemalloc) and write the artifacts here")
+    parser.add_argument("--tiled", action="store_true",
+                        help="Composite every template in strips (default: backgrounds of MOCKUP_TILED_MIN_MP or more)")
+    parser.add_argument("--exports", type=_parse_exports_arg, metavar="SPEC",
+                        help="Also produce these sizes from each composite: a preset ('etsy') or a JSON list")
+    parser.add_argument("--deadline", type=float, default=0, metavar="SECONDS",
+                        help="Skip the templates left after this many seconds")
+    try:
+        args = parser.parse_args()
+    except SystemExit as e:
+        if e.code:
+            print(json.dumps({'error': 'Usage: batch_mockup.py <artwork_path> <templates_json>'}), file=sys.stderr)
+        raise
     
+    templates = json.loads(args.templates)
+    deadline = Deadline(args.deadline if args.deadline > 0 else None)
+    # SIGTERM means the caller gave up: finish the current mockup, skip the rest
+    signal.signal(signal.SIGTERM, lambda signum, frame: deadline.cancel("terminated"))
+    run_timings = start_request()
+    profile_path = None
+    if args.profile_dir:
+        from perf_profile import profiling
+        with profiling("batch_mockup", args.profile_dir, run_timings) as holder:
+            results = _run_batch(args, templates, run_timings, deadline)
+        summary = holder.get("summary")
+        if summary is not None:
+            profile_path = str(Path(args.profile_dir) / f"{summary['id']}.json")
+            print(f"Profile written: {profile_path}", file=sys.stderr)
+    else:
+        results = _run_batch(args, templates, run_timings, deadline)
+
     # Output results as JSON
-    print(json.dumps({'mockups': results}))
+    # Per-mockup stage timings are in each result; artwork-level stages (ms) here
+    output = {'mockups': results, 'timings': run_timings}
+    if profile_path:
+        output['profile'] = profile_path
+    if deadline.reason or deadline.expired():
+        output['cancelled'] = deadline.reason or 'deadline exceeded'
+    print(json.dumps(output))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Bulk Mockup Generator - N artworks x M templates over a process pool
+Each worker decodes every template background once (or inherits them preloaded
+from the parent on fork platforms), outputs are written straight to disk and a
+progress journal makes interrupted runs resumable.
+
+Usage:
+    bulk_mockup.py <artworks_dir|manifest> <templates_json|all> --out <dir> [--workers N]
+
+The artworks manifest is either a JSON list of paths / {"path", "id"} objects or
+a text file with one path per line.
+"""
+import sys
+import json
+import os
+import math
+import time
+import argparse
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from batch_mockup import load_artwork, write_mockup_png
+from template_store import get_template, list_templates, preload
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp", ".tif", ".tiff")
+JOURNAL_NAME = "bulk_progress.jsonl"
+
+
+def _load_artworks(source):
+    """Resolve artworks from a directory, manifest or single image into [(artwork_id, path)]"""
+    src = Path(source)
+    if src.is_dir():
+        paths = sorted(p for p in src.iterdir() if p.is_file() and p.suffix.lower() in IMAGE_EXTS)
+        return [(p.stem, p) for p in paths]
+    if src.suffix.lower() in IMAGE_EXTS:
+        return [(src.stem, src)]
+
+    text = src.read_text()
+    if src.suffix.lower() == ".json":
+        entries = json.loads(text)
+        if isinstance(entries, dict):
+            entries = entries.get("artworks", [])
+    else:
+        entries = [line.strip() for line in text.splitlines() if line.strip() and not line.startswith("#")]
+
+    artworks = []
+    for entry in entries:
+        if isinstance(entry, dict):
+            path = src.parent / entry["path"]
+            artworks.append((entry.get("id") or path.stem, path))
+        else:
+            path = src.parent / entry
+            artworks.append((path.stem, path))
+    return artworks
+
+
+def _load_templates(selection):
+    """Resolve template selection: 'all', a room list ('bedroom,study') or templates JSON"""
+    if selection == "all":
+        return [{"room": r, "id": t} for r, t in list_templates()]
+    if selection.lstrip().startswith("["):
+        return json.loads(selection)
+    rooms = {r.strip() for r in selection.split(",") if r.strip()}
+    return [{"room": r, "id": t} for r, t in list_templates() if r in rooms]
+
+
+def _read_journal(journal_path):
+    """Set of (artwork_id, room, template_id) already completed"""
+    done = set()
+    if not journal_path.exists():
+        return done
+    with journal_path.open() as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # partial line from an interrupted run
+            if entry.get("success"):
+                done.add((entry["artwork"], entry["room"], entry["id"]))
+    return done
+
+
+def _process_artwork(artwork_id, artwork_path, templates, out_dir):
+    """Worker task: load one artwork and render every pending template for it"""
+    results = []
+    try:
+        art = load_artwork(artwork_path)
+    except Exception as e:
+        for template in templates:
+            results.append({"artwork": artwork_id, "room": template["room"], "id": template["id"],
+                            "success": False, "error": f"Could not read artwork: {e}"})
+        return results
+
+    art_dir = Path(out_dir) / artwork_id
+    art_dir.mkdir(parents=True, exist_ok=True)
+    for template in templates:
+        room, template_id = template["room"], template["id"]
+        t0 = time.perf_counter()
+        try:
+            tpl = get_template(room, template_id)
+            out_path = art_dir / f"{room}_{template_id}.png"
+            tmp_path = out_path.with_suffix(".png.part")
+            # Large backgrounds are composited in strips straight into the file
+            with open(tmp_path, "wb") as f:
+                write_mockup_png(art, tpl, f)
+            os.replace(tmp_path, out_path)
+            results.append({"artwork": artwork_id, "room": room, "id": template_id, "success": True,
+                            "file": str(out_path), "ms": round((time.perf_counter() - t0) * 1000, 1)})
+        except Exception as e:
+            results.append({"artwork": artwork_id, "room": room, "id": template_id,
+                            "success": False, "error": str(e)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render N artworks x M templates over a process pool")
+    parser.add_argument("artworks", help="Artwork directory, JSON manifest or text file of paths")
+    parser.add_argument("templates", help="'all', comma-separated rooms, or templates JSON")
+    parser.add_argument("--out", required=True, help="Output directory (also holds the progress journal)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    journal_path = out_dir / JOURNAL_NAME
+
+    artworks = _load_artworks(args.artworks)
+    templates = _load_templates(args.templates)
+    done = _read_journal(journal_path)
+
+    jobs = []
+    skipped = 0
+    for artwork_id, artwork_path in artworks:
+        pending = [t for t in templates if (artwork_id, t["room"], t["id"]) not in done]
+        skipped += len(templates) - len(pending)
+        if pending:
+            jobs.append((artwork_id, artwork_path, pending))
+
+    # Fewer artworks than workers: split each artwork's templates so every worker gets a share
+    workers = max(1, args.workers)
+    if jobs and len(jobs) < workers:
+        parts = math.ceil(workers / len(jobs))
+        split = []
+        for artwork_id, artwork_path, pending in jobs:
+            size = math.ceil(len(pending) / parts)
+            split.extend((artwork_id, artwork_path, pending[i:i + size]) for i in range(0, len(pending), size))
+        jobs = split
+
+    total = sum(len(j[2]) for j in jobs)
+    print(f"Bulk run: {len(artworks)} artworks x {len(templates)} templates, "
+          f"{total} pending, {skipped} already done", file=sys.stderr)
+
+    # On fork platforms decode templates once in the parent; workers share the pages copy-on-write
+    methods = multiprocessing.get_all_start_methods()
+    ctx = multiprocessing.get_context("fork" if "fork" in methods else None)
+    if "fork" in methods and jobs:
+        loaded, errors = preload([(t["room"], t["id"]) for t in templates])
+        print(f"Preloaded {loaded} templates", file=sys.stderr)
+        for key, err in errors.items():
+            print(f"Template {key} failed to load: {err}", file=sys.stderr)
+
+    completed = failed = 0
+    started = time.perf_counter()
+    with journal_path.open("a") as journal, \
+            ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        futures = [pool.submit(_process_artwork, a_id, str(a_path), pending, str(out_dir))
+                   for a_id, a_path, pending in jobs]
+        for future in as_completed(futures):
+            for entry in future.result():
+                journal.write(json.dumps(entry) + "\n")
+                if entry["success"]:
+                    completed += 1
+                else:
+                    failed += 1
+                    print(f"Failed {entry['artwork']} -> {entry['room']}/{entry['id']}: {entry['error']}", file=sys.stderr)
+            journal.flush()
+            elapsed = time.perf_counter() - started
+            print(f"Progress {completed + failed}/{total} ({completed / elapsed:.2f} images/s)", file=sys.stderr)
+
+    elapsed = time.perf_counter() - started
+    print(json.dumps({
+        "artworks": len(artworks),
+        "templates": len(templates),
+        "completed": completed,
+        "failed": failed,
+        "skipped": skipped,
+        "elapsed_s": round(elapsed, 2),
+        "images_per_sec": round(completed / elapsed, 3) if elapsed > 0 else 0.0,
+        "journal": str(journal_path),
+    }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+Deadlines - stop work nobody is waiting for
+A Deadline is shared by everything a request sets in motion. It ends when its
+time budget runs out or when cancel() is called (client disconnected, batch
+process sent SIGTERM). Pipelines call check() between units of work (styles,
+templates, variants) and skip the rest with Cancelled; upstream calls bound
+their timeouts by remaining().
+
+The budget comes from the X-Deadline-Ms header or a deadline_ms form field
+(milliseconds from receipt; the smaller wins) and is relative, so client and
+server clocks need not agree.
+
+A blocking HTTP call already in flight cannot be interrupted from another
+thread; its read timeout is what ends it at the deadline.
+"""
+import time
+import asyncio
+import threading
+import contextvars
+
+DEADLINE_HEADER = "X-Deadline-Ms"
+# How long past the deadline a caller waits for the job to stop and return what it has
+DEADLINE_GRACE_S = 0.25
+
+_CURRENT = contextvars.ContextVar("deadline", default=None)
+
+
+class Cancelled(Exception):
+    """The request's deadline passed or it was cancelled"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class ClientDisconnected(Cancelled):
+    """The client went away while waiting"""
+
+
+class Deadline:
+    """Time budget plus a cancel flag; safe to share between threads"""
+
+    def __init__(self, seconds=None):
+        self.expires = time.monotonic() + seconds if seconds is not None else None
+        self._cancelled = threading.Event()
+        self.reason = None
+
+    @classmethod
+    def from_ms(cls, *values):
+        """Deadline from millisecond budgets (header, form field, ...); the smallest given wins"""
+        budgets = []
+        for value in values:
+            try:
+                ms = float(value)
+            except (TypeError, ValueError):
+                continue
+            if ms > 0:
+                budgets.append(ms)
+        return cls(min(budgets) / 1000.0 if budgets else None)
+
+    def extend(self, other):
+        """Widen to cover another caller's deadline (a coalesced request that can wait longer)"""
+        if self.expires is None or other is None:
+            return
+        if other.expires is None:
+            self.expires = None
+        else:
+            self.expires = max(self.expires, other.expires)
+
+    def cancel(self, reason="cancelled"):
+        if not self._cancelled.is_set():
+            self.reason = reason
+            self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def remaining(self):
+        """Seconds left (0 when over), or None without a time budget"""
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self):
+        return self.cancelled or (self.expires is not None and time.monotonic() >= self.expires)
+
+    def check(self, what=""):
+        """Raise Cancelled if no one should continue this work"""
+        if self.cancelled:
+            raise Cancelled(f"{self.reason}{f' before {what}' if what else ''}")
+        if self.expires is not None and time.monotonic() >= self.expires:
+            raise Cancelled(f"deadline exceeded{f' before {what}' if what else ''}")
+
+    def timeout(self, default):
+        """default seconds, cut to what is left of the budget"""
+        left = self.remaining()
+        return default if left is None else max(0.001, min(default, left))
+
+    def run(self, fn, *args, **kwargs):
+        """Call fn with this as the current deadline (e.g. in a worker thread)"""
+        token = _CURRENT.set(self)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _CURRENT.reset(token)
+
+
+def current():
+    """The deadline of the work running here, or None"""
+    return _CURRENT.get()
+
+
+def check(what=""):
+    deadline = _CURRENT.get()
+    if deadline is not None:
+        deadline.check(what)
+
+
+def timeout(default):
+    deadline = _CURRENT.get()
+    return default if deadline is None else deadline.timeout(default)
+
+
+async def wait_unless_disconnected(request, awaitable, deadline=None):
+    """Await awaitable, raising ClientDisconnected early if the client goes away
+
+    Call after the request body has been read: the next ASGI message is then
+    the disconnect. (Request.is_disconnected() cannot see it from behind
+    @app.middleware("http").) The awaitable is not cancelled; whoever owns the
+    work decides (SingleFlight cancels the job's deadline once every caller is gone).
+    """
+    fut = asyncio.ensure_future(awaitable)
+    gone = asyncio.ensure_future(request.receive())
+    try:
+        while True:
+            wait_s = deadline.remaining() if deadline is not None else None
+            if wait_s is not None:
+                wait_s += DEADLINE_GRACE_S
+            done, _ = await asyncio.wait({fut, gone}, timeout=wait_s, return_when=asyncio.FIRST_COMPLETED)
+            if fut in done:
+                return fut.result()
+            if gone in done:
+                if gone.cancelled() or gone.exception() is not None or gone.result().get("type") == "http.disconnect":
+                    fut.add_done_callback(_consume)
+                    raise ClientDisconnected("client disconnected")
+                gone = asyncio.ensure_future(request.receive())
+                continue
+            if deadline.expired():
+                fut.add_done_callback(_consume)
+                deadline.check()
+    finally:
+        gone.cancel()
+
+
+def _consume(fut):
+    if not fut.cancelled():
+        fut.exception()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Mockup Exports - listing, preview and thumbnail sizes from one composed frame
+Listing sizes used to be cut from the full-size PNG after the fact: decode it
+again, resize, re-encode. With an exports spec the compositor makes them from
+the frame it still holds:
+
+- the frame is first box-averaged down by the largest whole factor that keeps
+  it at least as big as the biggest export (strip-composited frames are
+  averaged strip by strip as they stream past, so the full frame is still never
+  held; both routes give identical pixels)
+- sizes are then made largest first, each resized (INTER_AREA) from the one
+  before it rather than from the full frame
+- each size is encoded with cv2.imencode (JPEG, WebP or PNG) on a thread pool
+  while the next is being resized; the encoders release the GIL
+
+Spec: a preset name from PRESETS, or a JSON list of
+{"name", "long_edge" | "width", "format": "jpeg" | "webp" | "png", "quality"}.
+Sizes never enlarge the frame. JPEGs are flattened onto white.
+
+Environment:
+    MOCKUP_EXPORT_THREADS   encoder threads (default: CPUs, up to 4)
+"""
+import os
+import json
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from perf_metrics import stage
+
+# format: (extension, mime type, quality flag, default quality)
+FORMATS = {
+    "jpeg": (".jpg", "image/jpeg", cv2.IMWRITE_JPEG_QUALITY, 90),
+    "webp": (".webp", "image/webp", cv2.IMWRITE_WEBP_QUALITY, 85),
+    "png": (".png", "image/png", None, None),
+}
+PRESETS = {
+    # Etsy: 2000 px listing photo, 1000 px WebP for our own gallery, 570 px wide search thumbnail
+    "etsy": [
+        {"name": "listing", "long_edge": 2000, "format": "jpeg", "quality": 90},
+        {"name": "preview", "long_edge": 1000, "format": "webp", "quality": 85},
+        {"name": "thumbnail", "width": 570, "format": "jpeg", "quality": 85},
+    ],
+}
+EXPORT_THREADS = max(1, min(4, int(os.environ.get("MOCKUP_EXPORT_THREADS", os.cpu_count() or 1))))
+
+_POOL = {"executor": None}
+
+
+def _executor():
+    if _POOL["executor"] is None:
+        _POOL["executor"] = ThreadPoolExecutor(EXPORT_THREADS, thread_name_prefix="export")
+    return _POOL["executor"]
+
+
+def submit(fn, *args):
+    """Run fn on the export pool with the caller's stage timings"""
+    return _executor().submit(contextvars.copy_context().run, fn, *args)
+
+
+def parse_exports(spec):
+    """Validated export list from a preset name, a JSON string or an already parsed list"""
+    if isinstance(spec, str):
+        spec = spec.strip()
+        if spec in PRESETS:
+            return [dict(e) for e in PRESETS[spec]]
+        try:
+            spec = json.loads(spec)
+        except ValueError as e:
+            raise ValueError(f"exports: not a preset ({', '.join(PRESETS)}) or a JSON list: {e}")
+    if not isinstance(spec, list) or not spec:
+        raise ValueError("exports: expected a non-empty list")
+    exports, names = [], set()
+    for i, item in enumerate(spec):
+        if not isinstance(item, dict):
+            raise ValueError(f"exports[{i}]: expected an object")
+        fmt = str(item.get("format", "jpeg")).lower().replace("jpg", "jpeg")
+        if fmt not in FORMATS:
+            raise ValueError(f"exports[{i}]: format must be one of {', '.join(FORMATS)}")
+        sizes = [k for k in ("long_edge", "width") if item.get(k)]
+        if len(sizes) != 1:
+            raise ValueError(f"exports[{i}]: give exactly one of long_edge or width")
+        size = int(item[sizes[0]])
+        if size < 1:
+            raise ValueError(f"exports[{i}]: {sizes[0]} must be positive")
+        name = str(item.get("name") or f"{fmt}_{size}")
+        if name in names:
+            raise ValueError(f"exports[{i}]: duplicate name '{name}'")
+        names.add(name)
+        export = {"name": name, "format": fmt, sizes[0]: size}
+        if FORMATS[fmt][2] is not None:
+            export["quality"] = max(1, min(100, int(item.get("quality", FORMATS[fmt][3]))))
+        exports.append(export)
+    return exports
+
+
+def target_size(w, h, export):
+    """(w, h) of an export of a w x h frame; never larger than the frame"""
+    scale = export["width"] / w if "width" in export else export["long_edge"] / max(w, h)
+    if scale >= 1:
+        return w, h
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+
+def reduce_factor(w, h, exports):
+    """Largest whole factor the frame can be box-averaged by and still cover every export"""
+    tw, th = max((target_size(w, h, e) for e in exports), key=lambda s: s[0] * s[1])
+    return max(1, min(w // tw, h // th))
+
+
+def reduce_frame(frame, factor):
+    """Box-average a frame by a whole factor (the last factor-1 rows/columns at most are dropped)"""
+    if factor == 1:
+        return frame
+    h, w = frame.shape[:2]
+    with stage("resize"):
+        return cv2.resize(frame[:h - h % factor, :w - w % factor], (w // factor, h // factor),
+                          interpolation=cv2.INTER_AREA)
+
+
+class StripReducer:
+    """reduce_frame for a frame arriving as strips; feed() passes the strips on unchanged"""
+
+    def __init__(self, w, h, factor):
+        self.factor = factor
+        self.width = w - w % factor
+        self.rows = (h - h % factor) // factor
+        self.frame = np.empty((self.rows, self.width // factor, 4), dtype=np.uint8)
+        self._done = 0
+        self._carry = None
+
+    def add(self, strip):
+        if self._carry is not None:
+            strip = np.concatenate([self._carry, strip])
+            self._carry = None
+        rows = min(strip.shape[0] // self.factor, self.rows - self._done)
+        if rows:
+            with stage("resize"):
+                self.frame[self._done:self._done + rows] = cv2.resize(
+                    strip[:rows * self.factor, :self.width], (self.width // self.factor, rows),
+                    interpolation=cv2.INTER_AREA)
+            self._done += rows
+        if self._done < self.rows and strip.shape[0] > rows * self.factor:
+            self._carry = strip[rows * self.factor:].copy()
+
+    def feed(self, strips):
+        for strip in strips:
+            self.add(strip)
+            yield strip
+
+    def result(self):
+        if self._done != self.rows:
+            raise ValueError(f"Got {self._done} of {self.rows} reduced rows")
+        return self.frame
+
+
+def _encode(img, export):
+    ext, _, flag, _ = FORMATS[export["format"]]
+    with stage("encode"):
+        if img.ndim == 3 and img.shape[2] == 4:
+            if img[..., 3].min() == 255:
+                img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)  # opaque: no alpha channel to store
+            elif export["format"] == "jpeg":
+                alpha = img[..., 3:].astype(np.float32) / 255.0
+                img = (img[..., :3] * alpha + 255.0 * (1.0 - alpha) + 0.5).astype(np.uint8)
+        params = [flag, export["quality"]] if flag is not None else [cv2.IMWRITE_PNG_COMPRESSION, 6]
+        ok, buf = cv2.imencode(ext, img, params)
+    if not ok:
+        raise ValueError(f"Could not encode export '{export['name']}' as {export['format']}")
+    return buf.tobytes()
+
+
+def render_exports(level, frame_size, exports):
+    """Encoded exports from a reduced frame (reduce_frame/StripReducer) of a frame_size (w, h) frame
+
+    Returns dicts in spec order: name, format, mime, width, height, data (bytes).
+    """
+    w, h = frame_size
+    order = sorted(exports, key=lambda e: target_size(w, h, e)[0], reverse=True)
+    pending = {}
+    source = level
+    for export in order:
+        tw, th = target_size(w, h, export)
+        if (source.shape[1], source.shape[0]) != (tw, th):
+            with stage("resize"):
+                source = cv2.resize(source, (tw, th), interpolation=cv2.INTER_AREA)
+        pending[export["name"]] = (submit(_encode, source, export), tw, th)
+    results = []
+    for export in exports:
+        future, tw, th = pending[export["name"]]
+        results.append({"name": export["name"], "format": export["format"], "mime": FORMATS[export["format"]][1],
+                        "width": tw, "height": th, "data": future.result()})
+    return results
+
+
+def export_frame(frame, exports):
+    """Exports of a full BGRA frame already in memory"""
+    h, w = frame.shape[:2]
+    return render_exports(reduce_frame(frame, reduce_factor(w, h, exports)), (w, h), exports)
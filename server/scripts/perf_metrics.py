@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Perf Metrics - per-stage timings for the Python services
+Code wraps each stage (decode, fit, warp, blend, encode, upstream API, ...) in
+stage(); every observation feeds a Prometheus histogram and, while a request is
+being handled, that request's timings dict, which becomes its Server-Timing
+header (or the 'timings' field in batch_mockup.py output).
+
+Histograms are per process: with prefork workers each worker reports its own.
+Overhead is two perf_counter calls and a dict update per stage.
+
+instrument_app also wires up opt-in per-request profiling (see perf_profile.py)
+and gauges for event-loop lag (how late a 100 ms timer fires: blocking calls on
+the loop show up here) and resident memory.
+"""
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+import perf_profile
+
+# Histogram buckets in seconds (1 ms .. 60 s)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRIC = "mockup_stage_duration_seconds"
+
+_SERVICE = {"name": "python"}
+_HISTOGRAMS = {}  # (service, stage) -> [bucket counts..., +Inf count], sum
+_LOCK = threading.Lock()
+_CURRENT = contextvars.ContextVar("perf_timings", default=None)
+LOOP_LAG_INTERVAL = 0.1
+_LOOP_LAG = {"last": 0.0, "max": 0.0}
+_RENDERERS = []  # extra /metrics sections, e.g. the upstream limiter
+
+
+def set_service(name):
+    """Service label for this process's metrics"""
+    _SERVICE["name"] = name
+
+
+def start_request(timings=None):
+    """Start collecting stage timings for the current request or task; returns the dict (stage -> ms)
+
+    Pass an earlier dict to resume collecting into it.
+    """
+    if timings is None:
+        timings = {}
+    _CURRENT.set(timings)
+    return timings
+
+
+def current_timings():
+    return _CURRENT.get()
+
+
+def observe(stage_name, seconds):
+    """Record one stage duration (histogram + current request timings)"""
+    key = (_SERVICE["name"], stage_name)
+    with _LOCK:
+        hist = _HISTOGRAMS.get(key)
+        if hist is None:
+            hist = _HISTOGRAMS[key] = [[0] * (len(BUCKETS) + 1), 0.0]
+        counts = hist[0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        hist[1] += seconds
+    timings = _CURRENT.get()
+    if timings is not None:
+        timings[stage_name] = round(timings.get(stage_name, 0.0) + seconds * 1000.0, 2)
+
+
+@contextmanager
+def stage(stage_name):
+    """Time the enclosed block as one stage; repeated stages in a request add up"""
+    profile = perf_profile.active()
+    if profile is not None:
+        profile.track_thread()
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage_name, time.perf_counter() - t0)
+        if profile is not None:
+            profile.stage_done(stage_name)
+
+
+def server_timing(timings):
+    """Server-Timing header value for a timings dict"""
+    return ", ".join(f"{name};dur={ms:.1f}" for name, ms in timings.items())
+
+
+def render_prometheus():
+    """All histograms in the Prometheus text exposition format"""
+    lines = [f"# HELP {METRIC} Time spent per processing stage",
+             f"# TYPE {METRIC} histogram"]
+    with _LOCK:
+        items = sorted((k, [list(v[0]), v[1]]) for k, v in _HISTOGRAMS.items())
+    for (service, stage_name), (counts, total) in items:
+        labels = f'service="{service}",stage="{stage_name}"'
+        cumulative = 0
+        for bound, count in zip(BUCKETS, counts):
+            cumulative += count
+            lines.append(f'{METRIC}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        cumulative += counts[-1]
+        lines.append(f'{METRIC}_bucket{{{labels},le="+Inf"}} {cumulative}')
+        lines.append(f"{METRIC}_sum{{{labels}}} {total:.6f}")
+        lines.append(f"{METRIC}_count{{{labels}}} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+def register_metrics(render):
+    """Append render() (Prometheus text) to this process's /metrics"""
+    _RENDERERS.append(render)
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def render_gauges():
+    """Event-loop lag and resident memory gauges (services only)"""
+    lines = ["# HELP event_loop_lag_seconds Delay of the last event-loop timer tick",
+             "# TYPE event_loop_lag_seconds gauge",
+             f'event_loop_lag_seconds{{service="{_SERVICE["name"]}"}} {_LOOP_LAG["last"]:.6f}',
+             "# HELP event_loop_lag_max_seconds Largest event-loop timer delay since start",
+             "# TYPE event_loop_lag_max_seconds gauge",
+             f'event_loop_lag_max_seconds{{service="{_SERVICE["name"]}"}} {_LOOP_LAG["max"]:.6f}']
+    rss = _rss_bytes()
+    if rss is not None:
+        lines += ["# HELP process_resident_memory_bytes Resident memory size in bytes",
+                  "# TYPE process_resident_memory_bytes gauge",
+                  f"process_resident_memory_bytes {rss}"]
+    return "\n".join(lines) + "\n"
+
+
+async def watch_loop_lag(interval=LOOP_LAG_INTERVAL):
+    """Sleep interval on the event loop forever, recording how late each wake-up is"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - t0 - interval)
+        _LOOP_LAG["last"] = lag
+        _LOOP_LAG["max"] = max(_LOOP_LAG["max"], lag)
+
+
+def instrument_app(app, service):
+    """Add a per-request timings middleware (Server-Timing header), GET /metrics and,
+    when PERF_PROFILE_TOKEN is set, GET /profiles/{name} to a FastAPI app"""
+    import re
+    from fastapi import Request
+    from fastapi.responses import FileResponse, PlainTextResponse
+
+    set_service(service)
+
+    async def _start_lag_watch():
+        import asyncio
+        app.state.loop_lag_task = asyncio.get_running_loop().create_task(watch_loop_lag())
+
+    app.on_event("startup")(_start_lag_watch)
+
+    @app.middleware("http")
+    async def _stage_timings(request, call_next):
+        timings = start_request()
+        holder = None
+        if request.url.path.startswith(("/metrics", "/profiles/")):
+            pass
+        elif perf_profile.header_enabled(request.headers.get(perf_profile.PROFILE_HEADER)):
+            holder = perf_profile.arm()
+            perf_profile.request_profile(f"{service} {request.method} {request.url.path}")
+        elif perf_profile.PROFILE_FORM:
+            holder = perf_profile.arm()  # the endpoint starts it if the form asks
+        t0 = time.perf_counter()
+        try:
+            response = await call_next(request)
+        finally:
+            summary = perf_profile.finish(holder, timings, {"path": request.url.path}) if holder else None
+        observe("request", time.perf_counter() - t0)
+        response.headers["Server-Timing"] = server_timing(timings)
+        if summary is not None:
+            response.headers["X-Profile-Id"] = summary["id"]
+        return response
+
+    @app.get("/profiles/{name}", include_in_schema=False)
+    def profile_artifact(name: str, request: Request):
+        # Same token as X-Profile; artifacts never leave the box otherwise
+        if not perf_profile.header_enabled(request.headers.get(perf_profile.PROFILE_HEADER)) \
+                or not re.fullmatch(r"[\w-]+\.(json|folded|tracemalloc)", name):
+            return PlainTextResponse("Not found", status_code=404)
+        path = os.path.join(perf_profile.PROFILE_DIR, name)
+        if not os.path.isfile(path):
+            return PlainTextResponse("Not found", status_code=404)
+        return FileResponse(path)
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics():
+        text = render_prometheus() + render_gauges() + "".join(render() for render in _RENDERERS)
+        return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+    return app
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""
+Perf Profile - opt-in profiling of a single request or batch run
+A profiled request gets a sampling profile of the threads doing its work and
+tracemalloc peak-memory accounting per stage; the artifacts land in PROFILE_DIR:
+
+    <id>.json        summary: timings, per-stage peak memory, top functions, top allocations
+    <id>.folded      collapsed stacks (flamegraph.pl / speedscope)
+    <id>.tracemalloc snapshot taken at the largest peak (tracemalloc.Snapshot.load)
+
+Off by default. Requests opt in with the header "X-Profile: <PERF_PROFILE_TOKEN>"
+(needs the token set) or, where PERF_PROFILE_FORM=1, a profile=true form field;
+batch_mockup.py with --profile-dir. When nothing asks for a profile the only
+cost is a ContextVar lookup per stage.
+
+The sampler walks sys._current_frames() for every thread the request ran a
+stage on, so work handed to a thread pool is included. tracemalloc is process
+wide: concurrent requests show up in the memory numbers, and one profile runs
+at a time (a second request asking for one is served unprofiled). It sees Python
+and numpy allocations but not Pillow's or OpenCV's own buffers, so on Linux each
+stage also records the process's peak RSS (VmHWM, reset at every stage boundary).
+
+Environment:
+    PERF_PROFILE_TOKEN         header value that enables profiling (unset = header ignored)
+    PERF_PROFILE_FORM          honour the profile form field (default off)
+    PERF_PROFILE_DIR           artifact directory (default /tmp/mockup-profiles)
+    PERF_PROFILE_INTERVAL_MS   sampling interval (default 5)
+    PERF_PROFILE_TRACE_FRAMES  tracemalloc traceback depth (default 10)
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import tracemalloc
+import contextvars
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+
+PROFILE_TOKEN = os.environ.get("PERF_PROFILE_TOKEN", "")
+PROFILE_FORM = os.environ.get("PERF_PROFILE_FORM", "").lower() in ("1", "true", "yes")
+PROFILE_DIR = os.environ.get("PERF_PROFILE_DIR", "/tmp/mockup-profiles")
+PROFILE_INTERVAL = float(os.environ.get("PERF_PROFILE_INTERVAL_MS", "5")) / 1000.0
+TRACE_FRAMES = int(os.environ.get("PERF_PROFILE_TRACE_FRAMES", "10"))
+PROFILE_HEADER = "X-Profile"
+TOP_N = 30
+
+_ACTIVE = contextvars.ContextVar("perf_profile", default=None)  # holder dict: {"session": Profile | None}
+_BUSY = threading.Lock()  # one profiled request per process
+
+
+def header_enabled(value):
+    """True when a request's X-Profile header value matches PERF_PROFILE_TOKEN"""
+    return bool(PROFILE_TOKEN) and value == PROFILE_TOKEN
+
+
+def _max_rss():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # kB on Linux
+
+
+def _reset_rss_peak():
+    """Reset VmHWM so the next reading covers only what follows; False where unsupported"""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def rss_peak():
+    """Peak RSS in bytes since the last reset (VmHWM), or None off Linux"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class Profile:
+    """Sampling profiler + tracemalloc accounting for the threads of one request"""
+
+    def __init__(self, label, out_dir=None):
+        self.id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.label = label
+        self.out_dir = Path(out_dir or PROFILE_DIR)
+        self.threads = set()
+        self.stacks = Counter()
+        self.samples = 0
+        self.memory = {}  # stage -> peak traced bytes since the previous stage boundary
+        self.rss = {}  # stage -> peak RSS since the previous stage boundary
+        self._track_rss = False
+        self.peak = 0
+        self.peak_stage = None
+        self.snapshot = None
+        self._stop = threading.Event()
+        self._sampler = None
+        self._owns_tracemalloc = False
+        self._t0 = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACE_FRAMES)
+            self._owns_tracemalloc = True
+        tracemalloc.reset_peak()
+        self._track_rss = _reset_rss_peak()
+        self.track_thread()
+        self._t0 = time.perf_counter()
+        self._sampler = threading.Thread(target=self._sample, name="perf-profile", daemon=True)
+        self._sampler.start()
+        return self
+
+    def track_thread(self):
+        self.threads.add(threading.get_ident())
+
+    def _sample(self):
+        while not self._stop.wait(PROFILE_INTERVAL):
+            frames = sys._current_frames()
+            for tid in tuple(self.threads):
+                frame = frames.get(tid)
+                if frame is None:
+                    continue
+                names = []
+                while frame is not None:
+                    names.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(names))] += 1
+                self.samples += 1
+
+    def stage_done(self, stage_name):
+        """Attribute the tracemalloc peak since the last boundary to this stage"""
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        self.memory[stage_name] = max(self.memory.get(stage_name, 0), peak)
+        if self._track_rss:
+            self.rss[stage_name] = max(self.rss.get(stage_name, 0), rss_peak() or 0)
+            _reset_rss_peak()
+        if peak > self.peak:
+            self.peak, self.peak_stage = peak, stage_name
+            self.snapshot = tracemalloc.take_snapshot()
+
+    def _top_functions(self):
+        self_counts, total_counts = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            self_counts[frames[-1]] += count
+            for name in set(frames):
+                total_counts[name] += count
+        return ([{"function": f, "samples": n} for f, n in self_counts.most_common(TOP_N)],
+                [{"function": f, "samples": n} for f, n in total_counts.most_common(TOP_N)])
+
+    def finish(self, timings=None, extra=None):
+        """Stop sampling and tracing, write the artifacts; returns the summary dict"""
+        self._stop.set()
+        self._sampler.join()
+        elapsed = time.perf_counter() - self._t0
+        self.stage_done("end")
+        if self._owns_tracemalloc:
+            tracemalloc.stop()
+
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        base = self.out_dir / self.id
+        with open(f"{base}.folded", "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        allocations = []
+        if self.snapshot is not None:
+            self.snapshot.dump(f"{base}.tracemalloc")
+            for stat in self.snapshot.statistics("lineno")[:TOP_N]:
+                frame = stat.traceback[0]
+                allocations.append({"location": f"{frame.filename}:{frame.lineno}",
+                                    "bytes": stat.size, "blocks": stat.count})
+        self_top, total_top = self._top_functions()
+        summary = {
+            "id": self.id,
+            "label": self.label,
+            "elapsed_ms": round(elapsed * 1000.0, 1),
+            "interval_ms": PROFILE_INTERVAL * 1000.0,
+            "samples": self.samples,
+            "threads": len(self.threads),
+            "timings": timings or {},
+            "peak_bytes": self.peak,
+            # VmHWM resets at stage boundaries, so the run's peak is the largest stage peak
+            "max_rss_bytes": max(self.rss.values()) if self.rss else _max_rss(),
+            "peak_stage": self.peak_stage,
+            "stage_peak_bytes": self.memory,
+            "stage_rss_peak_bytes": self.rss,
+            "top_self": self_top,
+            "top_total": total_top,
+            "top_allocations": allocations,
+        }
+        summary.update(extra or {})
+        tmp = Path(f"{base}.json.part")
+        tmp.write_text(json.dumps(summary, indent=2))
+        os.replace(tmp, f"{base}.json")
+        return summary
+
+
+def active():
+    """Profile for the current request, or None (the common case)"""
+    holder = _ACTIVE.get()
+    return holder["session"] if holder is not None else None
+
+
+def arm():
+    """Let the current request start a profile later (request_profile); returns the holder"""
+    holder = {"session": None}
+    _ACTIVE.set(holder)
+    return holder
+
+
+def request_profile(label):
+    """Start profiling the current request if it was armed; False when another profile is running
+
+    Used for the form field, which is only known inside the endpoint.
+    """
+    holder = _ACTIVE.get()
+    if holder is None or holder["session"] is not None:
+        return holder is not None
+    if not _BUSY.acquire(blocking=False):
+        return False
+    holder["session"] = Profile(label).start()
+    return True
+
+
+def finish(holder, timings=None, extra=None):
+    """Finish the holder's profile, if one was started; returns its summary or None"""
+    session = holder["session"] if holder is not None else None
+    if session is None:
+        return None
+    holder["session"] = None
+    try:
+        return session.finish(timings, extra)
+    finally:
+        _BUSY.release()
+
+
+@contextmanager
+def profiling(label, out_dir=None, timings=None):
+    """Profile the enclosed block (batch runs); yields the holder, summary in holder["summary"]"""
+    holder = arm()
+    if not _BUSY.acquire(blocking=False):
+        yield holder
+        return
+    holder["session"] = Profile(label, out_dir).start()
+    try:
+        yield holder
+    finally:
+        holder["summary"] = finish(holder, timings)
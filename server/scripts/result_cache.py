@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+"""
+Result Cache - content-addressed disk cache of composed template mockups
+Compositing is deterministic, so a mockup is keyed on the artwork bytes, the
+template's content fingerprint (manifest, background, mask; see
+template_store.template_fingerprint) and the compositing parameters. Editing a
+template changes its fingerprint, so stale entries are never served; they just
+age out.
+
+Entries are the encoded PNGs under <MOCKUP_CACHE_DIR>/<key[:2]>/<key>.png,
+written atomically and shared by every process (batch runs, API workers).
+Reads refresh the file's mtime; once the directory exceeds MOCKUP_CACHE_MB the
+least recently used entries are deleted. The key doubles as the ETag.
+
+Environment:
+    MOCKUP_CACHE_DIR   cache directory (default /tmp/mockup-cache, empty = disabled)
+    MOCKUP_CACHE_MB    size cap (default 1024)
+"""
+import os
+import json
+import struct
+import hashlib
+import threading
+from pathlib import Path
+
+CACHE_DIR = os.environ.get('MOCKUP_CACHE_DIR', '/tmp/mockup-cache')
+CACHE_BYTES = int(os.environ.get('MOCKUP_CACHE_MB', '1024')) * 1024 * 1024
+# Bump when compositing output changes for the same inputs
+CACHE_VERSION = 1
+EVICT_TO = 0.9  # evict down to this fraction of the cap
+
+_STATE = {"bytes": None}
+_LOCK = threading.Lock()
+
+
+def enabled():
+    return bool(CACHE_DIR) and CACHE_BYTES > 0
+
+
+def artwork_hash(data):
+    """sha256 of the artwork bytes as uploaded (or raw pixels as passed)"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def result_key(art_hash, fingerprint, fit="cover", margin_px=0, feather_px=None, opacity=None,
+               preview_long_edge=0, remove_background=False):
+    """Cache key (and ETag) for one artwork x template x parameter set
+
+    feather_px/opacity of None mean "manifest value"; the batch path and
+    /mockup/apply normalise to the same key for the same output.
+    """
+    params = {
+        "v": CACHE_VERSION,
+        "art": art_hash,
+        "template": fingerprint,
+        "fit": fit,
+        "margin_px": int(margin_px),
+        "feather_px": None if feather_px is None else float(feather_px),
+        "opacity": None if opacity is None else float(opacity),
+        "preview_long_edge": int(preview_long_edge or 0),
+        "remove_background": bool(remove_background),
+    }
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def etag(key):
+    return f'"{key}"'
+
+
+def png_size(data):
+    """(w, h) of PNG bytes, from the IHDR chunk"""
+    return struct.unpack(">II", data[16:24])
+
+
+def _path(key):
+    return Path(CACHE_DIR) / key[:2] / f"{key}.png"
+
+
+def get(key):
+    """Cached PNG bytes or None"""
+    if not enabled():
+        return None
+    path = _path(key)
+    try:
+        data = path.read_bytes()
+    except OSError:
+        return None
+    try:
+        os.utime(path)  # LRU order is mtime order
+    except OSError:
+        pass
+    return data
+
+
+def _entries():
+    root = Path(CACHE_DIR)
+    if not root.is_dir():
+        return []
+    found = []
+    for sub in root.iterdir():
+        if not sub.is_dir():
+            continue
+        for f in sub.iterdir():
+            if f.suffix == ".png":
+                try:
+                    st = f.stat()
+                except OSError:
+                    continue
+                found.append((st.st_mtime, st.st_size, f))
+    return found
+
+
+def _evict():
+    """Delete least recently used entries until under EVICT_TO of the cap"""
+    entries = sorted(_entries(), key=lambda e: e[0])
+    total = sum(size for _, size, _ in entries)
+    target = CACHE_BYTES * EVICT_TO
+    for _, size, f in entries:
+        if total <= target:
+            break
+        try:
+            f.unlink()
+            total -= size
+        except OSError:
+            pass
+    return total
+
+
+def put(key, data):
+    """Store PNG bytes; never raises (a full or read-only disk must not fail the mockup)"""
+    if not enabled():
+        return
+    path = _path(key)
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.part")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        with _LOCK:
+            if _STATE["bytes"] is None:
+                _STATE["bytes"] = sum(size for _, size, _ in _entries())
+            else:
+                _STATE["bytes"] += len(data)
+            # Other processes write here too: the running total is an estimate,
+            # corrected by the rescan in _evict
+            if _STATE["bytes"] > CACHE_BYTES:
+                _STATE["bytes"] = _evict()
+    except OSError:
+        pass
+
+
+def info():
+    """Entry count and bytes on disk"""
+    entries = _entries() if enabled() else []
+    return {"dir": CACHE_DIR, "entries": len(entries), "bytes": sum(s for _, s, _ in entries),
+            "cap_bytes": CACHE_BYTES}
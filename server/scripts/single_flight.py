@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Single Flight - coalesce identical in-flight jobs
+Double clicks, frontend retries and proxy retries resend the same artwork with
+the same parameters while the first request is still running. Keyed on the
+artwork's content hash plus the normalized parameters, the first request runs
+the job and later identical requests attach to it and share its result (or its
+exception). Nothing is cached: once the job finishes the key is forgotten.
+
+The job runs as its own task, so a caller that goes away does not cancel it for
+the others; once every caller has gone, the job's deadline is cancelled and the
+job stops at its next check. Per process: prefork workers each coalesce their
+own requests.
+"""
+import json
+import asyncio
+import hashlib
+
+from perf_metrics import stage
+from deadlines import wait_unless_disconnected
+
+
+def request_key(content, **params):
+    """sha256 of the content plus the parameters (order-insensitive)
+
+    content is the bytes, or their sha256 hex digest when already computed
+    (upload_ingest hashes uploads while they stream in).
+    """
+    h = hashlib.sha256(content.encode("ascii") if isinstance(content, str) else content)
+    h.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+def _forget_result(task):
+    # Mark an exception as retrieved when every caller has gone away
+    if not task.cancelled():
+        task.exception()
+
+
+class SingleFlight:
+    """In-flight jobs of one event loop, by key"""
+
+    def __init__(self):
+        self._inflight = {}
+        self.stats = {"leaders": 0, "followers": 0}
+
+    async def run(self, key, job, deadline=None, request=None):
+        """Await job() once per key at a time; concurrent callers with the key share the outcome
+
+        job is a zero-argument callable returning an awaitable. deadline is the
+        Deadline job() works under (the first caller's); later callers widen it
+        to theirs. With request, a caller whose client disconnects stops
+        waiting with deadlines.Cancelled, and when no caller is left the
+        deadline is cancelled.
+        """
+        entry = self._inflight.get(key)
+        leader = entry is None
+        if leader:
+            self.stats["leaders"] += 1
+            task = asyncio.ensure_future(job())
+            entry = self._inflight[key] = {"task": task, "callers": 0, "deadline": deadline}
+            task.add_done_callback(lambda t: self._inflight.pop(key, None))
+            task.add_done_callback(_forget_result)
+        else:
+            self.stats["followers"] += 1
+            if entry["deadline"] is not None:
+                entry["deadline"].extend(deadline)
+        entry["callers"] += 1
+        try:
+            if leader:
+                return await self._wait(entry, request)
+            # Shows up as "coalesced" in the follower's Server-Timing
+            with stage("coalesced"):
+                return await self._wait(entry, request)
+        finally:
+            entry["callers"] -= 1
+            if entry["callers"] == 0 and not entry["task"].done() and entry["deadline"] is not None:
+                entry["deadline"].cancel("every caller left")
+
+    @staticmethod
+    async def _wait(entry, request):
+        waiter = asyncio.shield(entry["task"])
+        if request is None:
+            return await waiter
+        return await wait_unless_disconnected(request, waiter, entry["deadline"])
+
+    def __len__(self):
+        return len(self._inflight)
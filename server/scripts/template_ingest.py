@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+Template Ingest - detect the artwork quad from an admin-uploaded mask and
+precompile everything the compositor needs (raw background, preview tier, ROI
+geometry) so a new template serves hot from its first request.
+
+The quad is found at the mask's native resolution and the corner coordinates are
+scaled to the background, instead of upsampling the mask pixels first.
+
+Usage:
+    template_ingest.py <template_dir> --mask <mask_path> [--manifest '<json>'] [--preview 512]
+
+Prints {"manifest": {...}, "corners_detected": bool, ...} as JSON.
+"""
+import sys
+import json
+import os
+import argparse
+from pathlib import Path
+import numpy as np
+import cv2
+from PIL import Image
+
+from template_store import compile_template, DEFAULT_PREVIEW_TIERS
+
+MASK_NAME = "mask.png"
+BG_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+
+
+def _order_corners(pts):
+    """Sort 4 points into TL, TR, BR, BL"""
+    sorted_by_y = pts[np.argsort(pts[:, 1])]
+    top_sorted = sorted_by_y[:2][np.argsort(sorted_by_y[:2][:, 0])]
+    bottom_sorted = sorted_by_y[2:][np.argsort(sorted_by_y[2:][:, 0])]
+    tl, tr = top_sorted
+    bl, br = bottom_sorted
+    return np.array([tl, tr, br, bl], dtype=np.float32)
+
+
+def _refine_corners(binary, corners):
+    """Subpixel corner refinement; keeps the original point if refinement wanders off"""
+    h, w = binary.shape
+    win = max(1, min(5, h // 8, w // 8))
+    smooth = cv2.GaussianBlur(binary, (3, 3), 0).astype(np.float32)
+    refined = corners.reshape(-1, 1, 2).copy()
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 40, 0.01)
+    cv2.cornerSubPix(smooth, refined, (win, win), (-1, -1), criteria)
+    refined = refined.reshape(-1, 2)
+    moved = np.linalg.norm(refined - corners, axis=1)
+    return np.where((moved <= win)[:, None], refined, corners)
+
+
+def detect_corners(mask, bg_size):
+    """Detect the 4 corners of the white region in the mask
+
+    Args:
+        mask: Grayscale uint8 mask at its native resolution
+        bg_size: (width, height) of the background the corners are for
+
+    Returns:
+        [[x, y] x4] in background coordinates (TL, TR, BR, BL)
+    """
+    mask_h, mask_w = mask.shape[:2]
+    _, binary = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)
+
+    contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        raise ValueError("No contours found in mask")
+
+    largest_contour = max(contours, key=cv2.contourArea)
+    epsilon = 0.02 * cv2.arcLength(largest_contour, True)
+    approx = cv2.approxPolyDP(largest_contour, epsilon, True)
+
+    if len(approx) == 4:
+        corners = _refine_corners(binary, _order_corners(approx.reshape(4, 2).astype(np.float32)))
+    else:
+        # Not a clean quad: fall back to the bounding rectangle
+        x, y, w, h = cv2.boundingRect(largest_contour)
+        corners = np.array([[x, y], [x + w, y], [x + w, y + h], [x, y + h]], dtype=np.float32)
+
+    bg_w, bg_h = bg_size
+    corners = corners * np.array([bg_w / float(mask_w), bg_h / float(mask_h)], dtype=np.float32)
+    return [[round(float(x), 2), round(float(y), 2)] for x, y in corners]
+
+
+def _default_corners(bg_size):
+    bg_w, bg_h = bg_size
+    return [
+        [round(bg_w * 0.2), round(bg_h * 0.2)],
+        [round(bg_w * 0.8), round(bg_h * 0.2)],
+        [round(bg_w * 0.8), round(bg_h * 0.8)],
+        [round(bg_w * 0.2), round(bg_h * 0.8)],
+    ]
+
+
+def _find_background(tdir, manifest):
+    name = manifest.get("background")
+    if name and (tdir / name).exists():
+        return tdir / name
+    for cand in sorted(tdir.iterdir()):
+        if cand.is_file() and cand.suffix.lower() in BG_EXTS and cand.stem.lower().startswith("background"):
+            return cand
+    raise ValueError(f"No background image found in {tdir}")
+
+
+def ingest_template(template_dir, mask_path=None, fields=None, preview_edges=()):
+    """Detect corners, write manifest.json and compile the template's cache artifacts
+
+    Args:
+        template_dir: templates/<room>/<template_id>
+        mask_path: Uploaded mask (white = artwork area); stored as mask.png
+        fields: Manifest fields to set (name, blend, feather_px, ...)
+        preview_edges: Preview tiers to compile
+
+    Returns:
+        {"manifest", "corners_detected", "compiled", ["warning"]}
+    """
+    tdir = Path(template_dir)
+    manifest_path = tdir / "manifest.json"
+    manifest = json.loads(manifest_path.read_text()) if manifest_path.exists() else {}
+    manifest.update(fields or {})
+
+    bg_path = _find_background(tdir, manifest)
+    with Image.open(bg_path) as P:
+        bg_size = P.size  # header only, no decode
+
+    result = {"corners_detected": False}
+    if mask_path:
+        mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
+        if mask is None:
+            result["warning"] = "Failed to load mask image"
+        else:
+            try:
+                manifest["corners"] = detect_corners(mask, bg_size)
+                result["corners_detected"] = True
+            except ValueError as e:
+                result["warning"] = str(e)
+            stored_mask = tdir / MASK_NAME
+            if Path(mask_path).resolve() != stored_mask.resolve():
+                cv2.imwrite(str(stored_mask), mask)
+            manifest["mask"] = MASK_NAME
+    if not result["corners_detected"] and (mask_path or not manifest.get("corners")):
+        manifest["corners"] = _default_corners(bg_size)
+
+    manifest["background"] = bg_path.name
+    manifest["width"], manifest["height"] = bg_size
+    tmp = manifest_path.with_name("manifest.json.part")
+    tmp.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp, manifest_path)
+
+    result["compiled"] = compile_template(tdir.parent.name, tdir.name, tdir.parent.parent, preview_edges)
+    result["manifest"] = manifest
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Detect template corners and precompile cache artifacts")
+    parser.add_argument("template_dir")
+    parser.add_argument("--mask", help="Mask image (white = artwork area)")
+    parser.add_argument("--manifest", default="{}", help="Manifest fields as JSON")
+    parser.add_argument("--preview", default=DEFAULT_PREVIEW_TIERS, help="Preview tiers, e.g. 512,1024")
+    args = parser.parse_args()
+
+    try:
+        result = ingest_template(
+            args.template_dir, args.mask, json.loads(args.manifest),
+            [int(t) for t in args.preview.split(",") if t.strip()],
+        )
+    except Exception as e:
+        print(json.dumps({"error": str(e)}))
+        sys.exit(1)
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
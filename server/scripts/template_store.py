@@ -0,0 +1,570 @@
+#!/usr/bin/env python3
+"""
+Template Store - load template manifests and decoded backgrounds
+Long-lived processes (bulk workers, API servers) keep decoded templates cached so
+each background is decoded once per process instead of once per mockup.
+
+Backgrounds can also be converted offline to raw BGRA .npy files that are opened
+with np.memmap: no PNG decode, the OS page cache is shared by every process and
+compositing only faults in the pages under the quad ROI.
+
+A preview tier (background downscaled to a fixed long edge, with corners and
+feather scaled to match) makes full-gallery previews cheap; it is compiled
+alongside the raw background and memory-mapped the same way.
+
+A manifest "mask" (white = artwork visible, black = occluder such as a plant in
+front of the frame) is loaded once, cropped to its nonzero box and folded into
+the compiled ROI mask, so per-request blending never touches the full frame.
+
+Usage:
+    template_store.py build [templates_root] [--preview 512,1024]
+"""
+import sys
+import json
+import os
+import math
+import mmap
+import hashlib
+import threading
+from pathlib import Path
+import numpy as np
+import cv2
+from PIL import Image
+
+
+_CACHE = {}
+_CACHE_LOCK = threading.Lock()
+
+COMPILED_DIR = ".compiled"
+DEFAULT_PREVIEW_TIERS = os.environ.get('TEMPLATE_PREVIEW_TIERS', '512')
+
+
+def templates_root():
+    """Active templates root (TEMPLATES_PATH is set by the Node server in dev/prod)"""
+    return Path(os.environ.get('TEMPLATES_PATH', './templates'))
+
+
+def load_manifest(room, template_id, root=None):
+    """Load template manifest and validate paths"""
+    template_root = Path(root) if root is not None else templates_root()
+    room_dir = template_root / room
+    if not room_dir.exists():
+        raise Exception(f"Room folder not found: {room_dir}")
+    tdir = room_dir / template_id
+    if not tdir.exists():
+        raise Exception(f"Template '{template_id}' not found under {room_dir}")
+
+    mpath = tdir / "manifest.json"
+    if not mpath.exists():
+        raise Exception(f"manifest.json missing in {tdir}")
+
+    try:
+        manifest = json.loads(mpath.read_text())
+    except Exception as e:
+        raise Exception(f"manifest.json not valid JSON: {e}")
+
+    bg_name = manifest.get("background")
+    if not bg_name:
+        raise Exception("manifest.json missing 'background'")
+    bg_path = tdir / bg_name
+    if not bg_path.exists():
+        raise Exception(f"Background not found: {bg_path}")
+
+    corners = manifest.get("corners")
+    if not (isinstance(corners, list) and len(corners) == 4):
+        raise Exception("manifest.json 'corners' must be 4 points [TL,TR,BR,BL]")
+
+    return manifest, bg_path
+
+
+def _decode_background(bg_path):
+    """Decode background file to a BGRA uint8 array"""
+    with Image.open(bg_path) as P:
+        rgba = np.array(P.convert("RGBA"))
+    return cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA)
+
+
+def _sha1(path, nbytes=1 << 20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(nbytes)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _compiled_paths(bg_path):
+    """(raw .npy, stamp .json) paths for a background's compiled form"""
+    cdir = Path(bg_path).parent / COMPILED_DIR
+    stem = Path(bg_path).name
+    return cdir / f"{stem}.bgra.npy", cdir / f"{stem}.bgra.json"
+
+
+def _preview_path(bg_path, long_edge):
+    cdir = Path(bg_path).parent / COMPILED_DIR
+    return cdir / f"{Path(bg_path).name}.preview{int(long_edge)}.npy"
+
+
+def _fresh_stamp(bg_path):
+    """Build stamp if the raw background matches the current source file, else None
+
+    Size + mtime is the fast path; copies (e.g. into dist/) change mtimes, so a
+    size match falls back to comparing the source hash recorded at build time.
+    """
+    npy_path, stamp_path = _compiled_paths(bg_path)
+    if not (npy_path.exists() and stamp_path.exists()):
+        return None
+    try:
+        stamp = json.loads(stamp_path.read_text())
+    except ValueError:
+        return None
+    st = Path(bg_path).stat()
+    if stamp.get("size") != st.st_size:
+        return None
+    if stamp.get("mtime_ns") == st.st_mtime_ns:
+        return stamp
+    if stamp.get("sha1") != _sha1(bg_path):
+        return None
+    try:
+        stamp["mtime_ns"] = st.st_mtime_ns
+        stamp_path.write_text(json.dumps(stamp))
+    except OSError:
+        pass  # read-only template dir; the hash check keeps working
+    return stamp
+
+
+def _compiled_is_fresh(bg_path):
+    return _fresh_stamp(bg_path) is not None
+
+
+def _save_npy(path, arr):
+    tmp = path.with_name(path.name + ".part")
+    with open(tmp, "wb") as f:
+        np.save(f, arr)
+    os.replace(tmp, path)
+
+
+def _resize_long_edge(bg, long_edge):
+    """Area-downscale so the long edge is long_edge"""
+    h, w = bg.shape[:2]
+    s = long_edge / float(max(h, w))
+    size = (max(1, int(round(w * s))), max(1, int(round(h * s))))
+    return cv2.resize(np.asarray(bg), size, interpolation=cv2.INTER_AREA)
+
+
+def compile_background(bg_path, preview_edges=()):
+    """Decode a background once and store it as raw BGRA .npy next to the template
+
+    preview_edges lists preview tiers (long edge in px) to compile as well.
+    Returns the .npy path.
+    """
+    npy_path, stamp_path = _compiled_paths(bg_path)
+    npy_path.parent.mkdir(exist_ok=True)
+    bg = _decode_background(bg_path)
+    _save_npy(npy_path, bg)
+    previews = sorted({int(e) for e in preview_edges if 0 < int(e) < max(bg.shape[:2])})
+    for long_edge in previews:
+        _save_npy(_preview_path(bg_path, long_edge), _resize_long_edge(bg, long_edge))
+    st = Path(bg_path).stat()
+    stamp_path.write_text(json.dumps({
+        "source": Path(bg_path).name,
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sha1": _sha1(bg_path),
+        "shape": list(bg.shape),
+        "previews": previews,
+    }))
+    return npy_path
+
+
+def _geometry_path(bg_path):
+    return Path(bg_path).parent / COMPILED_DIR / f"{Path(bg_path).name}.geometry.npz"
+
+
+def _mask_path(manifest, bg_path):
+    """Manifest occlusion mask path, or None when the template has none"""
+    name = manifest.get("mask")
+    if not name:
+        return None
+    path = Path(bg_path).parent / name
+    return path if path.exists() else None
+
+
+def template_fingerprint(room, template_id, root=None):
+    """Content fingerprint of a template (manifest, background, mask) for result caching
+
+    Reads the manifest and stats its files on every call, so edits show up
+    immediately. The background contributes the sha1 recorded when it was
+    compiled (stable across copies), or size + mtime when it is not compiled.
+    """
+    template_root = Path(root) if root is not None else templates_root()
+    tdir = template_root / room / template_id
+    manifest_bytes = (tdir / "manifest.json").read_bytes()
+    manifest = json.loads(manifest_bytes)
+    h = hashlib.sha256(manifest_bytes)
+    bg_path = tdir / manifest.get("background", "")
+    stamp = _fresh_stamp(bg_path) if bg_path.is_file() else None
+    if stamp is not None and stamp.get("sha1"):
+        h.update(f"bg:{stamp['sha1']}".encode())
+    else:
+        st = bg_path.stat()
+        h.update(f"bg:{st.st_size}:{st.st_mtime_ns}".encode())
+    mask_path = _mask_path(manifest, bg_path)
+    if mask_path is not None:
+        st = mask_path.stat()
+        h.update(f"mask:{st.st_size}:{st.st_mtime_ns}".encode())
+    return h.hexdigest()
+
+
+def _geometry_key(manifest, shape_hw, mask_path=None):
+    """Everything the compiled ROI mask depends on"""
+    key = {
+        'corners': manifest['corners'],
+        'feather_px': manifest.get('feather_px', 0),
+        'shape': [int(v) for v in shape_hw],
+    }
+    if mask_path is not None:
+        st = os.stat(mask_path)
+        key['mask'] = [Path(mask_path).name, st.st_size, st.st_mtime_ns]
+    return json.dumps(key, sort_keys=True)
+
+
+def _load_geometry(bg_path, key):
+    """Compiled (roi, mask, occlusion) if present and built for this geometry key, else None"""
+    path = _geometry_path(bg_path)
+    if not path.exists():
+        return None
+    try:
+        with np.load(path) as z:
+            if str(z['key']) != key:
+                return None
+            occlusion = None
+            if 'occ_roi' in z.files:
+                occlusion = tuple(int(v) for v in z['occ_roi']), z['occ_mask']
+            return tuple(int(v) for v in z['roi']), z['mask'], occlusion
+    except Exception:
+        return None
+
+
+def save_geometry(bg_path, key, roi, mask, occlusion=None):
+    """Persist compiled (roi, mask) and the cropped occlusion mask next to the raw background"""
+    path = _geometry_path(bg_path)
+    path.parent.mkdir(exist_ok=True)
+    tmp = path.with_name(path.name + ".part")
+    extra = {}
+    if occlusion is not None:
+        extra = {'occ_roi': np.array(occlusion[0], dtype=np.int64), 'occ_mask': occlusion[1]}
+    with open(tmp, "wb") as f:
+        np.savez(f, key=np.array(key), roi=np.array(roi, dtype=np.int64), mask=mask, **extra)
+    os.replace(tmp, path)
+
+
+def open_background(bg_path):
+    """BGRA background: memory-mapped raw file when compiled, PNG decode otherwise"""
+    if _compiled_is_fresh(bg_path):
+        npy_path, _ = _compiled_paths(bg_path)
+        return np.load(npy_path, mmap_mode="r")
+    return _decode_background(bg_path)
+
+
+def background_rows(bg, r0, r1):
+    """Copy of background rows r0:r1
+
+    Compiled backgrounds are read from the file rather than through the
+    mapping, so streaming through a large one leaves no mapped pages in this
+    process (they stay in the shared page cache).
+    """
+    if isinstance(bg, np.memmap) and isinstance(bg.base, mmap.mmap) and bg.flags.c_contiguous:
+        out = np.empty((r1 - r0,) + bg.shape[1:], dtype=bg.dtype)
+        row_bytes = out[0].nbytes if len(out) else 0
+        with open(bg.filename, "rb", buffering=0) as f:
+            f.seek(bg.offset + r0 * row_bytes)
+            if f.readinto(memoryview(out).cast("B")) != out.nbytes:
+                raise ValueError(f"Truncated background file {bg.filename}")
+        return out
+    return np.array(bg[r0:r1])
+
+
+def polygon_mask(shape_hw, polygon, feather_px):
+    """Create polygon mask with optional feathering"""
+    h, w = shape_hw
+    mask = np.zeros((h, w), dtype=np.uint8)
+    cv2.fillConvexPoly(mask, polygon.astype(np.int32), 255)
+    if feather_px and feather_px > 0:
+        k = max(1, int(round(feather_px)) | 1)
+        mask = cv2.GaussianBlur(mask, (k, k), 0)
+    return mask
+
+
+def load_occlusion(mask_path, shape_hw):
+    """Manifest mask at background size, cropped to its nonzero box
+
+    Returns ((x0, y0, x1, y1), mask) with a uint8 mask of the box's shape.
+    """
+    mask = cv2.imread(str(mask_path), cv2.IMREAD_GRAYSCALE)
+    if mask is None:
+        raise Exception(f"Failed to load template mask: {mask_path}")
+    h, w = shape_hw
+    if mask.shape[:2] != (h, w):
+        interp = cv2.INTER_AREA if mask.shape[0] * mask.shape[1] > h * w else cv2.INTER_LINEAR
+        mask = cv2.resize(mask, (w, h), interpolation=interp)
+    return _crop_nonzero(mask, (0, 0))
+
+
+def scale_occlusion(occlusion, sx, sy, shape_hw):
+    """Cropped occlusion mask rescaled to a preview-sized background"""
+    (x0, y0, x1, y1), mask = occlusion
+    h, w = shape_hw
+    px0, py0 = int(x0 * sx), int(y0 * sy)
+    px1, py1 = min(w, int(math.ceil(x1 * sx))), min(h, int(math.ceil(y1 * sy)))
+    if px1 <= px0 or py1 <= py0:
+        return None
+    scaled = cv2.resize(mask, (px1 - px0, py1 - py0), interpolation=cv2.INTER_AREA)
+    return (px0, py0, px1, py1), scaled
+
+
+def _crop_nonzero(mask, origin):
+    """Shrink a mask (placed at origin) to the bounding box of its nonzero pixels"""
+    x, y, w, h = cv2.boundingRect(cv2.findNonZero(mask)) if cv2.countNonZero(mask) else (0, 0, 0, 0)
+    if w == 0 or h == 0:
+        raise Exception("Template mask leaves no visible artwork area")
+    ox, oy = origin
+    return (ox + x, oy + y, ox + x + w, oy + y + h), np.ascontiguousarray(mask[y:y + h, x:x + w])
+
+
+def compile_geometry(quad, feather_px, shape_hw, occlusion=None):
+    """Region of interest around the quad and its feathered mask
+
+    Compositing only touches pixels inside the ROI; it is padded by the feather
+    kernel radius so the blurred mask is identical to a full-frame one, then
+    trimmed to the mask's nonzero box. An occlusion from load_occlusion is
+    multiplied in.
+
+    Returns ((x0, y0, x1, y1), mask) where mask has the ROI's shape.
+    """
+    h, w = shape_hw
+    k = max(1, int(round(feather_px)) | 1) if feather_px and feather_px > 0 else 1
+    pad = k // 2 + 2
+    ipoly = quad.astype(np.int32)
+    x0 = max(0, int(ipoly[:, 0].min()) - pad)
+    y0 = max(0, int(ipoly[:, 1].min()) - pad)
+    x1 = min(w, int(ipoly[:, 0].max()) + pad + 1)
+    y1 = min(h, int(ipoly[:, 1].max()) + pad + 1)
+    if x1 <= x0 or y1 <= y0:
+        raise Exception("Template corners lie outside the background")
+    mask = polygon_mask((y1 - y0, x1 - x0), ipoly - np.array([x0, y0], dtype=np.int32), feather_px)
+    if occlusion is not None:
+        (ox0, oy0, ox1, oy1), occ = occlusion
+        ix0, iy0, ix1, iy1 = max(x0, ox0), max(y0, oy0), min(x1, ox1), min(y1, oy1)
+        if ix1 <= ix0 or iy1 <= iy0:
+            raise Exception("Template mask does not overlap the corners")
+        quad_part = mask[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0].astype(np.uint16)
+        occ_part = occ[iy0 - oy0:iy1 - oy0, ix0 - ox0:ix1 - ox0].astype(np.uint16)
+        mask = ((quad_part * occ_part + 127) // 255).astype(np.uint8)
+        x0, y0 = ix0, iy0
+    return _crop_nonzero(mask, (x0, y0))
+
+
+def load_template(room, template_id, root=None):
+    """Load manifest, decoded background and compiled geometry (uncached)
+
+    Returns a dict with:
+        room, id, manifest, bg_path, bg (BGRA ndarray), quad (4x2 float32, TL/TR/BR/BL),
+        roi (x0, y0, x1, y1), mask (ROI-sized uint8, manifest feather and occlusion)
+        and occlusion (cropped manifest mask as (roi, mask), or None)
+    """
+    manifest, bg_path = load_manifest(room, template_id, root)
+    bg = open_background(bg_path)
+    quad = np.array([tuple(map(float, p)) for p in manifest["corners"]], dtype=np.float32)
+    mask_path = _mask_path(manifest, bg_path)
+    geometry = _load_geometry(bg_path, _geometry_key(manifest, bg.shape[:2], mask_path))
+    if geometry is None:
+        occlusion = load_occlusion(mask_path, bg.shape[:2]) if mask_path is not None else None
+        roi, mask = compile_geometry(quad, manifest.get("feather_px", 0), bg.shape[:2], occlusion)
+    else:
+        roi, mask, occlusion = geometry
+    return {
+        'room': room,
+        'id': template_id,
+        'manifest': manifest,
+        'bg_path': bg_path,
+        'bg': bg,
+        'quad': quad,
+        'roi': roi,
+        'mask': mask,
+        'occlusion': occlusion,
+    }
+
+
+def preview_template(tpl, long_edge):
+    """Template scaled so its long edge is long_edge (background, corners, feather)
+
+    Uses the compiled preview tier when present, otherwise downscales the full
+    background. Results are kept on the template dict, so cached templates keep
+    their previews for the life of the process. Returns tpl itself when it is
+    already at or below long_edge.
+    """
+    bg = tpl['bg']
+    h, w = bg.shape[:2]
+    long_edge = int(long_edge or 0)
+    if long_edge <= 0 or long_edge >= max(h, w):
+        return tpl
+    previews = tpl.setdefault('previews', {})
+    ptpl = previews.get(long_edge)
+    if ptpl is not None:
+        return ptpl
+
+    stamp = _fresh_stamp(tpl['bg_path'])
+    if stamp and long_edge in stamp.get("previews", []):
+        pbg = np.load(_preview_path(tpl['bg_path'], long_edge), mmap_mode="r")
+    else:
+        pbg = _resize_long_edge(bg, long_edge)
+    ph, pw = pbg.shape[:2]
+    sx, sy = pw / float(w), ph / float(h)
+    scale = (sx + sy) / 2.0
+
+    manifest = dict(tpl['manifest'])
+    manifest['feather_px'] = float(manifest.get('feather_px', 0) or 0) * scale
+    quad = (tpl['quad'] * np.array([sx, sy], dtype=np.float32)).astype(np.float32)
+    occlusion = tpl.get('occlusion')
+    if occlusion is not None:
+        occlusion = scale_occlusion(occlusion, sx, sy, (ph, pw))
+    roi, mask = compile_geometry(quad, manifest['feather_px'], (ph, pw), occlusion)
+    ptpl = dict(tpl, manifest=manifest, bg=pbg, quad=quad, roi=roi, mask=mask, occlusion=occlusion,
+                scale=scale, previews={})
+    previews[long_edge] = ptpl
+    return ptpl
+
+
+def get_template(room, template_id, root=None):
+    """Cached load_template - decoded once per process and shared by later calls
+
+    Only use from long-lived processes; one-shot scripts should call load_template
+    so backgrounds are freed as soon as each mockup is done.
+    """
+    key = (str(Path(root) if root is not None else templates_root()), room, template_id)
+    tpl = _CACHE.get(key)
+    if tpl is not None:
+        return tpl
+    with _CACHE_LOCK:
+        tpl = _CACHE.get(key)
+        if tpl is None:
+            tpl = load_template(room, template_id, root)
+            _CACHE[key] = tpl
+    return tpl
+
+
+def invalidate(room, template_id, root=None):
+    """Drop a template from the process cache (after it was re-ingested or edited)"""
+    key = (str(Path(root) if root is not None else templates_root()), room, template_id)
+    with _CACHE_LOCK:
+        _CACHE.pop(key, None)
+
+
+def list_templates(root=None):
+    """All (room, template_id) pairs under the root that have a manifest"""
+    template_root = Path(root) if root is not None else templates_root()
+    found = []
+    if not template_root.exists():
+        return found
+    for room_dir in sorted(d for d in template_root.iterdir() if d.is_dir()):
+        for tdir in sorted(d for d in room_dir.iterdir() if d.is_dir()):
+            if (tdir / "manifest.json").exists():
+                found.append((room_dir.name, tdir.name))
+    return found
+
+
+def preload(templates, root=None):
+    """Decode the given (room, template_id) pairs into the process cache
+
+    Returns (loaded, errors) where errors maps "room/id" to the failure message.
+    """
+    loaded = 0
+    errors = {}
+    for room, template_id in templates:
+        try:
+            get_template(room, template_id, root)
+            loaded += 1
+        except Exception as e:
+            errors[f"{room}/{template_id}"] = str(e)
+    return loaded, errors
+
+
+def cache_info():
+    """Number of cached templates, how many are memory-mapped and their size in bytes"""
+    with _CACHE_LOCK:
+        items = list(_CACHE.values())
+    return {
+        'templates': len(items),
+        'mmapped': sum(1 for t in items if isinstance(t['bg'], np.memmap)),
+        'bytes': sum(t['bg'].nbytes + t['mask'].nbytes + (t['occlusion'][1].nbytes if t.get('occlusion') else 0)
+                     for t in items),
+    }
+
+
+def compile_template(room, template_id, root=None, preview_edges=()):
+    """Compile raw background, preview tiers and ROI geometry for one template
+
+    Only stale artifacts are rebuilt. Returns True if anything was written.
+    """
+    manifest, bg_path = load_manifest(room, template_id, root)
+    built = False
+    stamp = _fresh_stamp(bg_path)
+    wanted = set()
+    if stamp is not None:
+        wanted = {int(e) for e in preview_edges if 0 < int(e) < max(stamp["shape"][:2])}
+    if stamp is None or not wanted <= set(stamp.get("previews", [])):
+        compile_background(bg_path, preview_edges)
+        stamp = _fresh_stamp(bg_path)
+        built = True
+
+    shape_hw = stamp["shape"][:2]
+    mask_path = _mask_path(manifest, bg_path)
+    key = _geometry_key(manifest, shape_hw, mask_path)
+    if _load_geometry(bg_path, key) is None:
+        quad = np.array([tuple(map(float, p)) for p in manifest["corners"]], dtype=np.float32)
+        occlusion = load_occlusion(mask_path, shape_hw) if mask_path is not None else None
+        roi, mask = compile_geometry(quad, manifest.get("feather_px", 0), shape_hw, occlusion)
+        save_geometry(bg_path, key, roi, mask, occlusion)
+        built = True
+
+    if built:
+        invalidate(room, template_id, root)
+    return built
+
+
+def build_store(root=None, preview_edges=()):
+    """Compile raw backgrounds, preview tiers and geometry for every template under the root"""
+    built = skipped = 0
+    errors = {}
+    for room, template_id in list_templates(root):
+        try:
+            if compile_template(room, template_id, root, preview_edges):
+                built += 1
+                print(f"Compiled {room}/{template_id}", file=sys.stderr)
+            else:
+                skipped += 1
+        except Exception as e:
+            errors[f"{room}/{template_id}"] = str(e)
+    return {'built': built, 'up_to_date': skipped, 'errors': errors}
+
+
+def main():
+    args = sys.argv[1:]
+    if not args or args[0] != "build":
+        print(json.dumps({'error': 'Usage: template_store.py build [templates_root] [--preview 512,1024]'}), file=sys.stderr)
+        sys.exit(1)
+    tiers = DEFAULT_PREVIEW_TIERS
+    if "--preview" in args:
+        i = args.index("--preview")
+        tiers = args[i + 1] if i + 1 < len(args) else ""
+        args = args[:i] + args[i + 2:]
+    root = args[1] if len(args) > 1 else None
+    preview_edges = [int(t) for t in tiers.split(",") if t.strip()]
+    print(json.dumps(build_store(root, preview_edges)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""
+Upload Ingest - stream artwork uploads instead of reading them whole
+Endpoints used to `await file.read()` the whole upload into bytes before looking
+at it, so a huge or non-image upload cost its full size in memory before it
+could be refused. read_upload() copies the upload in CHUNK_BYTES pieces into a
+SpooledTemporaryFile the caller owns (in memory up to SPOOL_MEMORY_BYTES, then
+on disk) and on the way:
+
+- refuses a first chunk that is not a known image signature (415) without
+  reading the rest
+- stops with 413 as soon as the byte count passes MAX_UPLOAD_BYTES
+- computes the sha256 incrementally; it is the artwork hash of the result cache
+  and the content part of single-flight keys
+- probes the header (format, size) without decoding pixels and refuses images
+  over MAX_UPLOAD_MEGAPIXELS (413) before anything decodes them
+
+The framework parses (and spools) the whole multipart body before an endpoint
+runs, so UploadLimit, an ASGI middleware, answers 413 first: straight from
+Content-Length when it is over the cap, else as soon as the streamed body is.
+
+Environment:
+    MAX_UPLOAD_MB           bytes per upload (default 50, 0 = no cap)
+    MAX_UPLOAD_MEGAPIXELS   pixels per image, from its header (default 150, 0 = no cap)
+"""
+import os
+import json
+import hashlib
+import tempfile
+
+from perf_metrics import stage
+from warmup import lazy_import
+
+Image = lazy_import("PIL.Image")
+
+MAX_UPLOAD_BYTES = int(float(os.environ.get("MAX_UPLOAD_MB", "50")) * 1024 * 1024)
+MAX_UPLOAD_PIXELS = int(float(os.environ.get("MAX_UPLOAD_MEGAPIXELS", "150")) * 1_000_000)
+CHUNK_BYTES = 1024 * 1024
+SPOOL_MEMORY_BYTES = 8 * 1024 * 1024
+# Multipart boundaries and the other form fields on top of the file itself
+FORM_OVERHEAD_BYTES = 64 * 1024
+
+SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+    (b"BM", "BMP"),
+    (b"II*\x00", "TIFF"),
+    (b"MM\x00*", "TIFF"),
+)
+
+
+class UploadError(Exception):
+    """The upload was refused; status_code is the HTTP status to answer with"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+class Upload:
+    """A received upload: spooled bytes, size, sha256 and the probed header"""
+
+    def __init__(self, file, size, sha256, format, width, height):
+        self.file = file
+        self.size = size
+        self.sha256 = sha256
+        self.format = format
+        self.width = width
+        self.height = height
+
+    def rewind(self):
+        """The spooled file positioned at the start (for Image.open and friends)"""
+        self.file.seek(0)
+        return self.file
+
+    def read(self):
+        return self.rewind().read()
+
+    def close(self):
+        self.file.close()
+
+
+def sniff_format(head):
+    """Image format from the first bytes of a file, or None"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "WEBP"
+    for signature, fmt in SIGNATURES:
+        if head.startswith(signature):
+            return fmt
+    return None
+
+
+def _too_large(limit):
+    return UploadError(f"Upload larger than {limit / 1024 / 1024:g} MB", 413)
+
+
+def probe(file, max_pixels=MAX_UPLOAD_PIXELS):
+    """(format, width, height) from the image header; pixels are not decoded"""
+    file.seek(0)
+    try:
+        img = Image.open(file)
+    except Image.DecompressionBombError as e:
+        raise UploadError(str(e), 413)
+    except Exception as e:
+        raise UploadError(f"Could not read image: {e}", 400)
+    width, height = img.size
+    if max_pixels and width * height > max_pixels:
+        raise UploadError(f"Image is {width}x{height}; at most {max_pixels / 1e6:g} megapixels are accepted", 413)
+    return img.format, width, height
+
+
+async def read_upload(upload, max_bytes=MAX_UPLOAD_BYTES, max_pixels=MAX_UPLOAD_PIXELS):
+    """Stream an UploadFile into a spooled buffer; returns an Upload or raises UploadError"""
+    if max_bytes and upload.size is not None and upload.size > max_bytes:
+        raise _too_large(max_bytes)
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_BYTES)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with stage("upload"):
+            while True:
+                chunk = await upload.read(CHUNK_BYTES)
+                if not chunk:
+                    break
+                if size == 0 and sniff_format(chunk) is None:
+                    raise UploadError("Unsupported file type; upload a PNG, JPEG, WebP, GIF, BMP or TIFF image", 415)
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise _too_large(max_bytes)
+                digest.update(chunk)
+                spool.write(chunk)
+            if size == 0:
+                raise UploadError("Empty upload", 400)
+            fmt, width, height = probe(spool, max_pixels)
+        return Upload(spool, size, digest.hexdigest(), fmt, width, height)
+    except BaseException:
+        spool.close()
+        raise
+
+
+class UploadLimit:
+    """ASGI middleware: 413 for request bodies over max_bytes before the form is parsed"""
+
+    def __init__(self, app, max_bytes=MAX_UPLOAD_BYTES):
+        self.app = app
+        self.max_bytes = max_bytes + FORM_OVERHEAD_BYTES if max_bytes else 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.max_bytes:
+            await self.app(scope, receive, send)
+            return
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_bytes:
+            await self._reject(send)
+            return
+
+        state = {"received": 0, "over": False, "started": False}
+
+        async def limited_receive():
+            message = await receive()
+            if message["type"] == "http.request":
+                state["received"] += len(message.get("body", b""))
+                if state["received"] > self.max_bytes:
+                    state["over"] = True
+                    raise UploadError("Request body too large", 413)
+            return message
+
+        async def guarded_send(message):
+            if state["over"]:
+                return  # the app's error response for the aborted body; ours replaces it
+            state["started"] = True
+            await send(message)
+
+        try:
+            await self.app(scope, limited_receive, guarded_send)
+        except UploadError:
+            if not state["over"]:
+                raise
+        if state["over"] and not state["started"]:
+            await self._reject(send)
+
+    async def _reject(self, send):
+        limit = (self.max_bytes - FORM_OVERHEAD_BYTES) / 1024 / 1024
+        body = json.dumps({"detail": f"Upload larger than {limit:g} MB"}).encode("utf-8")
+        await send({"type": "http.response.start", "status": 413,
+                    "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode()),
+                                (b"connection", b"close")]})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+Upstream Limiter - admission control for Images API calls
+Every outpaint call used to go straight to the Images API, so a burst of users
+hit the account's rate limit together and every request failed at once. Calls
+now pass through admit(), which holds them in a priority queue until they fit
+under the configured requests-per-minute and images-per-minute token buckets
+(and an optional in-flight cap), so bursts are served at the upstream limit
+instead of collapsing into 429s.
+
+- priority classes: "interactive" (single-style requests a user is waiting on)
+  is always admitted ahead of "bulk" (multi-style packs)
+- a queue-depth cap and a queue timeout reject early with UpstreamBusy, which
+  carries a Retry-After hint, instead of letting requests pile up
+- backoff(seconds) pauses admissions after an upstream 429: at once in this
+  process, and for the other workers through the shared store when its write
+  goes through within SHARED_PAUSE_TIMEOUT_S
+- a call whose request deadline passes or is cancelled leaves the queue
+- queue depth, in-flight calls and admit/reject counters on /metrics; time
+  spent queued is the "upstream_queue" stage
+
+Buckets live in process memory by default. Set UPSTREAM_LIMITER_DB to a SQLite
+path to share them (and 429 pauses) between worker processes on one host; the
+queue and the in-flight cap stay per process.
+
+Environment (0 = no limit):
+    UPSTREAM_RPM             requests per minute
+    UPSTREAM_IPM             images per minute
+    UPSTREAM_CONCURRENCY     calls in flight per process
+    UPSTREAM_BURST_SECONDS   bucket size in seconds of rate (default 10)
+    UPSTREAM_QUEUE_MAX       queued calls per process before rejecting (default 64)
+    UPSTREAM_QUEUE_TIMEOUT   seconds a call may wait before rejecting (default 120)
+    UPSTREAM_LIMITER_DB      SQLite file for cross-worker buckets (default: per process)
+"""
+import os
+import time
+import heapq
+import sqlite3
+import weakref
+import itertools
+import threading
+from contextlib import contextmanager
+
+from perf_metrics import stage
+
+PRIORITIES = {"interactive": 0, "bulk": 1}
+CANCEL_POLL_S = 0.25
+SQLITE_BUSY_TIMEOUT_S = 10.0
+SHARED_PAUSE_TIMEOUT_S = 0.5
+
+
+class UpstreamBusy(Exception):
+    """The call was not admitted (queue full or waited too long)"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, int(retry_after + 0.999))
+
+
+def _take(state, buckets, costs, now):
+    """Refill state in place and take costs if every bucket has them
+
+    state: name -> [tokens, updated]; buckets: name -> (rate per second, capacity).
+    Returns 0.0 when taken, else seconds until the costs would fit.
+    """
+    wait = 0.0
+    for name, (rate, capacity) in buckets.items():
+        tokens, updated = state.get(name, (capacity, now))
+        tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+        state[name] = [tokens, now]
+        need = min(costs.get(name, 0), capacity)  # a call larger than the bucket waits for a full one
+        if tokens < need:
+            wait = max(wait, (need - tokens) / rate)
+    if wait == 0.0:
+        for name in buckets:
+            state[name][0] -= min(costs.get(name, 0), buckets[name][1])
+    return wait
+
+
+class _LocalStore:
+    """Buckets in process memory"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._state = {}
+
+    def try_take(self, costs):
+        return _take(self._state, self.buckets, costs, time.time())
+
+    def pause(self, until):
+        pass  # the limiter already holds this process's pause
+
+
+class _SqliteStore:
+    """Buckets shared between processes through a SQLite file
+
+    The connection is opened on first use in each process. Limiters are built
+    at import, before the prefork runner forks its workers, and a SQLite
+    connection must not be carried across fork(), so a forked child drops the
+    inherited one (and the lock guarding it) and opens its own.
+    """
+
+    _instances = weakref.WeakSet()
+
+    def __init__(self, buckets, path, name):
+        self.buckets = buckets
+        self._path = path
+        self._prefix = f"{name}:"
+        self._lock = threading.Lock()
+        self._db = None
+        self._inherited = []
+        _SqliteStore._instances.add(self)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()  # another parent thread may have held it at fork
+        if self._db is not None:
+            # Only keep it referenced: closing it here would act on the parent's file locks
+            self._inherited.append(self._db)
+            self._db = None
+
+    def _connection(self):
+        """This process's connection (call with self._lock held)"""
+        if self._db is None:
+            db = sqlite3.connect(self._path, timeout=SQLITE_BUSY_TIMEOUT_S, isolation_level=None,
+                                 check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS upstream_limiter "
+                       "(key TEXT PRIMARY KEY, value REAL NOT NULL, updated REAL NOT NULL)")
+            self._db = db
+        return self._db
+
+    def try_take(self, costs):
+        with self._lock:
+            self._connection().execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute("SELECT key, value, updated FROM upstream_limiter WHERE key LIKE ?",
+                                        (self._prefix + "%",)).fetchall()
+                state = {key[len(self._prefix):]: [value, updated] for key, value, updated in rows}
+                now = time.time()
+                paused_until = state.pop("pause", [0.0, 0.0])[0]
+                if paused_until > now:
+                    self._db.execute("COMMIT")
+                    return paused_until - now
+                wait = _take(state, self.buckets, costs, now)
+                self._db.executemany("INSERT OR REPLACE INTO upstream_limiter VALUES (?, ?, ?)",
+                                     [(self._prefix + k, v, u) for k, (v, u) in state.items()])
+                self._db.execute("COMMIT")
+                return wait
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def pause(self, until):
+        """Share a 429 pause with the other workers, waiting at most SHARED_PAUSE_TIMEOUT_S
+
+        Best effort: the limiter has already paused this process, and a worker
+        that misses the pause backs off on its own 429.
+        """
+        if not self._lock.acquire(timeout=SHARED_PAUSE_TIMEOUT_S):
+            return
+        try:
+            db = self._connection()
+            db.execute(f"PRAGMA busy_timeout = {int(SHARED_PAUSE_TIMEOUT_S * 1000)}")
+            try:
+                db.execute("INSERT INTO upstream_limiter VALUES (?, ?, ?) ON CONFLICT(key) DO UPDATE "
+                           "SET value = max(value, excluded.value), updated = excluded.updated",
+                           (self._prefix + "pause", until, time.time()))
+            finally:
+                db.execute(f"PRAGMA busy_timeout = {int(SQLITE_BUSY_TIMEOUT_S * 1000)}")
+        except sqlite3.OperationalError:
+            pass  # locked by another worker for too long
+        finally:
+            self._lock.release()
+
+
+def _reset_sqlite_after_fork():
+    for store in list(_SqliteStore._instances):
+        store._after_fork()
+
+
+os.register_at_fork(after_in_child=_reset_sqlite_after_fork)
+
+
+class UpstreamLimiter:
+    """Priority admission queue in front of one upstream API"""
+
+    def __init__(self, name, rpm=0, ipm=0, concurrency=0, burst_seconds=10.0, queue_max=64,
+                 queue_timeout=120.0, db_path=None):
+        self.name = name
+        self.rpm, self.ipm = rpm, ipm
+        self.concurrency = concurrency
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+        buckets = {}
+        for bucket, per_minute in (("requests", rpm), ("images", ipm)):
+            if per_minute > 0:
+                rate = per_minute / 60.0
+                buckets[bucket] = (rate, max(1.0, rate * burst_seconds))
+        self._store = _SqliteStore(buckets, db_path, name) if db_path else _LocalStore(buckets)
+        self._cond = threading.Condition()
+        self._queue = []  # heap of [priority, seq]
+        self._seq = itertools.count()
+        self._in_flight = 0
+        self._taking = False  # the queue head is in the store, outside the lock
+        self._paused_until = 0.0
+        self.stats = {"admitted": 0, "rejected_queue_full": 0, "rejected_timeout": 0, "cancelled": 0,
+                      "upstream_429": 0}
+
+    @classmethod
+    def from_env(cls, name):
+        return cls(
+            name,
+            rpm=float(os.getenv("UPSTREAM_RPM", "0")),
+            ipm=float(os.getenv("UPSTREAM_IPM", "0")),
+            concurrency=int(os.getenv("UPSTREAM_CONCURRENCY", "0")),
+            burst_seconds=float(os.getenv("UPSTREAM_BURST_SECONDS", "10")),
+            queue_max=int(os.getenv("UPSTREAM_QUEUE_MAX", "64")),
+            queue_timeout=float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "120")),
+            db_path=os.getenv("UPSTREAM_LIMITER_DB") or None,
+        )
+
+    def _retry_hint(self):
+        """Rough seconds until the queue ahead of a new call drains"""
+        per_second = self.rpm / 60.0 if self.rpm > 0 else max(self.concurrency, 1)
+        return (len(self._queue) + 1) / per_second
+
+    @contextmanager
+    def admit(self, images=1, priority="interactive", deadline=None):
+        """Block until the call may go upstream; raises UpstreamBusy instead of queueing forever
+
+        With a deadlines.Deadline, a call whose request is cancelled or runs out
+        of time leaves the queue with deadlines.Cancelled.
+        """
+        with stage("upstream_queue"):
+            self._acquire({"requests": 1, "images": max(1, int(images))}, PRIORITIES.get(priority, 1), deadline)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def _acquire(self, costs, priority, request_deadline=None):
+        with self._cond:
+            if self.queue_max and len(self._queue) >= self.queue_max:
+                self.stats["rejected_queue_full"] += 1
+                raise UpstreamBusy(f"{self.name}: {len(self._queue)} calls already queued", self._retry_hint())
+            entry = [priority, next(self._seq)]
+            heapq.heappush(self._queue, entry)
+            give_up = time.monotonic() + self.queue_timeout
+            try:
+                while True:
+                    if request_deadline is not None and request_deadline.expired():
+                        self.stats["cancelled"] += 1
+                        request_deadline.check("upstream call")
+                    wait = None
+                    # Only the head of the queue takes tokens, so bulk never overtakes interactive
+                    if (self._queue[0] is entry and not self._taking
+                            and (not self.concurrency or self._in_flight < self.concurrency)):
+                        wait = self._paused_until - time.time()
+                        if wait <= 0:
+                            wait = self._take_unlocked(costs)
+                        if wait <= 0:
+                            self._queue.remove(entry)  # a call queued meanwhile may now be the head
+                            heapq.heapify(self._queue)
+                            self._in_flight += 1
+                            self.stats["admitted"] += 1
+                            self._cond.notify_all()
+                            return
+                    remaining = give_up - time.monotonic()
+                    if remaining <= 0:
+                        self.stats["rejected_timeout"] += 1
+                        raise UpstreamBusy(f"{self.name}: queued {self.queue_timeout:g}s without admission",
+                                           self._retry_hint())
+                    if request_deadline is not None:
+                        remaining = min(remaining, CANCEL_POLL_S)  # cancel() does not notify us
+                    self._cond.wait(min(wait, remaining) if wait is not None else remaining)
+            except BaseException:
+                if entry in self._queue:
+                    self._queue.remove(entry)
+                    heapq.heapify(self._queue)
+                    self._cond.notify_all()
+                raise
+
+    def _take_unlocked(self, costs):
+        """store.try_take() with self._cond released (call with it held)
+
+        The SQLite store can wait seconds on another worker's lock; releases and
+        /metrics must not queue behind that. _taking keeps this to one caller.
+        """
+        self._taking = True
+        self._cond.release()
+        try:
+            return self._store.try_take(costs)
+        finally:
+            self._cond.acquire()
+            self._taking = False
+            self._cond.notify_all()
+
+    def backoff(self, seconds):
+        """Pause admissions after an upstream 429: this process at once, other workers best effort"""
+        until = time.time() + max(0.0, seconds)
+        with self._cond:
+            self.stats["upstream_429"] += 1
+            self._paused_until = max(self._paused_until, until)
+            self._cond.notify_all()
+        self._store.pause(until)
+
+    def render_prometheus(self):
+        """Queue depth, in-flight calls and counters in the Prometheus text format"""
+        with self._cond:
+            depth = {name: sum(1 for p, _ in self._queue if p == prio) for name, prio in PRIORITIES.items()}
+            in_flight = self._in_flight
+            stats = dict(self.stats)
+        upstream = f'upstream="{self.name}"'
+        lines = ["# HELP upstream_queue_depth Calls waiting for upstream admission",
+                 "# TYPE upstream_queue_depth gauge"]
+        lines += [f'upstream_queue_depth{{{upstream},priority="{name}"}} {n}' for name, n in depth.items()]
+        lines += ["# HELP upstream_in_flight Upstream calls in progress",
+                  "# TYPE upstream_in_flight gauge",
+                  f"upstream_in_flight{{{upstream}}} {in_flight}",
+                  "# HELP upstream_admissions_total Upstream admission outcomes",
+                  "# TYPE upstream_admissions_total counter"]
+        rate_limited = stats.pop("upstream_429")
+        lines += [f'upstream_admissions_total{{{upstream},outcome="{k}"}} {v}' for k, v in stats.items()]
+        lines += ["# HELP upstream_rate_limited_total 429 responses from the upstream",
+                  "# TYPE upstream_rate_limited_total counter",
+                  f"upstream_rate_limited_total{{{upstream}}} {rate_limited}"]
+        return "\n".join(lines) + "\n"
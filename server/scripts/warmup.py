@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Warmup - keep heavy imports off the startup path
+The services used to import requests, PIL, jwt, numpy and cv2 (and the
+compositor built on them) before uvicorn could bind its port, so every cold
+start made health checks wait for modules no health check needs.
+
+lazy_import() returns a stand-in that imports the real module on first
+attribute access; service modules bind heavy dependencies through it and call
+load() from a warmup thread started once the server is up, so the first real
+request usually finds them imported already. Anything that touches a module
+before the warmup reaches it simply imports it then (the import lock makes
+the two safe to race).
+
+Annotations naming lazy modules (Image.Image) need
+"from __future__ import annotations" so they are not evaluated at import.
+"""
+import time
+import threading
+import importlib
+
+
+class LazyModule:
+    """Module stand-in that imports name on first attribute access"""
+
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                module = importlib.import_module(self._name)
+                if self._setup is not None:
+                    self._setup(module)
+                self._module = module  # published only after setup, so no caller sees it half configured
+        return self._module
+
+    def __getattr__(self, attr):
+        module = self._module
+        if module is None:
+            module = self._load()
+        return getattr(module, attr)
+
+    @property
+    def loaded(self):
+        return self._module is not None
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}{'' if self.loaded else ' (not loaded)'}>"
+
+
+def lazy_import(name, setup=None):
+    """Stand-in for `import name`; setup(module) runs once, right after the real import"""
+    return LazyModule(name, setup)
+
+
+def load(*modules):
+    """Import lazy modules now; returns {name: seconds} for the ones this call loaded"""
+    took = {}
+    for module in modules:
+        if not module.loaded:
+            t0 = time.perf_counter()
+            module._load()
+            took[module._name] = round(time.perf_counter() - t0, 3)
+    return took
@@ -1,23 +1,160 @@
 #!/usr/bin/env python3
 import os
 import sys
+import gc
+import select
+import signal
+import socket
+import threading
+import argparse
+import importlib
 import uvicorn
 
 # Add current directory to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-# Import the FastAPI app
-from app import app
+
+def _load_app(app_path):
+    """Import 'module:attr' and return (module, app)"""
+    module_name, _, attr = app_path.partition(":")
+    module = importlib.import_module(module_name)
+    return module, getattr(module, attr or "app")
+
+
+def _serve_worker(app, sock):
+    """Child process: run uvicorn on the inherited listening socket"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    config = uvicorn.Config(app, log_level="info", access_log=True)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def _answer_while_warming(sock, done):
+    """Parent thread until the workers fork: /healthz gets 200, anything else 503
+
+    Nothing else accepts on the socket before the fork, so a liveness probe
+    would otherwise wait out the whole warmup in the backlog. Other requests
+    get a quick 503 with Retry-After instead of hanging.
+    """
+    while not done.is_set():
+        if not select.select([sock], [], [], 0.05)[0]:
+            continue
+        conn, _ = sock.accept()
+        with conn:
+            conn.settimeout(1)
+            try:
+                request_line = conn.recv(4096).split(b"\r\n", 1)[0].decode("latin-1").split()
+            except OSError:
+                continue
+            path = request_line[1].split("?", 1)[0] if len(request_line) >= 2 else ""
+            if path == "/healthz":
+                status, body, extra = "200 OK", b'{"ok":true,"warming":true}', ""
+            else:
+                status, body, extra = "503 Service Unavailable", b'{"ready":false,"warming":true}', "Retry-After: 1\r\n"
+            head = (f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                    f"{extra}Connection: close\r\n\r\n")
+            try:
+                conn.sendall(head.encode("latin-1") + body)
+            except OSError:
+                pass
+
+
+def serve_prefork(app_path, host, port, workers):
+    """Bind once, preload caches, then fork workers that share the warm memory
+
+    The app module may expose warm_caches(); it runs in the parent so decoded
+    templates and compiled geometry are shared copy-on-write by every worker.
+    The port is bound first and the parent answers /healthz while it imports
+    and warms (other requests get 503 until the workers are up). Dead workers
+    are re-forked from the (still warm) parent.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    warming = threading.Event()
+    responder = threading.Thread(target=_answer_while_warming, args=(sock, warming), name="warmup-probes",
+                                 daemon=True)
+    responder.start()
+    try:
+        module, app = _load_app(app_path)
+        warm = getattr(module, "warm_caches", None)
+        if warm is not None:
+            print(f"Warming caches before fork: {warm()}")
+    finally:
+        warming.set()
+        responder.join()  # no thread may be mid-accept when the workers fork
+
+    # Move everything allocated so far out of the GC's reach so collections in
+    # the workers don't write to (and un-share) the preloaded pages
+    gc.collect()
+    gc.freeze()
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _serve_worker(app, sock)
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        spawn()
+    print(f"Uvicorn running on http://{host}:{port} ({workers} prefork workers)", flush=True)
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        children.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited with status {status}, restarting", flush=True)
+            spawn()
+    sock.close()
+
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start the FastAPI server")
+    parser.add_argument("--app", default=os.getenv("FASTAPI_APP", "app:app"),
+                        help="'app:app' (outpaint) or 'template_mockup_api:app' (templates)")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("FASTAPI_WORKERS", "1")))
+    args = parser.parse_args()
+
     # Use FASTAPI_PORT first, then fallback to 8001
     # Don't use PORT as that conflicts with Express
     port = int(os.getenv("FASTAPI_PORT", 8001))
-    
+
     print(f"Starting FastAPI server on 0.0.0.0:{port}...")
     print("RunPod API Key present:", bool(os.getenv('RUNPOD_API_KEY')))
     print("RunPod Endpoint Base present:", bool(os.getenv('RUNPOD_ENDPOINT_BASE')))
-    
+
+    if args.workers > 1 and hasattr(os, "fork"):
+        serve_prefork(args.app, "0.0.0.0", port, args.workers)
+        sys.exit(0)
+
+    _, app = _load_app(args.app)
+
     # Always bind to 0.0.0.0 for Replit compatibility
     uvicorn.run(
         app,
@@ -25,4 +162,4 @@ if __name__ == "__main__":
         port=port,
         log_level="info",
         access_log=True
-    )
\ No newline at end of file
+    )
@@ -1,26 +1,29 @@
 # app.py — Local-template mockup API (Photopea/Photoshop corner method)
 # Endpoints:
 #   GET  /healthz
+#   GET  /readyz
+#   GET  /metrics
 #   GET  /templates/list
 #   GET  /templates/tree
 #   POST /mockup/apply
 
-import io, os, json, math, hashlib
-from pathlib import Path
-from typing import List, Tuple
+from __future__ import annotations
 
-import numpy as np
-import cv2  # requires opencv-python-headless
-from PIL import Image, ImageFilter, ImageOps
+import os, sys, hashlib, threading
+from functools import lru_cache
+from pathlib import Path
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
 from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 
 # ----------------------------
 # Template root resolution
 # ----------------------------
-def _resolve_template_root() -> Path:
+@lru_cache(maxsize=1)
+def template_root() -> Path:
+    """Resolved on first use rather than at import, so a disk mounted after boot is still found"""
     env_root = os.getenv("TEMPLATE_ROOT_DIR")
     if env_root:
         p = Path(env_root)
@@ -33,16 +36,35 @@ def _resolve_template_root() -> Path:
     # bundled with app
     return Path(__file__).parent / "templates"
 
-TEMPLATE_ROOT = _resolve_template_root()
+# Compositor + template cache are shared with the Node-spawned batch script
+sys.path.insert(0, str(Path(__file__).parent / "server" / "scripts"))
+from perf_metrics import instrument_app, stage  # noqa: E402
+from perf_profile import request_profile  # noqa: E402
+from single_flight import SingleFlight, request_key  # noqa: E402
+import result_cache  # noqa: E402
+from warmup import lazy_import, load  # noqa: E402
+from upload_ingest import UploadError, UploadLimit, read_upload  # noqa: E402
+
+# numpy/cv2/PIL and the compositor load on the warmup thread (or first use), after the port is bound
+template_store = lazy_import("template_store")
+batch_mockup = lazy_import("batch_mockup")
+background_removal = lazy_import("background_removal")
+Image = lazy_import("PIL.Image")
+ImageOps = lazy_import("PIL.ImageOps")
 
 # ----------------------------
 # FastAPI
 # ----------------------------
 app = FastAPI(title="Mockup API (local templates)", version="1.0")
+# Oversized bodies get 413 before the multipart form is parsed (MAX_UPLOAD_MB);
+# added before CORS so the 413 carries CORS headers
+app.add_middleware(UploadLimit)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"], allow_methods=["*"], allow_headers=["*"], allow_credentials=True
 )
+# Per-stage timings: Server-Timing header on every response, histograms on /metrics
+instrument_app(app, "template_mockup_api")
 
 # ----------------------------
 # Helpers
@@ -60,97 +82,44 @@ def _file_sha1(p: Path, nbytes=32768) -> str:
     except Exception:
         return "unreadable"
 
-def _pil_to_np(img: Image.Image) -> np.ndarray:
-    """PIL RGBA -> numpy BGRA (for OpenCV)."""
-    if img.mode != "RGBA":
-        img = img.convert("RGBA")
-    arr = np.array(img)  # RGBA
-    bgr = cv2.cvtColor(arr, cv2.COLOR_RGBA2BGRA)  # RGBA->BGRA
-    return bgr
-
-def _np_to_pil(arr: np.ndarray) -> Image.Image:
-    """numpy BGRA -> PIL RGBA."""
-    rgba = cv2.cvtColor(arr, cv2.COLOR_BGRA2RGBA)
-    return Image.fromarray(rgba)
-
-def _load_manifest(room: str, template_id: str) -> Tuple[dict, Path]:
-    room_dir = TEMPLATE_ROOT / room
-    if not room_dir.exists():
-        raise HTTPException(400, f"Room folder not found: {room_dir}")
-    tdir = room_dir / template_id
-    if not tdir.exists():
-        raise HTTPException(400, f"Template '{template_id}' not found under {room_dir}")
-
-    mpath = tdir / "manifest.json"
-    if not mpath.exists():
-        raise HTTPException(400, f"manifest.json missing in {tdir}")
+def _template_fingerprint(room: str, template_id: str):
+    """Result-cache fingerprint of a template, or None when it is broken (_get_template reports it)"""
+    try:
+        return template_store.template_fingerprint(room, template_id, template_root())
+    except Exception:
+        return None
+
+def _get_template(room: str, template_id: str) -> dict:
+    """Cached template (decoded background + compiled geometry) or HTTP 400."""
     try:
-        manifest = json.loads(mpath.read_text())
+        return template_store.get_template(room, template_id, template_root())
     except Exception as e:
-        raise HTTPException(400, f"manifest.json not valid JSON: {e}")
-
-    bg_name = manifest.get("background")
-    if not bg_name:
-        raise HTTPException(400, "manifest.json missing 'background'")
-    bg_path = tdir / bg_name
-    if not bg_path.exists():
-        raise HTTPException(400, f"Background not found: {bg_path}")
-
-    corners = manifest.get("corners")
-    if not (isinstance(corners, list) and len(corners) == 4):
-        raise HTTPException(400, "manifest.json 'corners' must be 4 points [TL,TR,BR,BL]")
-
-    return manifest, bg_path
-
-def _fit_size(src_w: int, src_h: int, dst_w: int, dst_h: int, mode: str) -> Tuple[int,int]:
-    """Return fitted width/height for contain/cover."""
-    r_src = src_w / src_h
-    r_dst = dst_w / dst_h
-    if mode == "cover":
-        if r_src < r_dst:  # too tall, scale by width
-            w = dst_w; h = int(round(w / r_src))
-        else:
-            h = dst_h; w = int(round(h * r_src))
-    else:  # contain
-        if r_src > r_dst:  # too wide, scale by width
-            w = dst_w; h = int(round(w / r_src))
-        else:
-            h = dst_h; w = int(round(h * r_src))
-    return w, h
-
-def _polygon_mask(shape_hw: Tuple[int,int], polygon: np.ndarray, feather_px: float) -> np.ndarray:
-    """Return single-channel (0..255) mask with optional feather (Gaussian)."""
-    h, w = shape_hw
-    mask = np.zeros((h, w), dtype=np.uint8)
-    cv2.fillConvexPoly(mask, polygon.astype(np.int32), 255)
-    if feather_px and feather_px > 0:
-        # kernel must be odd & positive
-        k = max(1, int(round(feather_px)) | 1)
-        mask = cv2.GaussianBlur(mask, (k, k), 0)
-    return mask
-
-def _blend(bg_bgra: np.ndarray, fg_bgra: np.ndarray, mask: np.ndarray, mode: str, opacity: float) -> np.ndarray:
-    """Blend fg into bg using mask and blend mode (normal|multiply)."""
-    opacity = max(0.0, min(1.0, float(opacity)))
-    # Normalize mask to 0..1
-    a = (mask.astype(np.float32) / 255.0) * opacity
-    a3 = np.dstack([a, a, a, a])
-
-    if mode == "multiply":
-        # Porter-Duff over with multiply on RGB
-        bg_rgb = bg_bgra[..., :3].astype(np.float32) / 255.0
-        fg_rgb = fg_bgra[..., :3].astype(np.float32) / 255.0
-        mul_rgb = bg_rgb * fg_rgb
-        out_rgb = mul_rgb * a[..., None] + bg_rgb * (1.0 - a[..., None])
-        out_a = np.clip(bg_bgra[..., 3].astype(np.float32)/255.0 + a - bg_bgra[..., 3].astype(np.float32)/255.0 * a, 0, 1)
-        out = np.dstack([np.clip(out_rgb*255,0,255).astype(np.uint8), (out_a*255).astype(np.uint8)])
-        return out
+        raise HTTPException(400, str(e))
 
-    # normal
-    fg = fg_bgra.astype(np.float32)
-    bg = bg_bgra.astype(np.float32)
-    out = (fg * a3 + bg * (1.0 - a3)).astype(np.uint8)
-    return out
+# ----------------------------
+# Cache warmup
+# ----------------------------
+_warm_state = {"ready": False, "loaded": 0, "errors": {}, "imports": {}}
+_warm_lock = threading.Lock()
+
+def warm_caches() -> dict:
+    """Import the compositor, then decode every template under template_root() into the process cache.
+
+    Called by start_fastapi.py before forking workers so they share the decoded
+    backgrounds copy-on-write (the parent answers /healthz meanwhile, and other
+    requests get 503); single-process servers warm up on startup instead.
+    """
+    with _warm_lock:
+        if not _warm_state["ready"]:
+            _warm_state["imports"] = load(template_store, batch_mockup, background_removal, Image, ImageOps)
+            loaded, errors = template_store.preload(template_store.list_templates(template_root()), template_root())
+            _warm_state.update(ready=True, loaded=loaded, errors=errors)
+    return dict(_warm_state)
+
+@app.on_event("startup")
+def _warm_on_startup():
+    if not _warm_state["ready"]:
+        threading.Thread(target=warm_caches, name="template-warmup", daemon=True).start()
 
 # ----------------------------
 # Diagnostics
@@ -159,13 +128,26 @@ def _blend(bg_bgra: np.ndarray, fg_bgra: np.ndarray, mask: np.ndarray, mode: str
 def healthz():
     return {
         "ok": True,
-        "template_root": str(TEMPLATE_ROOT.resolve()),
+        "template_root": str(template_root().resolve()),
         "hint": "Use /templates/list or /templates/tree to verify files on Render"
     }
 
+@app.get("/readyz")
+def readyz():
+    # Probes must not pull in the compositor ahead of the warmup thread
+    info = template_store.cache_info() if template_store.loaded else {"templates": 0, "bytes": 0}
+    body = {
+        "ready": _warm_state["ready"],
+        "templates_cached": info["templates"],
+        "cached_mb": round(info["bytes"] / 1024 / 1024, 1),
+        "errors": _warm_state["errors"],
+        "pid": os.getpid(),
+    }
+    return JSONResponse(body, status_code=200 if _warm_state["ready"] else 503)
+
 @app.get("/templates/list")
 def templates_list():
-    root = TEMPLATE_ROOT
+    root = template_root()
     out = {"template_root": str(root.resolve()), "exists": root.exists(), "rooms": {}}
     if not root.exists():
         return out
@@ -189,7 +171,7 @@ def templates_list():
 
 @app.get("/templates/tree", response_class=Response)
 def templates_tree():
-    root = TEMPLATE_ROOT
+    root = template_root()
     lines = [f"Template root: {root.resolve()}"]
     if not root.exists():
         lines.append("!! root does not exist")
@@ -208,6 +190,8 @@ def templates_tree():
 # ----------------------------
 # Main: /mockup/apply
 # ----------------------------
+_inflight = SingleFlight()
+
 @app.post("/mockup/apply")
 async def mockup_apply(
     file: UploadFile = File(..., description="Artwork image (PNG/JPG)"),
@@ -218,91 +202,120 @@ async def mockup_apply(
     feather_px: float = Form(-1.0, description="-1 uses manifest feather"),
     opacity: float = Form(-1.0, description="-1 uses manifest opacity (blend.opacity)"),
     return_format: str = Form("png", description="'png' or 'json' (base64)"),
+    preview_long_edge: int = Form(0, description="Composite at preview resolution (long edge px); 0 = full size"),
+    remove_background: bool = Form(False, description="Segment the artwork in-process and composite only its foreground"),
+    profile: bool = Form(False, description="Profile this request (honoured with PERF_PROFILE_FORM=1)"),
 ):
-    # Load template + background + manifest
-    manifest, bg_path = _load_manifest(room, template_id)
+    if profile:
+        request_profile("template_mockup_api POST /mockup/apply")
     try:
-        with Image.open(bg_path) as P:
-            bg = P.convert("RGBA")
-    except Exception as e:
-        raise HTTPException(400, f"Failed to open background: {e}")
-
-    bg_w, bg_h = bg.size
-    # Validate manifest dimensions (must match background)
-    man_w = int(manifest.get("width", bg_w))
-    man_h = int(manifest.get("height", bg_h))
-    if (man_w, man_h) != (bg_w, bg_h):
-        # Not fatal—warn but continue
-        pass
-
-    # Parse corners TL,TR,BR,BL
-    corners: List[List[float]] = manifest["corners"]
-    if len(corners) != 4:
-        raise HTTPException(400, "corners must have 4 points")
-    TL, TR, BR, BL = [tuple(map(float, p)) for p in corners]
-
-    # Read uploaded art
-    raw = await file.read()
+        upload = await read_upload(file)
+    except UploadError as e:
+        raise HTTPException(e.status_code, str(e))
+    started = []
+    try:
+        return_format = return_format.lower()
+        fit = fit.strip().lower()  # 'Contain' and 'contain' composite alike: same cache and flight keys
+        params = dict(room=room, template_id=template_id, fit=fit, margin_px=margin_px, feather_px=feather_px,
+                      opacity=opacity, preview_long_edge=preview_long_edge, remove_background=remove_background)
+
+        # Result cache: same artwork bytes + template content + parameters = same PNG
+        key = None
+        if result_cache.enabled():
+            with stage("cache"):
+                # Stats the template's files and may hash its background: keep it off the event loop
+                fingerprint = await run_in_threadpool(_template_fingerprint, room, template_id)
+                if fingerprint is not None:
+                    key = result_cache.result_key(
+                        upload.sha256, fingerprint, fit=fit, margin_px=margin_px,
+                        feather_px=feather_px if feather_px >= 0 else None,
+                        opacity=opacity if opacity >= 0 else None,
+                        preview_long_edge=preview_long_edge, remove_background=remove_background)
+            if key is not None:
+                with stage("cache"):
+                    png = await run_in_threadpool(result_cache.get, key)
+                if png is not None:
+                    return _mockup_response(png, return_format, key, "HIT")
+
+        # Identical concurrent requests (double clicks, retries) share one composite; it runs
+        # off the event loop so duplicates arriving meanwhile can attach
+        def job():
+            started.append(True)  # the job owns the upload from here
+            return _apply_job(upload, cache_key=key, **params)
+
+        png = await _inflight.run(request_key(upload.sha256, **params), job)
+        return _mockup_response(png, return_format, key, "MISS" if key is not None else None)
+    finally:
+        if not started:
+            upload.close()  # cache hit or joined another request's job: never read
+
+
+def _mockup_response(png, return_format, key=None, cache_status=None):
+    """PNG or base64 JSON response for composed PNG bytes"""
+    headers = {}
+    if key is not None:
+        headers["ETag"] = result_cache.etag(key)
+    if cache_status:
+        headers["X-Cache"] = cache_status
+
+    if return_format == "json":
+        import base64
+        with stage("base64"):
+            b64 = base64.b64encode(png).decode("utf-8")
+        w, h = result_cache.png_size(png)
+        return JSONResponse({"image_b64": b64, "w": w, "h": h}, headers=headers)
+
+    headers["Content-Disposition"] = 'inline; filename="mockup.png"'
+    return Response(content=png, media_type="image/png", headers=headers)
+
+
+async def _apply_job(upload, **kwargs):
+    try:
+        return await run_in_threadpool(_mockup_apply, upload, **kwargs)
+    finally:
+        upload.close()  # normally closed once decoded; not if the template failed first
+
+
+def _mockup_apply(upload, room, template_id, fit, margin_px, feather_px, opacity,
+                  preview_long_edge, remove_background, cache_key=None):
+    """Composite one artwork onto one template; returns the PNG bytes"""
+    # Cached template: decoded background + compiled quad geometry
+    with stage("template"):
+        tpl = _get_template(room, template_id)
+        if preview_long_edge > 0:
+            tpl = template_store.preview_template(tpl, preview_long_edge)
+    scale = tpl.get("scale", 1.0)
+
+    # Decode uploaded art
     try:
-        art = Image.open(io.BytesIO(raw)).convert("RGBA")
-        art = ImageOps.exif_transpose(art)
+        with stage("decode"):
+            art = Image.open(upload.rewind())
+            if preview_long_edge > 0:
+                art.draft(None, (preview_long_edge, preview_long_edge))
+            art = ImageOps.exif_transpose(art.convert("RGBA"))
     except Exception as e:
         raise HTTPException(400, f"Could not read artwork: {e}")
+    finally:
+        upload.close()  # decoded; drop the spooled bytes
 
-    # Destination rect inside corners
-    # Distance top edge:
-    dst_w = math.dist(TL, TR)
-    # Distance left edge:
-    dst_h = math.dist(TL, BL)
-
-    # apply margin (shrink destination)
-    mx = max(0, int(margin_px))
-    # Build destination quad as float np array
-    dst_quad = np.array([TL, TR, BR, BL], dtype=np.float32)
-
-    # Compute fitted source rectangle size
-    aw, ah = art.size
-    sw, sh = _fit_size(aw, ah, int(round(dst_w))-2*mx, int(round(dst_h))-2*mx, fit.lower())
-
-    # Resize source
-    art_resized = art.resize((max(1,sw), max(1,sh)), Image.LANCZOS)
-
-    # Paste resized art into a transparent canvas the size of dst_w x dst_h
-    canvas_w = int(round(dst_w)); canvas_h = int(round(dst_h))
-    if canvas_w < 2 or canvas_h < 2:
-        raise HTTPException(400, "Destination frame too small from corners")
-    art_canvas = Image.new("RGBA", (canvas_w, canvas_h), (0,0,0,0))
-    ox = (canvas_w - sw)//2
-    oy = (canvas_h - sh)//2
-    ox = max(0, ox + (mx if sw <= canvas_w-2*mx else 0))
-    oy = max(0, oy + (mx if sh <= canvas_h-2*mx else 0))
-    art_canvas.paste(art_resized, (ox, oy), art_resized)
-
-    # OpenCV homography: map art_canvas (0,0)-(w,h) to destination quad
-    src_quad = np.array([[0,0],[canvas_w,0],[canvas_w,canvas_h],[0,canvas_h]], dtype=np.float32)
-    H, ok = cv2.findHomography(src_quad, dst_quad, method=0)
-    if H is None:
-        raise HTTPException(500, "Failed to compute homography from points")
-
-    # Warp the art onto the background
-    bg_bgra = _pil_to_np(bg)                       # BGRA
-    art_bgra = _pil_to_np(art_canvas)
-    warped = cv2.warpPerspective(art_bgra, H, (bg_w, bg_h), flags=cv2.INTER_LANCZOS4, borderMode=cv2.BORDER_TRANSPARENT)
-
-    # Build feather mask for the quad
-    quad_mask = _polygon_mask((bg_h, bg_w), dst_quad, feather_px if feather_px>=0 else float(manifest.get("feather_px", 0)))
-    opacity_val = (opacity if opacity>=0 else float(manifest.get("blend",{}).get("opacity",1.0)))
-    blend_mode = (manifest.get("blend",{}).get("mode","normal")).lower()
-
-    composed = _blend(bg_bgra, warped, quad_mask, blend_mode, opacity_val)
-    out_img = _np_to_pil(composed)
-
-    if return_format.lower() == "json":
-        buf = io.BytesIO(); out_img.save(buf, "PNG")
-        import base64
-        b64 = base64.b64encode(buf.getvalue()).decode("utf-8")
-        return JSONResponse({"image_b64": b64, "w": bg_w, "h": bg_h})
+    if remove_background:
+        try:
+            with stage("remove_background"):
+                art = background_removal.remove_background(art)
+        except Exception as e:
+            raise HTTPException(500, f"Background removal failed: {e}")
 
-    buf = io.BytesIO(); out_img.save(buf, "PNG")
-    headers = {"Content-Disposition": 'inline; filename="mockup.png"'}
-    return Response(content=buf.getvalue(), media_type="image/png", headers=headers)
+    try:
+        # Large backgrounds are composited in strips (bounded memory)
+        png = batch_mockup.compose_png(
+            art, tpl, fit=fit, margin_px=int(round(margin_px * scale)),
+            feather_px=feather_px * scale if feather_px >= 0 else None,
+            opacity=opacity if opacity >= 0 else None,
+            art_alpha=remove_background,
+        )
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    if cache_key is not None:
+        with stage("cache"):
+            result_cache.put(cache_key, png)
+    return png
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Compositor checks on synthetic templates (no template files or network needed):
+alpha handling, the ROI mask, repeatable output, strip-by-strip output against the
+whole frame, the streaming PNG encoder and export sizes
+
+    python3 -m pytest -q test_compositor.py
+"""
+import io
+import sys
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).parent / "server" / "scripts"))
+
+from batch_mockup import compose_mockup, compose_strips, compose_png, compose_with_exports  # noqa: E402
+from mockup_exports import parse_exports  # noqa: E402
+from template_store import compile_geometry, polygon_mask  # noqa: E402
+
+
+def synthetic_template(w=320, h=240, quad=((60, 40), (260, 40), (260, 200), (60, 200)), color=(0, 0, 0),
+                       feather_px=0):
+    """Template dict shaped like load_template's: flat background, one quad"""
+    bg = np.empty((h, w, 4), dtype=np.uint8)
+    bg[..., :3] = color
+    bg[..., 3] = 255
+    quad = np.array(quad, dtype=np.float32)
+    roi, mask = compile_geometry(quad, feather_px, (h, w))
+    return {"manifest": {}, "bg": bg, "quad": quad, "roi": roi, "mask": mask}
+
+
+def textured_template():
+    """Noisy background with a feathered, skewed quad: every blend path matters"""
+    tpl = synthetic_template(w=640, h=480, quad=((90, 70), (560, 40), (600, 430), (70, 400)), feather_px=9)
+    rng = np.random.default_rng(1)
+    tpl["bg"][..., :3] = rng.integers(0, 256, (480, 640, 3), dtype=np.uint8)
+    return tpl
+
+
+def textured_art(alpha=False):
+    rng = np.random.default_rng(2)
+    rgba = rng.integers(0, 256, (300, 400, 4), dtype=np.uint8)
+    if not alpha:
+        rgba[..., 3] = 255
+    return Image.fromarray(rgba, "RGBA")
+
+
+def test_art_alpha_is_applied_once():
+    # RGB (200, 100, 50) at 50% alpha over black must come out as a 50/50 blend
+    art = Image.new("RGBA", (100, 80), (200, 100, 50, 128))
+    out = compose_mockup(art, synthetic_template(), art_alpha=True)
+    b, g, r, _ = (int(v) for v in out[120, 160])
+    a = 128 / 255
+    for got, want in ((r, 200 * a), (g, 100 * a), (b, 50 * a)):
+        assert abs(got - want) <= 2, (r, g, b)
+
+
+def test_opaque_art_fills_the_quad():
+    art = Image.new("RGBA", (100, 80), (200, 100, 50, 255))
+    out = compose_mockup(art, synthetic_template(color=(10, 20, 30)))
+    assert tuple(int(v) for v in out[120, 160]) == (50, 100, 200, 255)
+    assert tuple(int(v) for v in out[5, 5]) == (10, 20, 30, 255)
+
+
+def test_roi_mask_matches_full_frame_mask():
+    tpl = textured_template()
+    full = polygon_mask((480, 640), tpl["quad"].astype(np.int32), 9)
+    x0, y0, x1, y1 = tpl["roi"]
+    assert np.array_equal(tpl["mask"], full[y0:y1, x0:x1])
+    outside = full.copy()
+    outside[y0:y1, x0:x1] = 0
+    assert not outside.any()
+
+
+def test_same_inputs_compose_identical_bytes():
+    # The warp writes into a zeroed buffer, so feathered edges cannot pick up
+    # whatever an earlier composite left in reused memory
+    tpl = textured_template()
+    first = compose_mockup(textured_art(), tpl)
+    compose_mockup(Image.new("RGBA", (400, 300), (255, 255, 255, 255)), tpl)
+    assert np.array_equal(compose_mockup(textured_art(), tpl), first)
+
+
+def test_strips_match_whole_frame():
+    tpl = textured_template()
+    for art_alpha in (False, True):
+        art = textured_art(alpha=art_alpha)
+        whole = compose_mockup(art, tpl, art_alpha=art_alpha)
+        # 37 rows: strip edges fall inside the quad and the feathered border
+        strips = np.concatenate(list(compose_strips(art, tpl, art_alpha=art_alpha, rows=37)))
+        assert np.array_equal(strips, whole)
+
+
+def test_streamed_png_decodes_to_whole_frame():
+    tpl, art = textured_template(), textured_art()
+    whole = compose_mockup(art, tpl)
+    for tiled in (False, True):
+        decoded = np.array(Image.open(io.BytesIO(compose_png(art, tpl, tiled=tiled))))
+        assert np.array_equal(cv2.cvtColor(decoded, cv2.COLOR_RGBA2BGRA), whole), f"tiled={tiled}"
+
+
+def test_exports_identical_tiled_and_whole():
+    tpl, art = textured_template(), textured_art()
+    exports = parse_exports([{"name": "large", "long_edge": 500, "format": "png"},
+                             {"name": "small", "width": 120, "format": "jpeg", "quality": 80}])
+    png_whole, whole = compose_with_exports(art, tpl, exports, tiled=False)
+    png_tiled, tiled = compose_with_exports(art, tpl, exports, tiled=True)
+    assert [(e["name"], e["width"], e["height"]) for e in whole] == [("large", 500, 375), ("small", 120, 90)]
+    assert [e["data"] for e in whole] == [e["data"] for e in tiled]
+    assert np.array_equal(np.array(Image.open(io.BytesIO(png_whole))), np.array(Image.open(io.BytesIO(png_tiled))))
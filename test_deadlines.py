@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Deadline checks: budgets from headers, cancellation, widening and the
+per-thread current deadline
+
+    python3 -m pytest -q test_deadlines.py
+"""
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent / "server" / "scripts"))
+
+import deadlines  # noqa: E402
+from deadlines import Deadline, Cancelled  # noqa: E402
+
+
+def test_smallest_budget_wins_and_junk_is_ignored():
+    d = Deadline.from_ms("30000", None, "abc", 0, 2000)
+    assert 1.5 < d.remaining() <= 2.0
+    assert Deadline.from_ms(None, "").remaining() is None
+
+
+def test_check_raises_once_cancelled_or_expired():
+    d = Deadline(60)
+    d.check("warp")
+    d.cancel("client disconnected")
+    with pytest.raises(Cancelled, match="client disconnected before warp"):
+        d.check("warp")
+    expired = Deadline(0.001)
+    time.sleep(0.01)
+    assert expired.expired()
+    with pytest.raises(Cancelled, match="deadline exceeded"):
+        expired.check()
+
+
+def test_extend_widens_and_unbounded_wins():
+    d = Deadline(1)
+    d.extend(Deadline(30))
+    assert d.remaining() > 20
+    d.extend(Deadline())
+    assert d.remaining() is None
+
+
+def test_timeout_is_cut_to_the_budget_and_run_sets_current():
+    d = Deadline(2)
+    assert d.timeout(120) <= 2
+    assert Deadline().timeout(120) == 120
+    assert deadlines.current() is None
+    assert d.run(deadlines.current) is d
+    assert deadlines.timeout(120) == 120
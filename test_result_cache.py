@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Result cache checks: key normalisation, round trip and LRU eviction
+
+    python3 -m pytest -q test_result_cache.py
+"""
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent / "server" / "scripts"))
+
+import result_cache  # noqa: E402
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(result_cache, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(result_cache, "CACHE_BYTES", 10_000)
+    monkeypatch.setitem(result_cache._STATE, "bytes", None)
+    return tmp_path
+
+
+def test_key_normalises_parameters():
+    key = result_cache.result_key("a" * 64, "fp", feather_px=3, opacity=1)
+    assert key == result_cache.result_key("a" * 64, "fp", feather_px=3.0, opacity=1.0, margin_px=0.0)
+    assert key != result_cache.result_key("a" * 64, "fp", feather_px=None, opacity=1)
+    assert key != result_cache.result_key("a" * 64, "fp2", feather_px=3, opacity=1)
+
+
+def test_put_get_round_trip(cache_dir):
+    assert result_cache.get("ab" * 32) is None
+    result_cache.put("ab" * 32, b"png bytes")
+    assert result_cache.get("ab" * 32) == b"png bytes"
+    assert not list(cache_dir.rglob("*.part"))
+
+
+def test_least_recently_read_entries_are_evicted_first(cache_dir):
+    keys = [f"{i:02d}" * 32 for i in range(4)]
+    for i, key in enumerate(keys):
+        result_cache.put(key, b"x" * 2400)
+        os.utime(result_cache._path(key), (1000 + i, 1000 + i))
+    assert result_cache.get(keys[0])  # read: now the most recent
+    result_cache.put("ff" * 32, b"x" * 2400)  # 12 000 bytes > 10 000: evict down to 9 000
+    left = {k for k in keys + ["ff" * 32] if result_cache.get(k) is not None}
+    assert left == {keys[0], keys[3], "ff" * 32}
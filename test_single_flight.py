@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+SingleFlight checks: leader/follower sharing of results and exceptions, key
+lifetime, and cancelling the job's deadline once every caller has gone
+
+    python3 -m pytest -q test_single_flight.py
+"""
+import sys
+import asyncio
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent / "server" / "scripts"))
+
+from single_flight import SingleFlight, request_key  # noqa: E402
+from deadlines import Deadline  # noqa: E402
+
+
+def counting_job(calls, release, outcome):
+    """Job factory: counts runs, waits for release, then returns or raises outcome"""
+    async def job():
+        calls.append(1)
+        await release.wait()
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+    return job
+
+
+def test_followers_share_the_leaders_result():
+    async def main():
+        flight, calls, release = SingleFlight(), [], asyncio.Event()
+        job = counting_job(calls, release, {"png": b"x"})
+        callers = [asyncio.ensure_future(flight.run("k", job)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert len(flight) == 1
+        release.set()
+        results = await asyncio.gather(*callers)
+        return flight, calls, results
+
+    flight, calls, results = asyncio.run(main())
+    assert len(calls) == 1
+    assert results == [{"png": b"x"}] * 3
+    assert results[0] is results[1] is results[2]
+    assert flight.stats == {"leaders": 1, "followers": 2}
+    assert len(flight) == 0
+
+
+def test_leaders_exception_reaches_every_follower():
+    async def main():
+        flight, calls, release = SingleFlight(), [], asyncio.Event()
+        error = ValueError("template missing")
+        job = counting_job(calls, release, error)
+        callers = [asyncio.ensure_future(flight.run("k", job)) for _ in range(3)]
+        await asyncio.sleep(0)
+        release.set()
+        return error, calls, await asyncio.gather(*callers, return_exceptions=True), flight
+
+    error, calls, results, flight = asyncio.run(main())
+    assert len(calls) == 1
+    assert results == [error] * 3
+    assert len(flight) == 0
+
+
+def test_key_is_forgotten_once_the_job_finishes():
+    async def main():
+        flight, calls, release = SingleFlight(), [], asyncio.Event()
+        release.set()
+        job = counting_job(calls, release, 1)
+        await flight.run("k", job)
+        await flight.run("k", job)
+        return calls, flight
+
+    calls, flight = asyncio.run(main())
+    assert len(calls) == 2
+    assert flight.stats == {"leaders": 2, "followers": 0}
+
+
+def test_job_survives_one_caller_leaving_and_is_cancelled_when_all_leave():
+    async def main():
+        flight, calls, release = SingleFlight(), [], asyncio.Event()
+        deadline = Deadline()
+        job = counting_job(calls, release, "done")
+        leader = asyncio.ensure_future(flight.run("k", job, deadline=deadline))
+        follower = asyncio.ensure_future(flight.run("k", job, deadline=Deadline()))
+        await asyncio.sleep(0)
+        leader.cancel()
+        await asyncio.sleep(0)
+        left_one = deadline.cancelled
+        follower.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        return left_one, deadline.cancelled
+
+    left_one, left_all = asyncio.run(main())
+    assert not left_one
+    assert left_all
+
+
+def test_follower_widens_the_deadline():
+    async def main():
+        flight, release = SingleFlight(), asyncio.Event()
+        short, longer = Deadline(5), Deadline(60)
+        job = counting_job([], release, None)
+        callers = [asyncio.ensure_future(flight.run("k", job, deadline=short)),
+                   asyncio.ensure_future(flight.run("k", job, deadline=longer))]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*callers)
+        return short, longer
+
+    short, longer = asyncio.run(main())
+    assert short.expires == longer.expires
+
+
+def test_request_key_ignores_parameter_order():
+    assert request_key(b"artwork", style="loft", n=2) == request_key(b"artwork", n=2, style="loft")
+    assert request_key(b"artwork", style="loft") != request_key(b"artwork", style="barn")
+    digest = "ab" * 32  # upload_ingest's streamed sha256
+    assert request_key(digest, n=1) == request_key(digest, n=1) != request_key(digest, n=2)
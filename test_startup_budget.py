@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Startup budget for the Python services
+Each service module is imported under `python -X importtime` and must not pull
+in anything meant to load lazily (numpy, cv2, PIL, requests, jwt, rembg,
+onnxruntime; see server/scripts/warmup.py) or take longer than
+STARTUP_IMPORT_BUDGET_MS. It is then started under uvicorn, and under the
+prefork runner (start_fastapi.py --workers 2, which warms before forking), and
+the first 200 from /healthz must arrive within STARTUP_BUDGET_MS of spawning
+the process.
+
+    python3 test_startup_budget.py               # import-time report + checks
+    python3 -m pytest -q test_startup_budget.py
+"""
+import os
+import sys
+import time
+import socket
+import subprocess
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).parent
+SERVICES = {"app": "/healthz", "template_mockup_api": "/healthz"}
+LAZY_MODULES = ("numpy", "cv2", "PIL", "requests", "jwt", "rembg", "onnxruntime")
+IMPORT_BUDGET_MS = float(os.getenv("STARTUP_IMPORT_BUDGET_MS", "1000"))
+HEALTHZ_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "3000"))
+
+
+def import_report(module):
+    """Import module in a fresh interpreter; returns total ms, every module loaded and the top-level breakdown"""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                          cwd=ROOT, capture_output=True, text=True, timeout=120)
+    if proc.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{proc.stderr[-2000:]}")
+    loaded, top, total_us = set(), [], 0
+    for line in proc.stderr.splitlines():
+        parts = line.split("|")
+        if not line.startswith("import time:") or len(parts) != 3 or "self [us]" in line:
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        name, cumulative = name.strip(), int(parts[1])
+        loaded.add(name)
+        if name == module and depth == 0:
+            total_us = cumulative
+        elif depth == 1:
+            top.append((cumulative, name))
+    return {"total_ms": total_us / 1000, "modules": loaded, "top": sorted(top, reverse=True)}
+
+
+def lazy_modules_loaded(modules):
+    return sorted({m.split(".")[0] for m in modules} & set(LAZY_MODULES))
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def time_to_healthy(module, path, workers=1, timeout=60):
+    """ms from spawning uvicorn (or the prefork runner) on module:app until path answers 200"""
+    port = _free_port()
+    env = dict(os.environ, PYTHONUNBUFFERED="1", FASTAPI_PORT=str(port))
+    if workers > 1:
+        cmd = [sys.executable, "start_fastapi.py", "--app", f"{module}:app", "--workers", str(workers)]
+    else:
+        cmd = [sys.executable, "-m", "uvicorn", f"{module}:app", "--host", "127.0.0.1", "--port", str(port),
+               "--log-level", "warning"]
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        while time.perf_counter() - t0 < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(f"{module} exited during startup:\n{proc.stderr.read().decode()[-2000:]}")
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}{path}", timeout=1) as resp:
+                    if resp.status == 200:
+                        return (time.perf_counter() - t0) * 1000
+            except OSError:
+                time.sleep(0.02)
+        raise RuntimeError(f"{module} not healthy after {timeout}s")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def test_services_import_no_heavy_modules():
+    for module in SERVICES:
+        eager = lazy_modules_loaded(import_report(module)["modules"])
+        assert not eager, f"{module} imports {eager} at startup; load them through warmup.lazy_import"
+
+
+def test_services_import_within_budget():
+    for module in SERVICES:
+        total = import_report(module)["total_ms"]
+        assert total <= IMPORT_BUDGET_MS, f"import {module} took {total:.0f} ms (budget {IMPORT_BUDGET_MS:.0f} ms)"
+
+
+def test_services_healthy_within_budget():
+    for module, path in SERVICES.items():
+        took = time_to_healthy(module, path)
+        assert took <= HEALTHZ_BUDGET_MS, f"{module} {path} took {took:.0f} ms (budget {HEALTHZ_BUDGET_MS:.0f} ms)"
+
+
+def test_prefork_healthy_within_budget():
+    # The parent answers /healthz itself while it warms, before any worker exists
+    for module, path in SERVICES.items():
+        took = time_to_healthy(module, path, workers=2)
+        assert took <= HEALTHZ_BUDGET_MS, \
+            f"prefork {module} {path} took {took:.0f} ms (budget {HEALTHZ_BUDGET_MS:.0f} ms)"
+
+
+if __name__ == "__main__":
+    failed = False
+    for module, path in SERVICES.items():
+        report = import_report(module)
+        eager = lazy_modules_loaded(report["modules"])
+        healthy = time_to_healthy(module, path)
+        prefork = time_to_healthy(module, path, workers=2)
+        print(f"\n{module}: import {report['total_ms']:.0f} ms (budget {IMPORT_BUDGET_MS:.0f}), "
+              f"{path} 200 after {healthy:.0f} ms, prefork {prefork:.0f} ms (budget {HEALTHZ_BUDGET_MS:.0f})")
+        for cumulative, name in report["top"][:8]:
+            print(f"  {cumulative / 1000:8.1f} ms  {name}")
+        if eager:
+            print(f"  !! eagerly imported: {', '.join(eager)}")
+        failed |= bool(eager) or report["total_ms"] > IMPORT_BUDGET_MS or max(healthy, prefork) > HEALTHZ_BUDGET_MS
+    print("\nFAIL" if failed else "\nOK")
+    sys.exit(1 if failed else 0)
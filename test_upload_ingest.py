@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Upload ingestion checks: signature sniff, byte and pixel caps, streamed sha256,
+header probe and the UploadLimit middleware
+
+    python3 -m pytest -q test_upload_ingest.py
+"""
+import io
+import sys
+import asyncio
+import hashlib
+from pathlib import Path
+
+import pytest
+from PIL import Image
+from starlette.datastructures import UploadFile
+
+sys.path.insert(0, str(Path(__file__).parent / "server" / "scripts"))
+
+from upload_ingest import read_upload, UploadError, UploadLimit, CHUNK_BYTES  # noqa: E402
+
+
+def png_bytes(w=64, h=48, noise=False):
+    img = Image.effect_noise((w, h), 64).convert("RGB") if noise else Image.new("RGB", (w, h), (20, 40, 60))
+    buf = io.BytesIO()
+    img.save(buf, "PNG")
+    return buf.getvalue()
+
+
+def ingest(data, declared_size=True, **caps):
+    upload = UploadFile(io.BytesIO(data), size=len(data) if declared_size else None, filename="art.png")
+    return asyncio.run(read_upload(upload, **caps))
+
+
+def refused(data, **kwargs):
+    with pytest.raises(UploadError) as info:
+        ingest(data, **kwargs)
+    return info.value.status_code
+
+
+def test_image_is_spooled_hashed_and_probed():
+    data = png_bytes()
+    upload = ingest(data)
+    try:
+        assert (upload.format, upload.width, upload.height, upload.size) == ("PNG", 64, 48, len(data))
+        assert upload.sha256 == hashlib.sha256(data).hexdigest()
+        assert upload.read() == data
+        assert Image.open(upload.rewind()).size == (64, 48)
+    finally:
+        upload.close()
+
+
+def test_multi_chunk_upload_hashes_every_chunk():
+    data = png_bytes(1200, 1200, noise=True)
+    assert len(data) > CHUNK_BYTES
+    upload = ingest(data, declared_size=False)
+    try:
+        assert upload.sha256 == hashlib.sha256(data).hexdigest()
+        assert upload.read() == data
+    finally:
+        upload.close()
+
+
+def test_non_image_is_refused_with_415():
+    assert refused(b"%PDF-1.7 not an image" * 10) == 415
+
+
+def test_byte_cap_from_declared_size_and_while_streaming():
+    data = png_bytes(1200, 1200, noise=True)
+    assert refused(data, max_bytes=len(data) - 1) == 413
+    assert refused(data, declared_size=False, max_bytes=len(data) - 1) == 413
+
+
+def test_pixel_cap_from_header():
+    assert refused(png_bytes(400, 300), max_pixels=100_000) == 413
+    ingest(png_bytes(400, 250), max_pixels=100_000).close()
+
+
+def test_truncated_header_and_empty_upload_are_400():
+    assert refused(png_bytes()[:20]) == 400
+    assert refused(b"") == 400
+
+
+def call_limited(body, max_bytes, content_length=True):
+    """Run UploadLimit around an app that reads the whole body; returns (status, app_saw_body)"""
+    seen = {"body": False}
+
+    async def app(scope, receive, send):
+        while True:
+            message = await receive()
+            if not message.get("more_body"):
+                break
+        seen["body"] = True
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    chunks = [body[i:i + 1000] for i in range(0, len(body), 1000)]
+    headers = [(b"content-length", str(len(body)).encode())] if content_length else []
+    scope = {"type": "http", "method": "POST", "path": "/", "headers": headers}
+    sent = []
+
+    async def receive():
+        chunk = chunks.pop(0) if chunks else b""
+        return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(UploadLimit(app, max_bytes=max_bytes)(scope, receive, send))
+    status = next(m["status"] for m in sent if m["type"] == "http.response.start")
+    return status, seen["body"]
+
+
+def test_upload_limit_middleware():
+    small, large = b"x" * 10_000, b"x" * 200_000
+    cap = 50_000  # plus the middleware's form overhead allowance of 64 KiB
+    assert call_limited(small, cap) == (200, True)
+    assert call_limited(large, cap) == (413, False)
+    # Chunked: no Content-Length, stopped once the streamed body passes the cap
+    assert call_limited(large, cap, content_length=False)[0] == 413
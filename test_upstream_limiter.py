@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Upstream limiter checks: token buckets, priority order, rejection, a slow store,
+and the SQLite store shared by forked workers, including 429 pauses
+
+    python3 -m pytest -q test_upstream_limiter.py
+"""
+import os
+import sys
+import time
+import sqlite3
+import threading
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent / "server" / "scripts"))
+
+from upstream_limiter import UpstreamLimiter, UpstreamBusy  # noqa: E402
+
+# 6 requests/minute with a 40 s burst: a 4-token bucket that refills 0.1 token/s
+RPM, BURST_SECONDS, CAPACITY = 6, 40, 4
+
+
+def shared_limiter(db_path):
+    return UpstreamLimiter("test", rpm=RPM, burst_seconds=BURST_SECONDS, db_path=str(db_path))
+
+
+def test_forked_workers_share_sqlite_buckets(tmp_path):
+    db = tmp_path / "limiter.db"
+    limiter = shared_limiter(db)
+    # The parent uses its connection before forking, as a preloaded app might
+    assert limiter._store.try_take({"requests": 1}) == 0
+
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            parent_db = limiter._store._db
+            took = [limiter._store.try_take({"requests": 1}) for _ in range(2)]
+            fresh = limiter._store._db is not None and limiter._store._db is not parent_db
+            code = 0 if fresh and took == [0, 0] else 2
+        finally:
+            os._exit(code)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0, "child could not take tokens on its own connection"
+
+    # 1 (parent) + 2 (child) taken: one token left for the parent, then the shared bucket is empty
+    assert limiter._store.try_take({"requests": 1}) == 0
+    assert limiter._store.try_take({"requests": 1}) > 0
+
+
+def test_connection_opens_on_first_use(tmp_path):
+    limiter = shared_limiter(tmp_path / "limiter.db")
+    assert limiter._store._db is None
+    with limiter.admit():
+        pass
+    assert limiter._store._db is not None
+
+
+def test_backoff_pauses_this_process_when_the_shared_write_is_blocked(tmp_path):
+    db = tmp_path / "limiter.db"
+    limiter = UpstreamLimiter("test", rpm=RPM, burst_seconds=BURST_SECONDS, queue_timeout=0.2, db_path=str(db))
+    with limiter.admit():
+        pass
+    other_worker = sqlite3.connect(str(db), isolation_level=None)
+    other_worker.execute("BEGIN EXCLUSIVE")
+    try:
+        started = time.monotonic()
+        limiter.backoff(30)
+        blocked = time.monotonic() - started
+    finally:
+        other_worker.execute("ROLLBACK")
+        other_worker.close()
+    assert blocked < 2, f"backoff blocked {blocked:.1f}s on the SQLite lock"
+    with pytest.raises(UpstreamBusy), limiter.admit():
+        pass
+
+
+def test_bucket_holds_burst_then_waits():
+    limiter = UpstreamLimiter("test", rpm=RPM, burst_seconds=BURST_SECONDS)
+    for _ in range(CAPACITY):
+        assert limiter._store.try_take({"requests": 1}) == 0
+    assert limiter._store.try_take({"requests": 1}) > 0
+
+
+def test_interactive_is_admitted_before_bulk_queued_earlier():
+    limiter = UpstreamLimiter("test", concurrency=1)
+    order = []
+
+    def call(priority):
+        with limiter.admit(priority=priority):
+            order.append(priority)
+
+    with limiter.admit():  # hold the only slot while both queue
+        bulk = threading.Thread(target=call, args=("bulk",))
+        bulk.start()
+        while not limiter._queue:
+            time.sleep(0.001)
+        interactive = threading.Thread(target=call, args=("interactive",))
+        interactive.start()
+        while len(limiter._queue) < 2:
+            time.sleep(0.001)
+    bulk.join(5)
+    interactive.join(5)
+    assert order == ["interactive", "bulk"]
+
+
+def test_full_queue_and_queue_timeout_reject_with_retry_after():
+    limiter = UpstreamLimiter("test", concurrency=1, queue_max=0, queue_timeout=0.05)
+    with limiter.admit():
+        with pytest.raises(UpstreamBusy) as info, limiter.admit():
+            pass
+    assert info.value.retry_after >= 1
+    assert limiter.stats["rejected_timeout"] == 1
+
+    limiter = UpstreamLimiter("test", concurrency=1, queue_max=1)
+    limiter._queue.append([0, -1])  # one call already waiting
+    with pytest.raises(UpstreamBusy), limiter.admit():
+        pass
+    assert limiter.stats["rejected_queue_full"] == 1
+
+
+def test_slow_store_does_not_block_releases_or_metrics():
+    limiter = UpstreamLimiter("test")
+    in_store, release = threading.Event(), threading.Event()
+
+    class SlowStore:
+        """A store stuck on another worker's SQLite lock until released"""
+        def try_take(self, costs):
+            in_store.set()
+            release.wait(5)
+            return 0.0
+
+    held = limiter.admit()
+    held.__enter__()  # a call already in flight, admitted before the store got slow
+    limiter._store = SlowStore()
+
+    def call():
+        with limiter.admit():
+            pass
+
+    waiting = threading.Thread(target=call)
+    waiting.start()
+    assert in_store.wait(5)
+    started = time.monotonic()
+    limiter.render_prometheus()
+    held.__exit__(None, None, None)
+    blocked = time.monotonic() - started
+    release.set()
+    waiting.join(5)
+    assert blocked < 1, f"blocked {blocked:.1f}s behind the store"
+    assert limiter.stats["admitted"] == 2